@@ -0,0 +1,100 @@
+# admin_stats.py
+# آمار پیش‌محاسبه شده برای دستور ادمین /stats تا پاسخ آن به اندازه جداول users و connected_oauth_emails وابسته نباشد.
+#   stats_counters: شمارنده‌هایی که مسیرهای نوشتن با یک UPSERT افزایشی به‌روز می‌کنند (تعداد کاربران، حساب‌ها به تفکیک ارائه‌دهنده)
+#   subscription_expiry_days: تعداد کاربران به تفکیک روز انقضای اشتراک (0 = بدون انقضا)؛ فعال/منقضی با جمع چند صد ردیف
+#   stats_snapshots: خلاصه‌هایی که چرخه واکشی می‌نویسد (آمار آخرین پنجره هر پردازه واکشی و توزیع مصرف سهمیه)
+# توابع این ماژول یک execute(query, params) می‌گیرند تا هم با db_execute و هم با cursor یک تراکنش باز استفاده شوند.
+import json
+
+SECONDS_PER_DAY = 86400
+NO_EXPIRY_DAY = 0
+
+USERS_TOTAL = "users_total"
+QUOTA_DISTRIBUTION_SNAPSHOT = "quota_distribution"
+FETCH_CYCLE_SNAPSHOT_PREFIX = "fetch_cycle:"
+
+# بازه‌های مصرف سهمیه ماهانه (درصد)؛ کاربران با سهمیه نامحدود جداگانه شمرده می‌شوند
+QUOTA_DISTRIBUTION_QUERY = """
+SELECT CASE WHEN monthly_email_quota <= 0 THEN 'unlimited'
+            WHEN current_month_emails_received >= monthly_email_quota THEN '100'
+            WHEN current_month_emails_received * 4 >= monthly_email_quota * 3 THEN '75-99'
+            WHEN current_month_emails_received * 2 >= monthly_email_quota THEN '50-74'
+            WHEN current_month_emails_received * 4 >= monthly_email_quota THEN '25-49'
+            ELSE '0-24' END AS bucket,
+       COUNT(*) AS users
+FROM users GROUP BY bucket
+"""
+QUOTA_BUCKETS = ('0-24', '25-49', '50-74', '75-99', '100', 'unlimited')
+
+
+def accounts_total_counter(provider: str) -> str:
+    return f"accounts_total:{provider}"
+
+
+def accounts_active_counter(provider: str) -> str:
+    return f"accounts_active:{provider}"
+
+
+def expiry_day(expiry_timestamp) -> int:
+    return int(expiry_timestamp) // SECONDS_PER_DAY if expiry_timestamp else NO_EXPIRY_DAY
+
+
+def add_to_counters(execute, deltas: dict):
+    """افزودن deltaها (name -> مقدار) به stats_counters با یک کوئری؛ deltaهای صفر نادیده گرفته می‌شوند."""
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if not deltas: return
+    execute(
+        f"""INSERT INTO stats_counters (name, value) VALUES {', '.join(['(%s, %s)'] * len(deltas))}
+            ON DUPLICATE KEY UPDATE value = value + VALUES(value)""",
+        tuple(value for item in deltas.items() for value in item)
+    )
+
+
+def move_subscription_expiry(execute, day_deltas: dict):
+    """اعمال تغییر تعداد کاربران روزهای انقضا (expiry_day -> delta)؛ مثلاً {روز قبلی: -1، روز جدید: +1}."""
+    day_deltas = {day: delta for day, delta in day_deltas.items() if delta}
+    if not day_deltas: return
+    execute(
+        f"""INSERT INTO subscription_expiry_days (expiry_day, users) VALUES {', '.join(['(%s, %s)'] * len(day_deltas))}
+            ON DUPLICATE KEY UPDATE users = users + VALUES(users)""",
+        tuple(value for item in day_deltas.items() for value in item)
+    )
+
+
+def save_snapshot(execute, name: str, payload: dict, updated_at: int):
+    execute(
+        """INSERT INTO stats_snapshots (name, payload, updated_at) VALUES (%s, %s, %s)
+           ON DUPLICATE KEY UPDATE payload = VALUES(payload), updated_at = VALUES(updated_at)""",
+        (name, json.dumps(payload), updated_at)
+    )
+
+
+def rebuild_counters(execute):
+    """بازسازی کامل شمارنده‌ها از روی جداول (مهاجرت اولیه و /stats rebuild)؛ تنها مسیری که کل جداول را می‌خواند."""
+    execute("DELETE FROM stats_counters", ())
+    execute("DELETE FROM subscription_expiry_days", ())
+    execute(f"INSERT INTO stats_counters (name, value) SELECT '{USERS_TOTAL}', COUNT(*) FROM users", ())
+    execute(
+        """INSERT INTO stats_counters (name, value)
+           SELECT CONCAT('accounts_total:', provider), COUNT(*) FROM connected_oauth_emails GROUP BY provider""", ()
+    )
+    execute(
+        """INSERT INTO stats_counters (name, value)
+           SELECT CONCAT('accounts_active:', provider), COUNT(*) FROM connected_oauth_emails WHERE is_active = TRUE GROUP BY provider""", ()
+    )
+    execute(
+        f"""INSERT INTO subscription_expiry_days (expiry_day, users)
+            SELECT IFNULL(subscription_expiry_timestamp DIV {SECONDS_PER_DAY}, {NO_EXPIRY_DAY}) AS day, COUNT(*) FROM users GROUP BY day""", ()
+    )
+
+
+def subscription_summary(expiry_rows, now_timestamp: int) -> dict:
+    """خلاصه اشتراک‌ها از ردیف‌های subscription_expiry_days؛ روز جاری جداگانه («امروز منقضی می‌شود») شمرده می‌شود."""
+    today = now_timestamp // SECONDS_PER_DAY
+    summary = {'no_expiry': 0, 'active': 0, 'expiring_today': 0, 'expired': 0}
+    for row in expiry_rows:
+        if row['expiry_day'] == NO_EXPIRY_DAY: summary['no_expiry'] += row['users']
+        elif row['expiry_day'] > today: summary['active'] += row['users']
+        elif row['expiry_day'] == today: summary['expiring_today'] += row['users']
+        else: summary['expired'] += row['users']
+    return summary
@@ -0,0 +1,448 @@
+# benchmark.py
+# اجرای بارهای کاری مصنوعی روی کد واقعی ربات و redirect handler با سرورهای جایگزین محلی تلگرام و گوگل
+# (benchmark_standins.py) و یک پایگاه داده دورریختنی روی همان سرور MySQL (نام آن باید به _bench ختم شود).
+# خروجی یک گزارش JSON است (توان عملیاتی، تأخیر p50/p90/p99، حافظه و آمار سرورهای جایگزین) که با زیردستور compare مقایسه می‌شود.
+#
+# مثال‌ها:
+#   python benchmark.py run --workloads fetch --accounts 10000 --google-latency-ms 80 --output before.json
+#   python benchmark.py run --workloads buttons,oauth,db --output after.json
+#   python benchmark.py compare before.json after.json --fail-on-regression 10
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+from benchmark_standins import FakeGoogleServer, FakeTelegramServer
+
+BENCH_TELEGRAM_TOKEN = "123456:benchmark-token"
+BENCH_USER_ID_BASE = 900_000_000
+WORKLOADS = ('fetch', 'buttons', 'oauth', 'db')
+BUTTON_CALLBACKS = ('account_info', 'my_oauth_emails', 'connect_oauth_email_init', 'back_to_main')
+# جداولی که پیش از هر اجرا خالی می‌شوند (به ترتیب وابستگی کلید خارجی)
+BENCH_TABLES = ('digest_items', 'email_digests', 'stats_counters', 'subscription_expiry_days', 'oauth_completion_events', 'telegram_outbox', 'gmail_push_notifications', 'fetch_workers', 'oauth_states', 'connected_oauth_emails', 'users')
+
+
+# --- اندازه‌گیری ---
+class LatencyRecorder:
+    """ثبت تأخیر و خطای عملیات از چند نخ (یا حلقه رویداد)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations = []
+        self.errors = 0
+
+    def record(self, seconds: float, failed: bool = False):
+        with self._lock:
+            self.durations.append(seconds)
+            if failed: self.errors += 1
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    """صدک به روش nearest-rank روی فهرست مرتب شده."""
+    if not sorted_values: return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024 # لینوکس: کیلوبایت، macOS: بایت
+
+
+def summarize(recorder: LatencyRecorder, wall_seconds: float, **extra) -> dict:
+    durations = sorted(recorder.durations)
+    result = {
+        'operations': len(durations),
+        'errors': recorder.errors,
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_per_second': round(len(durations) / wall_seconds, 2) if wall_seconds > 0 else 0.0,
+        'latency_ms': {
+            'p50': round(percentile(durations, 0.50) * 1000, 2),
+            'p90': round(percentile(durations, 0.90) * 1000, 2),
+            'p99': round(percentile(durations, 0.99) * 1000, 2),
+            'max': round(durations[-1] * 1000, 2) if durations else 0.0,
+            'mean': round(sum(durations) / len(durations) * 1000, 2) if durations else 0.0,
+        },
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+    if tracemalloc.is_tracing():
+        result['python_heap_peak_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+        tracemalloc.reset_peak()
+    result.update(extra)
+    return result
+
+
+# --- آماده‌سازی محیط و داده‌ها ---
+def configure_environment(args):
+    """تنظیم متغیرهای محیطی پیش از import کردن main_bot و redirect_handler_app (هر دو پیکربندی را هنگام import می‌خوانند)."""
+    if not args.database.endswith('_bench'):
+        sys.exit(f"Refusing to use database '{args.database}': benchmark databases must end with '_bench' because their tables are wiped.")
+    os.environ['MYSQL_DATABASE'] = args.database
+    os.environ['TELEGRAM_BOT_TOKEN'] = BENCH_TELEGRAM_TOKEN
+    os.environ['ENABLE_EMAIL_FETCHING'] = 'false'
+    os.environ['GMAIL_PUSH_TOPIC'] = ''
+    os.environ['ADMIN_TELEGRAM_IDS'] = ''
+    os.environ['METRICS_PORT'] = '0'
+    os.environ['EMAIL_FETCH_WORKERS'] = str(args.workers)
+    os.environ['DB_POOL_SIZE'] = str(args.pool_size)
+    os.environ['LOG_LEVEL'] = args.log_level
+    for name in ('GOOGLE_CLIENT_ID', 'GOOGLE_CLIENT_SECRET', 'GOOGLE_REDIRECT_URI'):
+        os.environ.setdefault(name, 'benchmark')
+    if not os.getenv('ENCRYPTION_KEY'):
+        from cryptography.fernet import Fernet
+        os.environ['ENCRYPTION_KEY'] = Fernet.generate_key().decode()
+
+
+def reset_bench_database(main_bot):
+    main_bot.init_db_main()
+    for table_name in BENCH_TABLES:
+        main_bot.db_execute(f"DELETE FROM {table_name}", commit=True)
+    main_bot.user_profile_cache.clear()
+
+
+def seed_users_and_accounts(main_bot, accounts: int, accounts_per_user: int, chunk_size: int = 1000):
+    """ایجاد کاربران با سهمیه نامحدود و حساب‌های جیمیل با توکن معتبر و نشانگر history اولیه."""
+    users_count = -(-accounts // accounts_per_user)
+    current_month = datetime.now(timezone.utc).strftime("%Y-%m")
+    now = int(time.time())
+    user_rows = [(BENCH_USER_ID_BASE + i, f"bench_user_{i}", False, None, accounts_per_user, 0, 0, current_month) for i in range(users_count)]
+    encrypted_access_token = main_bot.encrypt_data("bench-at-seeded")
+    encrypted_refresh_token = main_bot.encrypt_data("bench-rt-seeded")
+    account_rows = [
+        (BENCH_USER_ID_BASE + i // accounts_per_user, 'google', f"bench{i}@bench.example.com", encrypted_access_token,
+         encrypted_refresh_token, now + 86400, True, '1000', now)
+        for i in range(accounts)
+    ]
+    conn = main_bot.get_db_connection(db_name=main_bot.MYSQL_DATABASE_NAME_ENV)
+    cursor = conn.cursor()
+    try:
+        for start in range(0, len(user_rows), chunk_size):
+            cursor.executemany(
+                """INSERT INTO users (telegram_id, username, is_admin, subscription_expiry_timestamp, max_allowed_emails,
+                   monthly_email_quota, current_month_emails_received, last_quota_reset_month) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+                user_rows[start:start + chunk_size]
+            )
+        for start in range(0, len(account_rows), chunk_size):
+            cursor.executemany(
+                """INSERT INTO connected_oauth_emails (user_telegram_id, provider, email_address, encrypted_access_token,
+                   encrypted_refresh_token, token_expiry_timestamp, is_active, last_processed_email_marker, timestamp_added)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+                account_rows[start:start + chunk_size]
+            )
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    return users_count
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --- بارهای کاری ---
+def bench_fetch(main_bot, args) -> dict:
+    """یک یا چند چرخه کامل واکشی (run_fetch_cycle) روی همه حساب‌ها با سرور جایگزین Gmail."""
+    google = FakeGoogleServer(args.google_latency_ms, args.google_error_rate, args.new_mail_ratio, args.messages_per_hit).start()
+    saved_urls = (main_bot.gmail_client.GMAIL_API_BASE_URL, main_bot.gmail_client.GMAIL_BATCH_URL, main_bot.GOOGLE_TOKEN_URI)
+    original_process_account_fetch = main_bot.process_account_fetch
+    recorder = LatencyRecorder()
+
+    def measured_process_account_fetch(acc_row, bot_instance_ref):
+        duration, outcome = original_process_account_fetch(acc_row, bot_instance_ref)
+        recorder.record(duration, failed=outcome is None)
+        return duration, outcome
+
+    main_bot.gmail_client.GMAIL_API_BASE_URL = google.gmail_api_base_url
+    main_bot.gmail_client.GMAIL_BATCH_URL = google.gmail_batch_url
+    main_bot.GOOGLE_TOKEN_URI = google.token_url
+    main_bot.process_account_fetch = measured_process_account_fetch
+    try:
+        reset_bench_database(main_bot)
+        seed_users_and_accounts(main_bot, args.accounts, args.accounts_per_user)
+        started = time.perf_counter()
+        lease_started = time.perf_counter()
+        main_bot.sync_account_leases(int(time.time()))
+        lease_sync_seconds = time.perf_counter() - lease_started
+        cycles = []
+        for _ in range(args.rounds):
+            rows = main_bot.iter_active_accounts(int(time.time()), lease_owner=main_bot.FETCH_WORKER_ID)
+            cycles.append(main_bot.run_fetch_cycle(rows, None, main_bot.fetch_executor))
+        wall_seconds = time.perf_counter() - started
+        outbox_row = main_bot.db_execute("SELECT COUNT(*) AS queued FROM telegram_outbox", fetchone=True)
+        main_bot.release_account_leases()
+        return summarize(
+            recorder, wall_seconds,
+            accounts=args.accounts, rounds=args.rounds, lease_sync_seconds=round(lease_sync_seconds, 3),
+            max_cycle_wall_seconds=round(max(cycle['wall_seconds'] for cycle in cycles), 3),
+            messages_enqueued=outbox_row['queued'] if outbox_row else None,
+            db_pool=main_bot.db_pool.stats(), gmail_batch=dict(main_bot.gmail_client.batch_stats),
+            standins={'google': google.stats()},
+        )
+    finally:
+        main_bot.gmail_client.GMAIL_API_BASE_URL, main_bot.gmail_client.GMAIL_BATCH_URL, main_bot.GOOGLE_TOKEN_URI = saved_urls
+        main_bot.process_account_fetch = original_process_account_fetch
+        google.stop()
+
+
+def callback_query_update(update_id: int, user_id: int, data: str) -> dict:
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id), 'chat_instance': 'bench', 'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench', 'username': f'bench_user_{user_id - BENCH_USER_ID_BASE}'},
+            'message': {'message_id': 1, 'date': int(time.time()), 'text': 'menu', 'chat': {'id': user_id, 'type': 'private'},
+                        'from': {'id': 123456, 'is_bot': True, 'first_name': 'bench'}},
+        },
+    }
+
+
+async def run_button_bursts(main_bot, application, args, recorder: LatencyRecorder):
+    from telegram import Update
+    failed_update_ids = set()
+
+    async def count_error(update, context):
+        if isinstance(update, Update): failed_update_ids.add(update.update_id)
+
+    application.add_error_handler(count_error)
+    await application.initialize()
+    try:
+        async def press(update_dict):
+            update = Update.de_json(update_dict, application.bot)
+            started = time.perf_counter()
+            await application.process_update(update)
+            recorder.record(time.perf_counter() - started, failed=update.update_id in failed_update_ids)
+
+        update_id = 0
+        for _ in range(args.bursts):
+            burst = []
+            for _ in range(args.burst_size):
+                update_id += 1
+                user_id = BENCH_USER_ID_BASE + update_id % args.users
+                burst.append(callback_query_update(update_id, user_id, BUTTON_CALLBACKS[update_id % len(BUTTON_CALLBACKS)]))
+            await asyncio.gather(*(press(update_dict) for update_dict in burst))
+            if args.burst_interval_ms: await asyncio.sleep(args.burst_interval_ms / 1000)
+    finally:
+        await application.shutdown()
+
+
+def bench_buttons(main_bot, args) -> dict:
+    """رگبار فشردن دکمه‌های شیشه‌ای: هر به‌روزرسانی از مسیر کامل Application (کنترل‌کننده، پایگاه داده و Bot API) عبور می‌کند."""
+    from telegram.ext import Application
+    telegram = FakeTelegramServer(args.telegram_latency_ms, args.telegram_error_rate).start()
+    recorder = LatencyRecorder()
+    try:
+        reset_bench_database(main_bot)
+        seed_users_and_accounts(main_bot, args.users, 1)
+        builder = Application.builder().token(BENCH_TELEGRAM_TOKEN).base_url(f"{telegram.url}/bot").concurrent_updates(True)
+        builder = builder.connection_pool_size(max(8, args.burst_size))
+        application = main_bot.build_application(builder)
+        started = time.perf_counter()
+        asyncio.run(run_button_bursts(main_bot, application, args, recorder))
+        return summarize(recorder, time.perf_counter() - started, bursts=args.bursts, burst_size=args.burst_size,
+                         db_pool=main_bot.db_pool.stats(), user_cache=main_bot.user_profile_cache.stats(),
+                         standins={'telegram': telegram.stats()})
+    finally:
+        telegram.stop()
+
+
+def bench_oauth(main_bot, args) -> dict:
+    """طوفان callbackهای OAuth: درخواست‌های هم‌زمان به /oauth2callback روی سرور WSGI چندنخی محلی."""
+    import requests
+    from werkzeug.serving import make_server
+    import oauth_flow
+    import redirect_handler_app
+    google = FakeGoogleServer(args.google_latency_ms, args.google_error_rate).start()
+    saved_urls = (oauth_flow.GOOGLE_TOKEN_URL, oauth_flow.GOOGLE_USERINFO_URL)
+    oauth_flow.GOOGLE_TOKEN_URL = google.token_url
+    oauth_flow.GOOGLE_USERINFO_URL = google.userinfo_url
+    server = make_server('127.0.0.1', 0, redirect_handler_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench_redirect_handler", daemon=True).start()
+    recorder = LatencyRecorder()
+    try:
+        reset_bench_database(main_bot)
+        seed_users_and_accounts(main_bot, args.users, 1)
+        if args.oauth_state_mode == 'signed': # redirect handler با همان ENCRYPTION_KEY امضا را بررسی می‌کند
+            states = [main_bot.oauth_state_signer.issue(BENCH_USER_ID_BASE + i % args.users, 'google')[0] for i in range(args.callbacks)]
+        else:
+            now = int(time.time())
+            states = [str(uuid.uuid4()) for _ in range(args.callbacks)]
+            for start in range(0, len(states), 1000):
+                chunk = states[start:start + 1000]
+                main_bot.db_execute(
+                    f"INSERT INTO oauth_states (state_uuid, telegram_id, provider, timestamp_created) VALUES {', '.join(['(%s, %s, %s, %s)'] * len(chunk))}",
+                    tuple(value for i, state in enumerate(chunk, start) for value in (state, BENCH_USER_ID_BASE + i % args.users, 'google', now)),
+                    commit=True
+                )
+        callback_url = f"http://127.0.0.1:{server.server_port}/oauth2callback"
+        thread_local = threading.local()
+
+        def callback(state):
+            session = getattr(thread_local, 'session', None)
+            if session is None: session = thread_local.session = requests.Session()
+            started = time.perf_counter()
+            try:
+                failed = session.get(callback_url, params={'state': state, 'code': f'bench-code-{state}'}, timeout=60).status_code != 200
+            except requests.exceptions.RequestException:
+                failed = True
+            recorder.record(time.perf_counter() - started, failed=failed)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="bench_oauth") as executor:
+            list(executor.map(callback, states))
+        return summarize(recorder, time.perf_counter() - started, callbacks=args.callbacks, concurrency=args.concurrency,
+                         oauth_state_mode=args.oauth_state_mode,
+                         db_pool=redirect_handler_app.db_pool_rh.stats(), standins={'google': google.stats()})
+    finally:
+        server.shutdown()
+        oauth_flow.GOOGLE_TOKEN_URL, oauth_flow.GOOGLE_USERINFO_URL = saved_urls
+        google.stop()
+
+
+def bench_db(main_bot, args) -> dict:
+    """خواندن پروفایل کاربر بدون کش (مسیر پرتکرار کنترل‌کننده‌ها) به صورت هم‌زمان برای سنجش db_execute و استخر اتصال."""
+    recorder = LatencyRecorder()
+    reset_bench_database(main_bot)
+    seed_users_and_accounts(main_bot, args.users, 1)
+
+    def read_profile(i):
+        telegram_id = BENCH_USER_ID_BASE + i % args.users
+        started = time.perf_counter()
+        main_bot.invalidate_user_profile(telegram_id)
+        profile = main_bot.get_user_profile(telegram_id)
+        recorder.record(time.perf_counter() - started, failed=profile is None)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="bench_db") as executor:
+        list(executor.map(read_profile, range(args.db_operations)))
+    return summarize(recorder, time.perf_counter() - started, db_operations=args.db_operations,
+                     concurrency=args.concurrency, db_pool=main_bot.db_pool.stats())
+
+
+# --- گزارش و مقایسه ---
+def run_benchmarks(args) -> dict:
+    configure_environment(args)
+    if args.tracemalloc: tracemalloc.start()
+    import main_bot
+    report = {
+        'benchmark': 'mailtotelbot',
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'params': {name: value for name, value in vars(args).items() if name not in ('func', 'output')},
+        'results': {},
+    }
+    workload_functions = {'fetch': bench_fetch, 'buttons': bench_buttons, 'oauth': bench_oauth, 'db': bench_db}
+    for workload in args.workloads:
+        print(f"Running workload '{workload}'...", file=sys.stderr)
+        report['results'][workload] = workload_functions[workload](main_bot, args)
+    main_bot.db_pool.close_all()
+    return report
+
+
+def compare_reports(baseline: dict, candidate: dict, fail_on_regression: float = None) -> int:
+    """چاپ تغییر توان عملیاتی و تأخیر هر بار کاری؛ با fail_on_regression، بدتر شدن p99 یا توان بیش از این درصد کد خروج 1 می‌دهد."""
+    regressions = []
+    print(f"baseline {baseline.get('git_commit')} vs candidate {candidate.get('git_commit')}")
+    for workload, new in candidate['results'].items():
+        old = baseline['results'].get(workload)
+        if old is None:
+            print(f"{workload}: no baseline"); continue
+        rows = [('throughput/s', old['throughput_per_second'], new['throughput_per_second'], True)]
+        rows += [(f'{key} ms', old['latency_ms'][key], new['latency_ms'][key], False) for key in ('p50', 'p99')]
+        rows += [('errors', old['errors'], new['errors'], False), ('peak rss MB', old['peak_rss_mb'], new['peak_rss_mb'], False)]
+        print(f"{workload}:")
+        for label, old_value, new_value, higher_is_better in rows:
+            change = (new_value - old_value) / old_value * 100 if old_value else 0.0
+            print(f"  {label:<14}{old_value:>12}{new_value:>12}{change:>+9.1f}%")
+            worse = -change if higher_is_better else change
+            if fail_on_regression is not None and label in ('throughput/s', 'p99 ms') and worse > fail_on_regression:
+                regressions.append(f"{workload} {label} {change:+.1f}%")
+    if regressions:
+        print("Regressions: " + ', '.join(regressions))
+        return 1
+    return 0
+
+
+def parse_args(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Benchmark mailtotelbot against local Telegram/Google stand-ins.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help="run workloads and write a JSON report")
+    run_parser.add_argument('--workloads', type=lambda value: value.split(','), default=list(WORKLOADS),
+                            help=f"comma-separated subset of {','.join(WORKLOADS)}")
+    run_parser.add_argument('--database', default=f"{os.getenv('MYSQL_DATABASE', 'mailtotelbot')}_bench",
+                            help="throwaway database on the configured MySQL server (must end with _bench)")
+    run_parser.add_argument('--output', help="write the JSON report to this file instead of stdout")
+    run_parser.add_argument('--workers', type=int, default=int(os.getenv('EMAIL_FETCH_WORKERS', 8)))
+    run_parser.add_argument('--pool-size', type=int, default=int(os.getenv('DB_POOL_SIZE', 10)))
+    run_parser.add_argument('--log-level', default='WARNING')
+    run_parser.add_argument('--tracemalloc', action='store_true', help="also report the Python heap peak (slower)")
+    # fetch
+    run_parser.add_argument('--accounts', type=int, default=10000)
+    run_parser.add_argument('--accounts-per-user', type=int, default=1)
+    run_parser.add_argument('--rounds', type=int, default=1)
+    run_parser.add_argument('--new-mail-ratio', type=float, default=0.1)
+    run_parser.add_argument('--messages-per-hit', type=int, default=3)
+    # buttons / oauth / db
+    run_parser.add_argument('--users', type=int, default=1000)
+    run_parser.add_argument('--bursts', type=int, default=20)
+    run_parser.add_argument('--burst-size', type=int, default=100)
+    run_parser.add_argument('--burst-interval-ms', type=float, default=0)
+    run_parser.add_argument('--callbacks', type=int, default=2000)
+    run_parser.add_argument('--oauth-state-mode', choices=('signed', 'db'), default='signed',
+                            help="signed: stateless tokens (no oauth_states rows); db: seed oauth_states rows")
+    run_parser.add_argument('--db-operations', type=int, default=20000)
+    run_parser.add_argument('--concurrency', type=int, default=32)
+    # stand-ins
+    run_parser.add_argument('--google-latency-ms', type=float, default=50)
+    run_parser.add_argument('--google-error-rate', type=float, default=0.0)
+    run_parser.add_argument('--telegram-latency-ms', type=float, default=30)
+    run_parser.add_argument('--telegram-error-rate', type=float, default=0.0)
+
+    compare_parser = subparsers.add_parser('compare', help="compare two JSON reports")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--fail-on-regression', type=float, help="exit with 1 if throughput or p99 is worse by more than this percentage")
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        unknown = set(args.workloads) - set(WORKLOADS)
+        if unknown: parser.error(f"unknown workload(s): {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    if args.command == 'compare':
+        with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+            return compare_reports(json.load(baseline_file), json.load(candidate_file), args.fail_on_regression)
+    report = run_benchmarks(args)
+    report_text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w') as output_file: output_file.write(report_text + '\n')
+        print(f"Report written to {args.output}", file=sys.stderr)
+    else:
+        print(report_text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,249 @@
+# benchmark_standins.py
+# سرورهای HTTP محلی که به جای Telegram Bot API و APIهای گوگل (توکن، userinfo و Gmail) در benchmark.py استفاده می‌شوند.
+# هر سرور تأخیر قابل تنظیم و تزریق خطا (با احتمال error_rate) دارد و تعداد درخواست‌ها را برای گزارش نگه می‌دارد.
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BENCH_BOT_ID = 123456
+
+
+class _StandinHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024 # صف پیش‌فرض (5) در رگبار اتصال‌های هم‌زمان باعث reset شدن اتصال‌ها می‌شود
+
+
+class _StandinServer:
+    """پایه مشترک: اجرای ThreadingHTTPServer در نخ پس‌زمینه و شمارش درخواست‌ها به تفکیک مسیر."""
+
+    def __init__(self, handler_class, latency_ms: float = 0, error_rate: float = 0, seed: int = 1):
+        self.latency_seconds = latency_ms / 1000
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'requests': 0, 'injected_errors': 0, 'by_route': {}}
+        self._server = _StandinHTTPServer(('127.0.0.1', 0), handler_class)
+        self._server.standin = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def random(self) -> float:
+        with self._random_lock: return self._random.random()
+
+    def begin_request(self, route: str, allow_error: bool = True) -> bool:
+        """ثبت درخواست، اعمال تأخیر و تصمیم تزریق خطا؛ True یعنی این درخواست باید با خطا پاسخ داده شود."""
+        inject_error = allow_error and self.error_rate > 0 and self.random() < self.error_rate
+        with self._stats_lock:
+            self._stats['requests'] += 1
+            self._stats['by_route'][route] = self._stats['by_route'].get(route, 0) + 1
+            if inject_error: self._stats['injected_errors'] += 1
+        if self.latency_seconds: time.sleep(self.latency_seconds)
+        return inject_error
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return dict(self._stats, by_route=dict(self._stats['by_route']))
+
+
+class _JsonRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive، مانند سرورهای واقعی
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def send_json(self, status: int, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items(): self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# --- Telegram Bot API ---
+class _TelegramHandler(_JsonRequestHandler):
+    def do_POST(self):
+        standin = self.server.standin
+        method = self.path.rstrip('/').rsplit('/', 1)[-1]
+        raw_body = self.read_body()
+        params = {}
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(raw_body or b'{}')
+        else: # python-telegram-bot پارامترها را به صورت فرم با مقادیر JSON ارسال می‌کند
+            for name, values in parse_qs(raw_body.decode()).items():
+                try: params[name] = json.loads(values[0])
+                except ValueError: params[name] = values[0]
+        if standin.begin_request(method, allow_error=method != 'getMe'): # راه‌اندازی Application نباید با خطای تزریقی شکست بخورد
+            self.send_json(429, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1', 'parameters': {'retry_after': 1}})
+            return
+        self.send_json(200, {'ok': True, 'result': standin.result_for(method, params)})
+
+    do_GET = do_POST
+
+
+class FakeTelegramServer(_StandinServer):
+    """شبیه‌ساز Bot API: getMe، ارسال و ویرایش پیام و answerCallbackQuery؛ بقیه متدها true برمی‌گردانند."""
+
+    def __init__(self, latency_ms: float = 0, error_rate: float = 0, seed: int = 1):
+        super().__init__(_TelegramHandler, latency_ms, error_rate, seed)
+        self._message_ids = iter(range(1, 10 ** 12))
+        self._message_ids_lock = threading.Lock()
+
+    def result_for(self, method: str, params: dict):
+        if method == 'getMe':
+            return {'id': BENCH_BOT_ID, 'is_bot': True, 'first_name': 'bench', 'username': 'bench_bot',
+                    'can_join_groups': False, 'can_read_all_group_messages': False, 'supports_inline_queries': False}
+        if method in ('sendMessage', 'editMessageText'):
+            with self._message_ids_lock: message_id = params.get('message_id') or next(self._message_ids)
+            return {'message_id': message_id, 'date': int(time.time()), 'text': params.get('text', ''),
+                    'chat': {'id': params.get('chat_id', 0), 'type': 'private'},
+                    'from': {'id': BENCH_BOT_ID, 'is_bot': True, 'first_name': 'bench'}}
+        return True
+
+
+# --- Google: OAuth token، userinfo و Gmail ---
+class _GoogleHandler(_JsonRequestHandler):
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, http_method: str):
+        standin = self.server.standin
+        parsed = urlparse(self.path)
+        query = {name: values if len(values) > 1 else values[0] for name, values in parse_qs(parsed.query).items()}
+        access_token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+        body = self.read_body() if http_method == 'POST' else b''
+        route = standin.route_name(parsed.path)
+        if standin.begin_request(route):
+            self.send_json(429 if route.startswith('gmail') else 500, {'error': {'code': 429, 'message': 'injected error'}})
+            return
+        if route == 'gmail.batch':
+            boundary = f"batch_{uuid.uuid4().hex}"
+            payload = standin.batch_response(access_token, body.decode(), boundary).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', f'multipart/mixed; boundary={boundary}')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        status, payload = standin.handle(route, parsed.path, query, access_token, body)
+        self.send_json(status, payload)
+
+
+class FakeGoogleServer(_StandinServer):
+    """شبیه‌ساز endpointهای گوگل که ربات و redirect handler استفاده می‌کنند.
+
+    هر فراخوانی history با احتمال new_mail_ratio تعداد messages_per_hit پیام جدید برمی‌گرداند.
+    """
+
+    def __init__(self, latency_ms: float = 0, error_rate: float = 0, new_mail_ratio: float = 0.1,
+                 messages_per_hit: int = 3, seed: int = 1):
+        super().__init__(_GoogleHandler, latency_ms, error_rate, seed)
+        self.new_mail_ratio = new_mail_ratio
+        self.messages_per_hit = messages_per_hit
+
+    @property
+    def token_url(self) -> str:
+        return f"{self.url}/token"
+
+    @property
+    def userinfo_url(self) -> str:
+        return f"{self.url}/oauth2/v1/userinfo"
+
+    @property
+    def gmail_api_base_url(self) -> str:
+        return f"{self.url}/gmail/v1/users/me"
+
+    @property
+    def gmail_batch_url(self) -> str:
+        return f"{self.url}/batch/gmail/v1"
+
+    @staticmethod
+    def route_name(path: str) -> str:
+        if path == '/token': return 'token'
+        if path.endswith('/userinfo'): return 'userinfo'
+        if path.startswith('/batch/'): return 'gmail.batch'
+        parts = path.removeprefix('/gmail/v1/users/me/').split('/')
+        return 'gmail.' + ('message' if parts[0] == 'messages' and len(parts) > 1 else parts[0])
+
+    def handle(self, route: str, path: str, query: dict, access_token: str, body: bytes):
+        if route == 'token':
+            form = {name: values[0] for name, values in parse_qs(body.decode()).items()}
+            payload = {'access_token': f"bench-at-{uuid.uuid4().hex}", 'expires_in': 3600, 'token_type': 'Bearer'}
+            if form.get('grant_type') == 'authorization_code': payload['refresh_token'] = f"bench-rt-{uuid.uuid4().hex}"
+            return 200, payload
+        if route == 'userinfo':
+            return 200, {'email': f"{access_token.removeprefix('bench-at-')[:16]}@bench.example.com", 'verified_email': True}
+        if route == 'gmail.profile':
+            return 200, {'emailAddress': 'bench@example.com', 'historyId': '1000'}
+        if route == 'gmail.history':
+            start_history_id = int(query.get('startHistoryId', 1000))
+            history = []
+            if self.random() < self.new_mail_ratio:
+                history = [{'id': str(start_history_id + 1), 'messagesAdded': [
+                    {'message': {'id': f"m{start_history_id}x{i}{uuid.uuid4().hex[:8]}", 'labelIds': ['INBOX', 'UNREAD']}}
+                    for i in range(self.messages_per_hit)
+                ]}]
+            return 200, {'history': history, 'historyId': str(start_history_id + 1)}
+        if route == 'gmail.messages':
+            count = int(query.get('maxResults', 10))
+            return 200, {'messages': [{'id': f"r{uuid.uuid4().hex[:12]}"} for _ in range(min(count, 5))]}
+        if route == 'gmail.message':
+            return 200, self.message(path.rsplit('/', 1)[-1])
+        if route == 'gmail.watch':
+            return 200, {'historyId': '1000', 'expiration': str(int((time.time() + 7 * 86400) * 1000))}
+        return 404, {'error': {'code': 404, 'message': f"no stand-in for {path}"}}
+
+    @staticmethod
+    def message(message_id: str) -> dict:
+        return {
+            'id': message_id, 'labelIds': ['INBOX', 'UNREAD'], 'snippet': 'Benchmark message snippet',
+            'payload': {
+                'mimeType': 'text/plain',
+                'headers': [{'name': 'From', 'value': 'sender@bench.example.com'},
+                            {'name': 'Subject', 'value': f'Benchmark {message_id}'},
+                            {'name': 'Date', 'value': time.strftime('%a, %d %b %Y %H:%M:%S +0000', time.gmtime())}],
+                'body': {'data': 'QmVuY2htYXJrIGJvZHkgdGV4dC4='}, # "Benchmark body text."
+            },
+        }
+
+    def batch_response(self, access_token: str, request_body: str, boundary: str) -> str:
+        """پاسخ multipart/mixed برای درخواست batch جیمیل (هر بخش یک GET پیام)."""
+        parts = []
+        for request_part in request_body.split('--batch_')[1:]:
+            content_id, request_line = None, None
+            for line in request_part.replace('\r\n', '\n').split('\n'):
+                if line.lower().startswith('content-id:'): content_id = line.split(':', 1)[1].strip().strip('<>')
+                elif line.startswith('GET '): request_line = line
+            if content_id is None or request_line is None: continue
+            message_id = urlparse(request_line.split()[1]).path.rsplit('/', 1)[-1]
+            parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 200 OK\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n{json.dumps(self.message(message_id))}\r\n"
+            )
+        parts.append(f"--{boundary}--\r\n")
+        return ''.join(parts)
@@ -0,0 +1,168 @@
+# bulk_subscriptions.py
+# اعمال گروهی اشتراک کاربران از فایل CSV یا JSON ارسال شده توسط ادمین (دستور /bulk_subscriptions در main_bot.py).
+# فایل ردیف به ردیف خوانده و اعتبارسنجی می‌شود و ردیف‌های معتبر در دسته‌های chunk_size تایی، هر دسته با یک
+# INSERT ... ON DUPLICATE KEY UPDATE چندردیفی در یک تراکنش، نوشته می‌شوند.
+import csv
+import io
+import itertools
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+
+import admin_stats
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ('telegram_id', 'days', 'max_emails', 'quota')
+# همان معنای /set_subscription: days=0 یعنی بدون تاریخ انقضا، quota=0 یعنی سهمیه نامحدود
+MAX_SUBSCRIPTION_DAYS = 36500
+
+
+def validate_record(record) -> tuple[int, int, int, int]:
+    """(telegram_id، days، max_emails، quota) از یک ردیف (dict یا لیست به ترتیب FIELDS)؛ ردیف نامعتبر ValueError با پیام قابل نمایش به ادمین می‌دهد."""
+    if isinstance(record, dict):
+        missing = [field for field in FIELDS if record.get(field) in (None, '')]
+        if missing: raise ValueError(f"ستون خالی: {', '.join(missing)}")
+        values = [record[field] for field in FIELDS]
+    elif isinstance(record, (list, tuple)):
+        if len(record) < len(FIELDS): raise ValueError(f"{len(FIELDS)} ستون لازم است، {len(record)} ستون داده شده")
+        values = list(record[:len(FIELDS)])
+    else:
+        raise ValueError("ردیف باید شیء یا لیست باشد")
+    try:
+        telegram_id, days, max_emails, quota = (int(str(value).strip()) for value in values)
+    except ValueError:
+        raise ValueError("همه مقادیر باید عدد صحیح باشند")
+    if telegram_id <= 0: raise ValueError("telegram_id باید مثبت باشد")
+    if not 0 <= days <= MAX_SUBSCRIPTION_DAYS: raise ValueError(f"days باید بین 0 و {MAX_SUBSCRIPTION_DAYS} باشد")
+    if max_emails < 0 or quota < 0: raise ValueError("max_emails و quota نباید منفی باشند")
+    return telegram_id, days, max_emails, quota
+
+
+def iter_records(stream, file_name: str):
+    """(شماره ردیف، ردیف خام) از فایل باینری بدون بارگذاری کامل آن (به جز آرایه JSON که یک‌جا parse می‌شود).
+
+    CSV با سطر عنوان (telegram_id,days,max_emails,quota) یا بدون آن؛ JSON به صورت آرایه‌ای از اشیا یا JSON Lines.
+    """
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if file_name.lower().endswith(('.json', '.jsonl')):
+        first_char = text_stream.read(1)
+        while first_char.isspace(): first_char = text_stream.read(1)
+        if first_char == '[':
+            yield from enumerate(json.loads(first_char + text_stream.read()), 1)
+            return
+        for line_number, line in enumerate(itertools.chain([first_char + text_stream.readline()], text_stream), 1):
+            if not line.strip(): continue
+            try: yield line_number, json.loads(line)
+            except ValueError as e: yield line_number, e
+        return
+    reader = csv.reader(text_stream)
+    for row in reader:
+        if not row or not any(cell.strip() for cell in row): continue
+        header = [cell.strip().lower() for cell in row]
+        if set(FIELDS) <= set(header): # سطر عنوان؛ ستون‌ها با نام خوانده می‌شوند
+            for data_row in reader:
+                if any(cell.strip() for cell in data_row): yield reader.line_num, dict(zip(header, data_row))
+            return
+        yield reader.line_num, row
+        for data_row in reader:
+            if any(cell.strip() for cell in data_row): yield reader.line_num, data_row
+        return
+
+
+def _write_chunk(get_connection, chunk: list, now: datetime, admin_ids: set):
+    """upsert یک دسته در یک تراکنش؛ کاربران جدید با مقادیر پیش‌فرض check_and_create_user ساخته می‌شوند.
+
+    شمارنده‌های admin_stats (تعداد کاربران و روزهای انقضا) در همان تراکنش به‌روز می‌شوند.
+    """
+    current_month = now.strftime("%Y-%m")
+    params = []
+    new_expiry_days = {}
+    for telegram_id, days, max_emails, quota in chunk:
+        expiry_timestamp = int((now + timedelta(days=days)).timestamp()) if days > 0 else None
+        new_expiry_days[telegram_id] = admin_stats.expiry_day(expiry_timestamp)
+        params.extend((telegram_id, f"User_{telegram_id}", telegram_id in admin_ids, current_month, expiry_timestamp, max_emails, quota))
+    conn = get_connection()
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"SELECT telegram_id, subscription_expiry_timestamp FROM users WHERE telegram_id IN ({', '.join(['%s'] * len(chunk))}) FOR UPDATE",
+            tuple(new_expiry_days)
+        )
+        old_expiry_days = {telegram_id: admin_stats.expiry_day(expiry) for telegram_id, expiry in cursor.fetchall()}
+        cursor.execute(
+            f"""INSERT INTO users (telegram_id, username, is_admin, last_quota_reset_month, subscription_expiry_timestamp,
+                                   max_allowed_emails, monthly_email_quota, current_month_emails_received)
+                VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s, 0)'] * len(chunk))}
+                ON DUPLICATE KEY UPDATE
+                subscription_expiry_timestamp = VALUES(subscription_expiry_timestamp),
+                max_allowed_emails = VALUES(max_allowed_emails),
+                monthly_email_quota = VALUES(monthly_email_quota)""",
+            tuple(params)
+        )
+        day_deltas = {}
+        for telegram_id, new_day in new_expiry_days.items():
+            old_day = old_expiry_days.get(telegram_id)
+            if old_day == new_day: continue
+            if old_day is not None: day_deltas[old_day] = day_deltas.get(old_day, 0) - 1
+            day_deltas[new_day] = day_deltas.get(new_day, 0) + 1
+        admin_stats.move_subscription_expiry(cursor.execute, day_deltas)
+        admin_stats.add_to_counters(cursor.execute, {admin_stats.USERS_TOTAL: len(new_expiry_days) - len(old_expiry_days)})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if cursor: cursor.close()
+        conn.close()
+
+
+def import_subscriptions(stream, file_name: str, get_connection, admin_ids=(), chunk_size: int = 500, max_reported_errors: int = 20,
+                         on_chunk_applied=None) -> dict:
+    """خواندن، اعتبارسنجی و اعمال دسته‌ای ردیف‌ها؛ گزارش خلاصه (تعداد ردیف‌ها، اعمال شده، نامعتبر، دسته‌های ناموفق و نمونه خطاها).
+
+    اگر یک شناسه چند بار در فایل آمده باشد، آخرین ردیف اعمال می‌شود. on_chunk_applied(telegram_ids) پس از commit هر دسته
+    فراخوانی می‌شود (مثلاً برای پاک کردن کش پروفایل).
+    """
+    now = datetime.now(timezone.utc)
+    admin_ids = set(admin_ids)
+    report = {'rows': 0, 'applied': 0, 'invalid': 0, 'duplicates': 0, 'failed': 0, 'chunks': 0, 'errors': [], 'errors_omitted': 0}
+    pending = {} # telegram_id -> ردیف معتبر دسته فعلی
+
+    def add_error(line_number, message):
+        if len(report['errors']) < max_reported_errors: report['errors'].append(f"{line_number}: {message}")
+        else: report['errors_omitted'] += 1
+
+    def flush_chunk():
+        chunk = list(pending.values())
+        pending.clear()
+        report['chunks'] += 1
+        try:
+            _write_chunk(get_connection, chunk, now, admin_ids)
+        except Exception as e:
+            logger.error(f"Bulk subscription chunk of {len(chunk)} rows failed: {e}")
+            report['failed'] += len(chunk)
+            add_error(f"دسته {report['chunks']}", f"خطای پایگاه داده، {len(chunk)} ردیف اعمال نشد")
+            return
+        report['applied'] += len(chunk)
+        if on_chunk_applied: on_chunk_applied([row[0] for row in chunk])
+
+    try:
+        for line_number, record in iter_records(stream, file_name):
+            report['rows'] += 1
+            try:
+                if isinstance(record, Exception): raise ValueError(f"JSON نامعتبر ({record})")
+                row = validate_record(record)
+            except ValueError as e:
+                report['invalid'] += 1
+                add_error(line_number, str(e))
+                continue
+            if pending.pop(row[0], None) is not None: report['duplicates'] += 1 # ترتیب درج = ترتیب آخرین ظهور
+            pending[row[0]] = row
+            if len(pending) >= chunk_size: flush_chunk()
+    except (ValueError, csv.Error) as e: # فایل خراب (مثلاً آرایه JSON ناقص یا کدگذاری غیر UTF-8)
+        add_error("فایل", f"قابل خواندن نیست: {e}")
+        report['unreadable'] = True
+    if pending: flush_chunk()
+    return report
@@ -0,0 +1,134 @@
+# db_pool.py
+# استخر اتصال مشترک MySQL که هم main_bot.py و هم redirect_handler_app.py از آن استفاده می‌کنند.
+import logging
+import threading
+import time
+from collections import deque
+
+import mysql.connector
+from mysql.connector.errors import PoolError
+
+logger = logging.getLogger(__name__)
+
+
+class PooledConnection:
+    """پوشش یک اتصال استخر؛ close() اتصال را به جای بستن، به استخر بازمی‌گرداند."""
+
+    def __init__(self, pool, raw_conn, created_at):
+        self._pool = pool
+        self._conn = raw_conn
+        self._created_at = created_at
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise PoolError("Connection has already been returned to the pool.")
+        return getattr(self._conn, name)
+
+    def is_connected(self) -> bool:
+        return self._conn is not None and self._conn.is_connected()
+
+    def close(self):
+        if self._conn is None: return
+        conn, self._conn = self._conn, None
+        self._pool._release(conn, self._created_at)
+
+
+class MySQLPool:
+    """استخر محدود اتصال‌ها با بررسی سلامت، حداکثر عمر اتصال و آمار انتظار."""
+
+    def __init__(self, name: str, conn_params: dict, size: int = 10, max_lifetime_seconds: int = 1800,
+                 healthcheck_idle_seconds: int = 30, acquire_timeout_seconds: float = 10):
+        self.name = name
+        self.size = max(1, size)
+        self.max_lifetime_seconds = max_lifetime_seconds
+        self.healthcheck_idle_seconds = healthcheck_idle_seconds
+        self.acquire_timeout_seconds = acquire_timeout_seconds
+        self._conn_params = dict(conn_params)
+        self._slots = threading.BoundedSemaphore(self.size) # سقف اتصال‌های هم‌زمان
+        self._idle = deque() # (conn, created_at, last_used_at)
+        self._lock = threading.Lock()
+        self._stats = {
+            'acquired': 0, 'waits': 0, 'wait_seconds_total': 0.0, 'wait_seconds_max': 0.0,
+            'timeouts': 0, 'created': 0, 'recycled_lifetime': 0, 'discarded_unhealthy': 0,
+        }
+
+    def get_connection(self) -> PooledConnection:
+        """یک اتصال از استخر برمی‌دارد؛ در صورت پر بودن استخر حداکثر acquire_timeout_seconds منتظر می‌ماند."""
+        wait_started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            if not self._slots.acquire(timeout=self.acquire_timeout_seconds):
+                with self._lock: self._stats['timeouts'] += 1
+                raise PoolError(f"Pool '{self.name}' exhausted: no connection available within {self.acquire_timeout_seconds}s.")
+            waited = time.monotonic() - wait_started
+            with self._lock:
+                self._stats['waits'] += 1
+                self._stats['wait_seconds_total'] += waited
+                self._stats['wait_seconds_max'] = max(self._stats['wait_seconds_max'], waited)
+            if waited > 1:
+                logger.warning(f"DB pool '{self.name}' wait took {waited:.2f}s.")
+        try:
+            conn, created_at = self._checkout()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock: self._stats['acquired'] += 1
+        return PooledConnection(self, conn, created_at)
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                entry = self._idle.pop() if self._idle else None # LIFO: اتصال‌های گرم‌تر اول استفاده می‌شوند
+            if entry is None:
+                break
+            conn, created_at, last_used_at = entry
+            now = time.monotonic()
+            if now - created_at > self.max_lifetime_seconds:
+                self._discard(conn, 'recycled_lifetime')
+                continue
+            if now - last_used_at > self.healthcheck_idle_seconds:
+                try:
+                    conn.ping(reconnect=False)
+                except mysql.connector.Error as err:
+                    logger.info(f"DB pool '{self.name}': dropping unhealthy idle connection: {err}")
+                    self._discard(conn, 'discarded_unhealthy')
+                    continue
+            return conn, created_at
+        conn = mysql.connector.connect(**self._conn_params)
+        with self._lock: self._stats['created'] += 1
+        return conn, time.monotonic()
+
+    def _release(self, conn, created_at):
+        try:
+            if not conn.is_connected():
+                self._discard(conn, 'discarded_unhealthy'); return
+            # پایان تراکنش باز (حتی برای SELECT) تا اتصال بعدی snapshot قدیمی نبیند
+            conn.rollback()
+            if time.monotonic() - created_at > self.max_lifetime_seconds:
+                self._discard(conn, 'recycled_lifetime'); return
+            with self._lock:
+                self._idle.append((conn, created_at, time.monotonic()))
+        except mysql.connector.Error:
+            self._discard(conn, 'discarded_unhealthy')
+        finally:
+            self._slots.release()
+
+    def _discard(self, conn, reason: str):
+        with self._lock: self._stats[reason] += 1
+        try: conn.close()
+        except Exception: pass
+
+    def stats(self) -> dict:
+        """آمار فعلی استخر (برای لاگ و متریک‌ها)."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        stats['size'] = self.size
+        return stats
+
+    def close_all(self):
+        """بستن همه اتصال‌های بیکار (مثلاً هنگام خاموش شدن)."""
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn, _, _ in idle:
+            try: conn.close()
+            except Exception: pass
@@ -0,0 +1,166 @@
+# email_digest.py
+# حالت ارسال «خلاصه» برای هر حساب متصل: به جای یک پیام تلگرام برای هر ایمیل، پیام‌های جدید در digest_items جمع
+# و پس از پنجره زمانی در یک پیام صفحه‌بندی شده (email_digests) با دکمه باز کردن هر ایمیل ارسال می‌شوند.
+# پردازه‌های واکشی فقط سرآیندها را ذخیره می‌کنند؛ متن کامل هر ایمیل تنها وقتی کاربر آن را باز کند از ارائه‌دهنده گرفته می‌شود.
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+DELIVERY_IMMEDIATE = 'immediate'
+DELIVERY_DIGEST = 'digest'
+
+TELEGRAM_MESSAGE_MAX_CHARS = 4096
+SENDER_MAX_CHARS = 255
+SUBJECT_MAX_CHARS = 500
+SNIPPET_MAX_CHARS = 1000
+LIST_LINE_MAX_CHARS = 80 # طول سرآیندها در فهرست هر صفحه
+OPEN_BUTTONS_PER_ROW = 4
+
+
+class DigestStoreError(Exception):
+    """پیام‌های خلاصه در digest_items ذخیره نشدند؛ فراخوانی‌کننده نباید آن‌ها را ارسال شده حساب کند."""
+
+
+def _shorten(text: str, max_chars: int) -> str:
+    text = (text or '').strip()
+    return text if len(text) <= max_chars else text[:max_chars - 1] + "…"
+
+
+def store_items(db_execute, user_telegram_id: int, account_id: int, email_address: str, messages: list, created_at: int) -> int:
+    """ذخیره پیام‌های جدید یک حساب برای خلاصه بعدی با یک INSERT چندردیفی؛ تعداد ردیف‌های ذخیره شده را برمی‌گرداند.
+
+    messages: فهرست dict با کلیدهای message_id، sender، subject و snippet. اگر همه ردیف‌ها ذخیره نشوند
+    (db_execute خطا را فقط ثبت می‌کند و صفر برمی‌گرداند) DigestStoreError داده می‌شود.
+    """
+    if not messages: return 0
+    params = []
+    for message in messages:
+        params.extend((user_telegram_id, account_id, email_address, message['message_id'],
+                       _shorten(message.get('sender'), SENDER_MAX_CHARS), _shorten(message.get('subject'), SUBJECT_MAX_CHARS),
+                       _shorten(message.get('snippet'), SNIPPET_MAX_CHARS), created_at))
+    stored = db_execute(
+        f"""INSERT INTO digest_items (user_telegram_id, account_id, email_address, gmail_message_id, sender, subject, snippet, created_at)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s, %s)'] * len(messages))}""",
+        tuple(params), commit=True, row_count=True
+    )
+    if stored < len(messages):
+        raise DigestStoreError(f"stored {stored} of {len(messages)} digest item(s) for user {user_telegram_id}")
+    return stored
+
+
+def due_user_ids(db_execute, window_seconds: int, now_timestamp: int, limit: int = 100) -> list:
+    """کاربرانی که قدیمی‌ترین پیام منتظر خلاصه‌شان از پنجره خلاصه گذشته است."""
+    rows = db_execute(
+        """SELECT user_telegram_id FROM digest_items WHERE digest_id IS NULL
+           GROUP BY user_telegram_id HAVING MIN(created_at) <= %s LIMIT %s""",
+        (now_timestamp - window_seconds, limit), fetchall=True
+    ) or []
+    return [row['user_telegram_id'] for row in rows]
+
+
+def create_digest(get_connection, user_telegram_id: int, now_timestamp: int) -> int | None:
+    """بستن همه پیام‌های منتظر کاربر در یک خلاصه جدید (یک تراکنش)؛ شناسه خلاصه یا None اگر پیامی نمانده باشد."""
+    conn = get_connection()
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO email_digests (user_telegram_id, created_at) VALUES (%s, %s)", (user_telegram_id, now_timestamp))
+        digest_id = cursor.lastrowid
+        cursor.execute(
+            "UPDATE digest_items SET digest_id = %s WHERE digest_id IS NULL AND user_telegram_id = %s",
+            (digest_id, user_telegram_id)
+        )
+        item_count = cursor.rowcount
+        if not item_count:
+            conn.rollback(); return None
+        cursor.execute("UPDATE email_digests SET item_count = %s WHERE id = %s", (item_count, digest_id))
+        conn.commit()
+        return digest_id
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if cursor: cursor.close()
+        conn.close()
+
+
+def unsent_digests(db_execute, limit: int = 100) -> list:
+    return db_execute(
+        "SELECT id, user_telegram_id, item_count FROM email_digests WHERE sent_at IS NULL ORDER BY id LIMIT %s",
+        (limit,), fetchall=True
+    ) or []
+
+
+def mark_sent(db_execute, digest_id: int, sent_at: int):
+    db_execute("UPDATE email_digests SET sent_at = %s WHERE id = %s", (sent_at, digest_id), commit=True)
+
+
+def load_page(db_execute, digest_id: int, user_telegram_id: int, page: int, page_size: int):
+    """(ردیف خلاصه، پیام‌های صفحه) برای کاربر مالک خلاصه؛ None اگر خلاصه وجود نداشته یا متعلق به کاربر نباشد."""
+    digest_row = db_execute(
+        "SELECT id, item_count, created_at FROM email_digests WHERE id = %s AND user_telegram_id = %s",
+        (digest_id, user_telegram_id), fetchone=True
+    )
+    if not digest_row: return None
+    last_page = max(0, (digest_row['item_count'] - 1) // page_size)
+    page = min(max(0, page), last_page)
+    items = db_execute(
+        """SELECT id, email_address, sender, subject FROM digest_items
+           WHERE digest_id = %s AND user_telegram_id = %s ORDER BY created_at, id LIMIT %s OFFSET %s""",
+        (digest_id, user_telegram_id, page_size, page * page_size), fetchall=True
+    ) or []
+    return digest_row, items, page
+
+
+def load_item(db_execute, item_id: int, user_telegram_id: int) -> dict | None:
+    return db_execute(
+        """SELECT id, digest_id, account_id, email_address, gmail_message_id, sender, subject, snippet
+           FROM digest_items WHERE id = %s AND user_telegram_id = %s AND digest_id IS NOT NULL""",
+        (item_id, user_telegram_id), fetchone=True
+    )
+
+
+def purge_old_digests(db_execute, created_before: int, batch_size: int = 500) -> int:
+    """حذف خلاصه‌های قدیمی‌تر از created_before و پیام‌هایشان؛ تعداد خلاصه‌های حذف شده."""
+    rows = db_execute(
+        "SELECT id FROM email_digests WHERE created_at < %s ORDER BY id LIMIT %s", (created_before, batch_size), fetchall=True
+    ) or []
+    if not rows: return 0
+    digest_ids = tuple(row['id'] for row in rows)
+    placeholders = ', '.join(['%s'] * len(digest_ids))
+    db_execute(f"DELETE FROM digest_items WHERE digest_id IN ({placeholders})", digest_ids, commit=True)
+    db_execute(f"DELETE FROM email_digests WHERE id IN ({placeholders})", digest_ids, commit=True)
+    return len(digest_ids)
+
+
+# --- نمایش ---
+def render_page(digest_row: dict, items: list, page: int, page_size: int):
+    """(متن، کیبورد) یک صفحه از خلاصه: فهرست فرستنده/موضوع، دکمه باز کردن هر ایمیل و پیمایش صفحه‌ها."""
+    page_count = max(1, -(-digest_row['item_count'] // page_size))
+    lines = [f"🗂 خلاصه ایمیل‌ها: {digest_row['item_count']} ایمیل جدید (صفحه {page + 1} از {page_count})"]
+    open_buttons = []
+    for number, item in enumerate(items, page * page_size + 1):
+        lines.append(
+            f"\n{number}. {_shorten(item['subject'], LIST_LINE_MAX_CHARS) or '(بدون موضوع)'}\n"
+            f"    از: {_shorten(item['sender'], LIST_LINE_MAX_CHARS) or '-'}\n"
+            f"    📧 {item['email_address']}"
+        )
+        open_buttons.append(InlineKeyboardButton(f"📖 {number}", callback_data=f"digest_open_{item['id']}_{page}"))
+    keyboard = [open_buttons[i:i + OPEN_BUTTONS_PER_ROW] for i in range(0, len(open_buttons), OPEN_BUTTONS_PER_ROW)]
+    if page_count > 1:
+        navigation = []
+        if page > 0: navigation.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"digest_page_{digest_row['id']}_{page - 1}"))
+        navigation.append(InlineKeyboardButton(f"{page + 1}/{page_count}", callback_data="noop_digest"))
+        if page < page_count - 1: navigation.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"digest_page_{digest_row['id']}_{page + 1}"))
+        keyboard.append(navigation)
+    return "\n".join(lines)[:TELEGRAM_MESSAGE_MAX_CHARS], InlineKeyboardMarkup(keyboard)
+
+
+def render_item(item: dict, body_text: str | None, page: int, body_max_chars: int):
+    """(متن، کیبورد) یک ایمیل باز شده؛ اگر متن کامل در دسترس نباشد snippet ذخیره شده نمایش داده می‌شود."""
+    header = (f"📧 {item['email_address']}\n"
+              f"از: {item['sender'] or '-'}\n"
+              f"موضوع: {item['subject'] or '(بدون موضوع)'}\n\n")
+    body = (body_text or '').strip() or (item['snippet'] or '')
+    if body_text is None: body += "\n\n(متن کامل در دسترس نیست؛ خلاصه کوتاه نمایش داده شد.)"
+    body = _shorten(body, max(0, min(body_max_chars, TELEGRAM_MESSAGE_MAX_CHARS - len(header))))
+    keyboard = [[InlineKeyboardButton("⬅️ بازگشت به خلاصه", callback_data=f"digest_page_{item['digest_id']}_{page}")]]
+    return header + body, InlineKeyboardMarkup(keyboard)
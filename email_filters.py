@@ -0,0 +1,125 @@
+# email_filters.py
+# قوانین فیلتر هر حساب متصل (فرستنده، کلمات موضوع، برچسب و اندازه) که از منوی حساب در ربات مدیریت می‌شوند.
+# قوانین به صورت JSON در ستون connected_oauth_emails.filter_rules ذخیره و یک بار به MessageFilter کامپایل می‌شوند:
+#   gmail_query: همان قوانین در زبان جستجوی Gmail تا پیام‌های ناخواسته اصلاً دریافت و از سهمیه کم نشوند
+#   matches(): بررسی محلی روی سرآیندهای metadata، برای مسیرهایی که جستجوی سمت سرور در دسترس نیست یا شکست خورده است
+# قوانین هم‌نوع با «یا» و انواع مختلف با «و» ترکیب می‌شوند؛ not_from هر فرستنده را جداگانه حذف می‌کند.
+import json
+import re
+
+from ttl_cache import TTLCache
+
+MAX_RULES_PER_ACCOUNT = 20
+MAX_RULE_VALUE_CHARS = 100
+
+# نوع قانون -> (پیشوند قابل قبول در پیام کاربر، توضیح فارسی)
+RULE_KINDS = {
+    'from': ("from", "فرستنده شامل"),
+    'not_from': ("-from", "فرستنده نباشد"),
+    'subject': ("subject", "موضوع شامل"),
+    'label': ("label", "برچسب"),
+    'larger': ("larger", "بزرگ‌تر از"),
+    'smaller': ("smaller", "کوچک‌تر از"),
+}
+_KIND_BY_PREFIX = {prefix: kind for kind, (prefix, _) in RULE_KINDS.items()}
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 * 1024}
+_SIZE_PATTERN = re.compile(r'^(\d+)\s*([KM]?)B?$', re.IGNORECASE)
+_UNSAFE_QUERY_CHARS = re.compile(r'["{}()]') # کاراکترهایی که ساختار جستجوی Gmail را تغییر می‌دهند
+
+# برچسب‌های سیستمی که در labelIds پیام با همین نام می‌آیند؛ برچسب‌های کاربر فقط در جستجوی سمت سرور قابل بررسی‌اند
+SYSTEM_LABELS = {'INBOX', 'IMPORTANT', 'STARRED', 'UNREAD', 'CATEGORY_PERSONAL', 'CATEGORY_SOCIAL',
+                 'CATEGORY_PROMOTIONS', 'CATEGORY_UPDATES', 'CATEGORY_FORUMS'}
+
+
+def parse_size(text: str) -> int:
+    match = _SIZE_PATTERN.match(text.strip())
+    if not match: raise ValueError("اندازه باید عدد با واحد اختیاری K یا M باشد (مثلاً 500K یا 2M)")
+    return int(match.group(1)) * _SIZE_UNITS[match.group(2).upper()]
+
+
+def format_size(size_bytes: int) -> str:
+    for unit in ('M', 'K'):
+        if size_bytes >= _SIZE_UNITS[unit] and size_bytes % _SIZE_UNITS[unit] == 0: return f"{size_bytes // _SIZE_UNITS[unit]}{unit}"
+    return str(size_bytes)
+
+
+def parse_rule(text: str) -> dict:
+    """تبدیل متن کاربر (مثلاً «from: boss@example.com» یا «larger: 2M») به قانون؛ متن نامعتبر ValueError با پیام قابل نمایش."""
+    prefix, separator, value = text.partition(':')
+    kind = _KIND_BY_PREFIX.get(prefix.strip().lower())
+    if not separator or kind is None:
+        raise ValueError("قالب قانون: نوع: مقدار — انواع مجاز: " + "، ".join(prefix for prefix, _ in RULE_KINDS.values()))
+    value = _UNSAFE_QUERY_CHARS.sub('', value).strip()
+    if not value: raise ValueError("مقدار قانون خالی است")
+    if len(value) > MAX_RULE_VALUE_CHARS: raise ValueError(f"مقدار قانون حداکثر {MAX_RULE_VALUE_CHARS} کاراکتر است")
+    if kind in ('larger', 'smaller'): return {'kind': kind, 'value': parse_size(value)}
+    if kind == 'label': value = value.replace(' ', '-')
+    return {'kind': kind, 'value': value.lower()}
+
+
+def describe_rule(rule: dict) -> str:
+    value = format_size(rule['value']) if rule['kind'] in ('larger', 'smaller') else rule['value']
+    return f"{RULE_KINDS[rule['kind']][1]}: {value}"
+
+
+def load_rules(rules_json: str | None) -> list:
+    return json.loads(rules_json) if rules_json else []
+
+
+def dump_rules(rules: list) -> str | None:
+    return json.dumps(rules, ensure_ascii=False) if rules else None
+
+
+class MessageFilter:
+    """قوانین کامپایل شده یک حساب: عبارت جستجوی Gmail و matcher محلی با regexهای از پیش ساخته شده."""
+
+    def __init__(self, rules: list):
+        values = {kind: [rule['value'] for rule in rules if rule['kind'] == kind] for kind in RULE_KINDS}
+        self._from = self._substring_pattern(values['from'])
+        self._not_from = self._substring_pattern(values['not_from'])
+        self._subject = self._substring_pattern(values['subject'])
+        self._labels = {label.upper() for label in values['label']}
+        self._labels_checkable = self._labels <= SYSTEM_LABELS
+        self._min_size = max(values['larger']) if values['larger'] else None
+        self._max_size = min(values['smaller']) if values['smaller'] else None
+        self.gmail_query = self._build_gmail_query(values)
+
+    @staticmethod
+    def _substring_pattern(words: list):
+        return re.compile('|'.join(re.escape(word) for word in words), re.IGNORECASE) if words else None
+
+    @staticmethod
+    def _build_gmail_query(values: dict) -> str:
+        def any_of(operator, words):
+            terms = [f'{operator}:"{word}"' for word in words]
+            return terms[0] if len(terms) == 1 else "{" + " ".join(terms) + "}"
+        parts = [any_of(operator, values[kind]) for kind, operator in (('from', 'from'), ('subject', 'subject'), ('label', 'label')) if values[kind]]
+        parts.extend(f'-from:"{sender}"' for sender in values['not_from'])
+        if values['larger']: parts.append(f"larger:{max(values['larger'])}")
+        if values['smaller']: parts.append(f"smaller:{min(values['smaller'])}")
+        return " ".join(parts)
+
+    def matches(self, message: dict, sender: str, subject: str) -> bool:
+        """بررسی محلی یک پیام قالب metadata؛ برچسب‌های کاربر (غیر سیستمی) در این مسیر قابل بررسی نیستند و رد نمی‌شوند."""
+        if self._from and not self._from.search(sender or ''): return False
+        if self._not_from and self._not_from.search(sender or ''): return False
+        if self._subject and not self._subject.search(subject or ''): return False
+        if self._labels and self._labels_checkable and not self._labels & set(message.get('labelIds', [])): return False
+        size = message.get('sizeEstimate')
+        if size is not None:
+            if self._min_size is not None and size <= self._min_size: return False
+            if self._max_size is not None and size >= self._max_size: return False
+        return True
+
+
+_compiled_filters = TTLCache(maxsize=4096, ttl_seconds=3600) # متن filter_rules -> MessageFilter
+
+
+def compile_rules(rules_json: str | None) -> MessageFilter | None:
+    """MessageFilter برای مقدار ستون filter_rules (کش شده بر اساس همان متن)؛ None یعنی حساب فیلتری ندارد."""
+    if not rules_json: return None
+    message_filter = _compiled_filters.get(rules_json)
+    if message_filter is None:
+        message_filter = MessageFilter(load_rules(rules_json))
+        _compiled_filters.set(rules_json, message_filter)
+    return message_filter
@@ -0,0 +1,37 @@
+# fetch_worker.py
+# پردازه مستقل واکشی ایمیل که می‌توان چند نمونه از آن را روی یک یا چند سرور اجرا کرد.
+# هر نمونه بخشی از حساب‌های connected_oauth_emails را از طریق lease در اختیار می‌گیرد و پیام‌ها را
+# در telegram_outbox می‌گذارد تا ربات (main_bot.py) آن‌ها را ارسال کند. اگر نمونه‌ای متوقف شود،
+# leaseهای آن پس از FETCH_LEASE_TTL_SECONDS منقضی و بین نمونه‌های دیگر تقسیم می‌شوند.
+#
+# اجرا: python fetch_worker.py  (برای اجرای واکشی فقط در این پردازه‌ها، در ربات ENABLE_EMAIL_FETCHING="false" قرار دهید)
+import logging
+import signal
+import threading
+
+import main_bot
+
+logger = logging.getLogger(__name__)
+
+
+def run_worker():
+    """راه‌اندازی نخ‌های واکشی و انتظار تا دریافت SIGTERM/SIGINT؛ سپس leaseها آزاد می‌شوند."""
+    main_bot.init_db_main()
+    stop_event = threading.Event()
+
+    def handle_stop_signal(signum, frame):
+        logger.info(f"Received signal {signum}; stopping fetch worker.")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, handle_stop_signal)
+    signal.signal(signal.SIGINT, handle_stop_signal)
+    main_bot.start_email_fetching()
+    if main_bot.METRICS_PORT: main_bot.metrics.start_metrics_server(main_bot.METRICS_PORT, main_bot.METRICS_BIND_HOST)
+    logger.info(f"Fetch worker {main_bot.FETCH_WORKER_ID} started.")
+    stop_event.wait()
+    main_bot.release_account_leases()
+    main_bot.db_pool.close_all()
+
+
+if __name__ == '__main__':
+    run_worker()
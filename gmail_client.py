@@ -0,0 +1,234 @@
+# gmail_client.py
+# فراخوانی‌های REST مورد نیاز ربات به Gmail API (بدون وابستگی به google-api-python-client).
+import json
+import logging
+import threading
+import time
+import uuid
+from urllib.parse import urlencode
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+GMAIL_API_BASE_URL = "https://gmail.googleapis.com/gmail/v1/users/me"
+GMAIL_BATCH_URL = "https://gmail.googleapis.com/batch/gmail/v1"
+GMAIL_BATCH_MAX_SIZE = 100 # سقف گوگل برای تعداد درخواست در هر batch
+GMAIL_REQUEST_TIMEOUT_SECONDS = 15
+
+# یک Session مشترک تا اتصال‌های HTTPS به گوگل بین درخواست‌ها باز بمانند (keep-alive)
+http_session = requests.Session()
+
+
+# آمار تأخیر درخواست‌های batch (برای لاگ و متریک‌ها)
+batch_stats = {'batches': 0, 'messages': 0, 'failed_items': 0, 'seconds_total': 0.0, 'seconds_max': 0.0}
+batch_stats_lock = threading.Lock()
+
+
+class GmailHistoryExpiredError(Exception):
+    """historyId ذخیره شده دیگر توسط گوگل نگهداری نمی‌شود و باید همگام‌سازی کامل انجام شود."""
+
+
+def _gmail_get(access_token: str, path: str, params=None) -> dict:
+    response = http_session.get(
+        f"{GMAIL_API_BASE_URL}/{path}", params=params,
+        headers={'Authorization': f'Bearer {access_token}'}, timeout=GMAIL_REQUEST_TIMEOUT_SECONDS
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def _gmail_post(access_token: str, path: str, payload: dict) -> dict:
+    response = http_session.post(
+        f"{GMAIL_API_BASE_URL}/{path}", json=payload,
+        headers={'Authorization': f'Bearer {access_token}'}, timeout=GMAIL_REQUEST_TIMEOUT_SECONDS
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def get_profile(access_token: str) -> dict:
+    """پروفایل صندوق (شامل emailAddress و historyId فعلی)."""
+    return _gmail_get(access_token, "profile")
+
+
+def list_history_message_ids(access_token: str, start_history_id: str, label_id: str = "INBOX", max_pages: int = 10):
+    """شناسه پیام‌های اضافه شده پس از start_history_id را (به ترتیب قدیمی به جدید) و آخرین historyId را برمی‌گرداند.
+
+    اگر فهرست پس از max_pages صفحه ناتمام بماند، historyId آخرین رکورد خوانده شده برگردانده می‌شود تا همگام‌سازی بعدی
+    از همان نقطه ادامه یابد (historyId فعلی صندوق صفحه‌های خوانده نشده را رد می‌کرد).
+    """
+    message_ids, seen = [], set()
+    latest_history_id = last_record_history_id = start_history_id
+    page_token = None
+    for _ in range(max_pages):
+        params = {'startHistoryId': start_history_id, 'historyTypes': 'messageAdded', 'labelId': label_id}
+        if page_token: params['pageToken'] = page_token
+        try:
+            data = _gmail_get(access_token, "history", params)
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                raise GmailHistoryExpiredError(f"historyId {start_history_id} is no longer available") from e
+            raise
+        for history_record in data.get('history', []):
+            last_record_history_id = history_record.get('id', last_record_history_id)
+            for added in history_record.get('messagesAdded', []):
+                message = added.get('message', {})
+                message_id = message.get('id')
+                if not message_id or message_id in seen: continue
+                if label_id and label_id not in message.get('labelIds', [label_id]): continue
+                seen.add(message_id)
+                message_ids.append(message_id)
+        latest_history_id = data.get('historyId', latest_history_id)
+        page_token = data.get('nextPageToken')
+        if not page_token: break
+    else:
+        logger.warning(f"History listing from {start_history_id} truncated after {max_pages} pages; "
+                       f"continuing from {last_record_history_id} next time.")
+        return message_ids, last_record_history_id
+    return message_ids, latest_history_id
+
+
+def skip_forwarded_message_ids(message_ids: list, forwarded_through: str | None) -> list:
+    """حذف پیام‌ها تا forwarded_through (شامل آن)؛ فهرست همان marker در هر دور همان ترتیب را دارد و فقط پیام‌های جدید به انتهایش اضافه می‌شوند."""
+    if not forwarded_through or forwarded_through not in message_ids: return message_ids
+    return message_ids[message_ids.index(forwarded_through) + 1:]
+
+
+def list_message_ids(access_token: str, query: str, max_results: int) -> list:
+    """شناسه پیام‌های منطبق با query (حداکثر max_results، به ترتیب قدیمی به جدید)."""
+    message_ids, page_token = [], None
+    while len(message_ids) < max_results:
+        params = {'q': query, 'maxResults': min(500, max_results - len(message_ids))}
+        if page_token: params['pageToken'] = page_token
+        data = _gmail_get(access_token, "messages", params)
+        message_ids.extend(m['id'] for m in data.get('messages', []))
+        page_token = data.get('nextPageToken')
+        if not page_token: break
+    return list(reversed(message_ids[:max_results])) # Gmail جدیدترین‌ها را اول برمی‌گرداند
+
+
+def iter_message_id_pages(access_token: str, query: str, page_size: int = 500):
+    """(شناسه‌های یک صفحه، وجود صفحه بعد) برای پیام‌های منطبق با query (جدیدترین‌ها اول)؛ صفحه بعد فقط وقتی خواسته شود دریافت می‌شود."""
+    page_token = None
+    while True:
+        params = {'q': query, 'maxResults': min(500, page_size)}
+        if page_token: params['pageToken'] = page_token
+        data = _gmail_get(access_token, "messages", params)
+        page_token = data.get('nextPageToken')
+        yield [m['id'] for m in data.get('messages', [])], bool(page_token)
+        if not page_token: return
+
+
+def get_message(access_token: str, message_id: str, message_format: str = "metadata", metadata_headers=("From", "Subject", "Date")) -> dict:
+    """دریافت یک پیام؛ در قالب metadata فقط سرآیندهای خواسته شده و snippet برگردانده می‌شوند."""
+    params = {'format': message_format}
+    if message_format == "metadata":
+        params['metadataHeaders'] = list(metadata_headers)
+    return _gmail_get(access_token, f"messages/{message_id}", params)
+
+
+def iter_attachment_chunks(access_token: str, message_id: str, attachment_id: str, chunk_bytes: int = 64 * 1024):
+    """پاسخ خام attachments.get (JSON با فیلد data به صورت base64url) تکه به تکه؛ با بستن generator اتصال هم آزاد می‌شود.
+
+    رمزگشایی جریانی در mime_pipeline.iter_json_base64_field انجام می‌شود تا پیوست بزرگ کامل در حافظه نباشد.
+    """
+    with http_session.get(
+        f"{GMAIL_API_BASE_URL}/messages/{message_id}/attachments/{attachment_id}",
+        headers={'Authorization': f'Bearer {access_token}'}, timeout=GMAIL_REQUEST_TIMEOUT_SECONDS, stream=True
+    ) as response:
+        response.raise_for_status()
+        yield from response.iter_content(chunk_size=chunk_bytes)
+
+
+def get_header(message: dict, header_name: str) -> str:
+    """مقدار یک سرآیند از payload پیام (بدون حساسیت به حروف بزرگ و کوچک)."""
+    for header in message.get('payload', {}).get('headers', []):
+        if header.get('name', '').lower() == header_name.lower():
+            return header.get('value', '')
+    return ''
+
+
+def watch_mailbox(access_token: str, topic_name: str, label_ids=("INBOX",)) -> dict:
+    """ثبت یا تمدید watch صندوق روی topic مربوط به Pub/Sub؛ historyId و expiration (میلی‌ثانیه) را برمی‌گرداند."""
+    return _gmail_post(access_token, "watch", {
+        'topicName': topic_name, 'labelIds': list(label_ids), 'labelFilterBehavior': 'INCLUDE'
+    })
+
+
+def _message_request_path(message_id: str, message_format: str, metadata_headers) -> str:
+    params = [('format', message_format)]
+    if message_format == "metadata":
+        params.extend(('metadataHeaders', header) for header in metadata_headers)
+    return f"/gmail/v1/users/me/messages/{message_id}?{urlencode(params)}"
+
+
+def _parse_batch_response(response) -> dict:
+    """پاسخ multipart/mixed یک batch را به نگاشت Content-ID -> (کد وضعیت، بدنه JSON) تبدیل می‌کند."""
+    content_type = response.headers.get('Content-Type', '')
+    boundary = content_type.split('boundary=')[-1].strip().strip('"')
+    results = {}
+    for part in response.text.replace('\r\n', '\n').split(f"--{boundary}"):
+        part = part.strip()
+        if not part or part == '--': continue
+        part_headers, _, http_response = part.partition('\n\n')
+        content_id = None
+        for line in part_headers.split('\n'):
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-id':
+                content_id = value.strip().strip('<>').removeprefix('response-')
+        status_line, _, http_rest = http_response.partition('\n')
+        _, _, body = http_rest.partition('\n\n')
+        try:
+            status_code = int(status_line.split()[1])
+            results[content_id] = (status_code, json.loads(body) if body.strip() else {})
+        except (IndexError, ValueError):
+            results[content_id] = (0, {})
+    return results
+
+
+def batch_get_messages(access_token: str, message_ids: list, message_format: str = "metadata",
+                       metadata_headers=("From", "Subject", "Date"), batch_size: int = 50) -> dict:
+    """دریافت گروهی پیام‌ها با endpoint batch جیمیل؛ نگاشت message_id -> پیام را برمی‌گرداند.
+
+    آیتم‌های ناموفق داخل batch (مثلاً 429) یک بار به صورت تکی دوباره درخواست می‌شوند.
+    """
+    batch_size = max(1, min(batch_size, GMAIL_BATCH_MAX_SIZE))
+    messages, failed_ids = {}, []
+    for offset in range(0, len(message_ids), batch_size):
+        chunk = message_ids[offset:offset + batch_size]
+        boundary = f"batch_{uuid.uuid4().hex}"
+        body_parts = []
+        for index, message_id in enumerate(chunk):
+            body_parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <{index}>\r\n\r\n"
+                f"GET {_message_request_path(message_id, message_format, metadata_headers)}\r\n\r\n"
+            )
+        body_parts.append(f"--{boundary}--\r\n")
+        started = time.monotonic()
+        response = http_session.post(
+            GMAIL_BATCH_URL, data=''.join(body_parts).encode(),
+            headers={'Authorization': f'Bearer {access_token}', 'Content-Type': f'multipart/mixed; boundary={boundary}'},
+            timeout=GMAIL_REQUEST_TIMEOUT_SECONDS * 2
+        )
+        response.raise_for_status()
+        results = _parse_batch_response(response)
+        elapsed = time.monotonic() - started
+        chunk_failures = 0
+        for index, message_id in enumerate(chunk):
+            status_code, message = results.get(str(index), (0, {}))
+            if status_code == 200: messages[message_id] = message
+            else: failed_ids.append(message_id); chunk_failures += 1
+        with batch_stats_lock:
+            batch_stats['batches'] += 1
+            batch_stats['messages'] += len(chunk)
+            batch_stats['failed_items'] += chunk_failures
+            batch_stats['seconds_total'] += elapsed
+            batch_stats['seconds_max'] = max(batch_stats['seconds_max'], elapsed)
+        logger.debug(f"Gmail batch of {len(chunk)} message(s) ({message_format}) took {elapsed:.3f}s, {chunk_failures} failed.")
+    for message_id in failed_ids:
+        try:
+            messages[message_id] = get_message(access_token, message_id, message_format, metadata_headers)
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"Could not fetch message {message_id} after batch failure: {e}")
+    return messages
@@ -0,0 +1,14 @@
+# gunicorn.conf.py
+# تنظیمات Gunicorn برای redirect_handler_app.py (از همین پوشه به صورت خودکار خوانده می‌شود):
+#   gunicorn redirect_handler_app:app
+# worker پیش‌فرض gevent است: هر درخواست یک greenlet است و انتظار برای گوگل یا MySQL فقط همان greenlet را متوقف می‌کند،
+# بنابراین یک فرآیند صدها تکمیل OAuth هم‌زمان را پاسخ می‌دهد. برای worker همگام قبلی GUNICORN_WORKER_CLASS="sync" قرار دهید.
+# از --preload استفاده نکنید تا gevent پیش از import شدن برنامه socketها را وصله کند.
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000)) # حداکثر درخواست هم‌زمان هر worker در gevent
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+keepalive = 5
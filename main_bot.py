@@ -9,18 +9,44 @@ from datetime import datetime, timedelta, timezone
 from urllib.parse import urlencode
 import threading
 import time
+import heapq
+import socket
+import random
+import asyncio
+import functools
+import tempfile
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_for_futures
 
 from cryptography.fernet import Fernet
 
 import requests # برای بازآوری توکن توسط ربات
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ForceReply
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+from telegram.warnings import PTBUserWarning
 from telegram.ext import (
     Application, CommandHandler, MessageHandler,
     filters, CallbackContext, ConversationHandler, CallbackQueryHandler
 )
 from dotenv import load_dotenv
 
+from db_pool import MySQLPool
+import gmail_client
+import metrics
+import oauth_flow
+import schema_migrations
+import admin_stats
+import bulk_subscriptions
+import email_digest
+import email_filters
+import mime_pipeline
+from ttl_cache import TTLCache
+from telegram_delivery import (
+    TelegramDeliveryQueue, TelegramDocumentSender, OutboxWriteError, AttachmentUnavailableError, TELEGRAM_UPLOAD_MAX_BYTES
+)
+
 # --- پیکربندی و مقداردهی اولیه ---
 load_dotenv() # بارگذاری متغیرهای محیطی از فایل .env
 logging.basicConfig(
@@ -46,6 +72,95 @@ GOOGLE_REDIRECT_URI = os.getenv('GOOGLE_REDIRECT_URI')
 
 ENABLE_EMAIL_FETCHING = os.getenv('ENABLE_EMAIL_FETCHING', 'false').lower() == 'true'
 EMAIL_FETCH_INTERVAL_SECONDS = int(os.getenv('EMAIL_FETCH_INTERVAL_SECONDS', 300))
+EMAIL_FETCH_WORKERS = int(os.getenv('EMAIL_FETCH_WORKERS', 8)) # تعداد حساب‌هایی که هم‌زمان بررسی می‌شوند
+EMAIL_FETCH_PAGE_SIZE = int(os.getenv('EMAIL_FETCH_PAGE_SIZE', 500)) # تعداد حساب‌های خوانده شده در هر صفحه از مجموعه کار چرخه
+EMAIL_FETCH_PROVIDER_LIMITS_STR = os.getenv('EMAIL_FETCH_PROVIDER_LIMITS', '') # مثال: "google:8"
+# زمان‌بندی تطبیقی: بازه هر حساب بین این دو مقدار، بر اساس فعالیت صندوق تنظیم می‌شود
+EMAIL_POLL_MIN_INTERVAL_SECONDS = int(os.getenv('EMAIL_POLL_MIN_INTERVAL_SECONDS', 60))
+EMAIL_POLL_MAX_INTERVAL_SECONDS = int(os.getenv('EMAIL_POLL_MAX_INTERVAL_SECONDS', 1800))
+EMAIL_POLL_BACKOFF_FACTOR = float(os.getenv('EMAIL_POLL_BACKOFF_FACTOR', 1.5)) # ضریب افزایش بازه پس از هر بررسی بدون پیام جدید
+EMAIL_POLL_REFRESH_SECONDS = int(os.getenv('EMAIL_POLL_REFRESH_SECONDS', 300)) # فاصله بازخوانی مجموعه حساب‌های قابل واکشی از پایگاه داده
+# اجاره (lease) حساب‌ها بین پردازه‌های واکشی (ربات و fetch_worker.py)؛ هر حساب در هر لحظه فقط یک مالک دارد
+FETCH_WORKER_ID = os.getenv('FETCH_WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}"
+FETCH_LEASE_TTL_SECONDS = int(os.getenv('FETCH_LEASE_TTL_SECONDS', 900)) # باید از EMAIL_POLL_REFRESH_SECONDS بزرگ‌تر باشد
+GMAIL_RESYNC_MAX_MESSAGES = int(os.getenv('GMAIL_RESYNC_MAX_MESSAGES', 20)) # سقف پیام‌ها در همگام‌سازی کامل پس از انقضای history
+GMAIL_RESYNC_WINDOW_DAYS = int(os.getenv('GMAIL_RESYNC_WINDOW_DAYS', 2)) # بازه زمانی جستجو در همگام‌سازی کامل
+GMAIL_BATCH_SIZE = int(os.getenv('GMAIL_BATCH_SIZE', 50)) # تعداد پیام در هر درخواست batch (حداکثر 100)
+GMAIL_METADATA_HEADERS = [h.strip() for h in os.getenv('GMAIL_METADATA_HEADERS', 'From,Subject,Date').split(',') if h.strip()]
+GMAIL_BODY_FORMAT = os.getenv('GMAIL_BODY_FORMAT', 'full').lower() # full: دریافت متن پیام‌های ارسالی | none: فقط سرآیندها و snippet
+GMAIL_FILTER_QUERY_MAX_PAGES = int(os.getenv('GMAIL_FILTER_QUERY_MAX_PAGES', 5)) # سقف صفحه‌های messages.list برای اعمال فیلتر در سمت Gmail
+EMAIL_BODY_PREVIEW_CHARS = int(os.getenv('EMAIL_BODY_PREVIEW_CHARS', 1500)) # سقف کل متن؛ متن طولانی در چند پیام 4096 کاراکتری ارسال می‌شود
+EMAIL_ATTACHMENT_MAX_BYTES = int(os.getenv('EMAIL_ATTACHMENT_MAX_BYTES', 20 * 1024 * 1024)) # 0: پیوست‌ها ارسال نمی‌شوند
+EMAIL_ATTACHMENT_SPOOL_BYTES = int(os.getenv('EMAIL_ATTACHMENT_SPOOL_BYTES', 1024 * 1024)) # پیوست‌های بزرگ‌تر روی دیسک موقت نگه داشته می‌شوند
+EMAIL_ATTACHMENTS_PER_MESSAGE = int(os.getenv('EMAIL_ATTACHMENTS_PER_MESSAGE', 5))
+
+# بازآوری پیش‌دستانه توکن‌ها
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv('TOKEN_REFRESH_MARGIN_SECONDS', 300)) # چند ثانیه قبل از انقضا بازآوری شود
+TOKEN_REFRESH_SCAN_SECONDS = int(os.getenv('TOKEN_REFRESH_SCAN_SECONDS', 120)) # فاصله بررسی توکن‌های نزدیک به انقضا
+TOKEN_REFRESH_WORKERS = int(os.getenv('TOKEN_REFRESH_WORKERS', 4))
+TOKEN_REFRESH_RETRY_SECONDS = int(os.getenv('TOKEN_REFRESH_RETRY_SECONDS', 60)) # تأخیر پس از اولین بازآوری ناموفق؛ هر بار دو برابر می‌شود
+TOKEN_REFRESH_MAX_BACKOFF_SECONDS = int(os.getenv('TOKEN_REFRESH_MAX_BACKOFF_SECONDS', 1800))
+ACCESS_TOKEN_CACHE_MAX_ENTRIES = int(os.getenv('ACCESS_TOKEN_CACHE_MAX_ENTRIES', 10000))
+
+# صف ارسال پیام‌ها به تلگرام (محدودیت‌های Bot API: حدود 30 پیام در ثانیه در کل و 1 پیام در ثانیه برای هر چت)
+DELIVERY_GLOBAL_RATE_PER_SECOND = float(os.getenv('DELIVERY_GLOBAL_RATE_PER_SECOND', 25))
+DELIVERY_PER_CHAT_RATE_PER_SECOND = float(os.getenv('DELIVERY_PER_CHAT_RATE_PER_SECOND', 1))
+DELIVERY_PER_CHAT_BURST = float(os.getenv('DELIVERY_PER_CHAT_BURST', 3))
+DELIVERY_COALESCE_MAX_CHARS = int(os.getenv('DELIVERY_COALESCE_MAX_CHARS', 1000)) # پیام‌های کوتاه‌تر از این با هم ادغام می‌شوند
+DELIVERY_POLL_SECONDS = float(os.getenv('DELIVERY_POLL_SECONDS', 1))
+DELIVERY_MAX_CONCURRENT_UPLOADS = int(os.getenv('DELIVERY_MAX_CONCURRENT_UPLOADS', 2)) # ارسال هم‌زمان پیوست‌ها (هر کدام در یک نخ)
+
+# رویدادهای تکمیل OAuth (جدول oauth_completion_events که redirect handler پر می‌کند)؛ جدول فقط در این مدت پس از شروع یک اتصال بررسی می‌شود
+OAUTH_COMPLETION_POLL_SECONDS = float(os.getenv('OAUTH_COMPLETION_POLL_SECONDS', 1))
+OAUTH_COMPLETION_WATCH_SECONDS = int(os.getenv('OAUTH_COMPLETION_WATCH_SECONDS', 900))
+OAUTH_COMPLETION_MAX_POLL_SECONDS = float(os.getenv('OAUTH_COMPLETION_MAX_POLL_SECONDS', 30)) # فاصله بررسی پس از هر بررسی بی‌نتیجه تا این سقف دو برابر می‌شود
+
+# state پارامتر OAuth: "signed" توکن امضا شده بدون جدول؛ "db" رفتار قبلی با ردیف oauth_states
+OAUTH_STATE_MODE = os.getenv('OAUTH_STATE_MODE', 'signed').lower()
+OAUTH_STATE_MAX_AGE_SECONDS = int(os.getenv('OAUTH_STATE_MAX_AGE_SECONDS', 1800)) # پس از این مدت state (و ردیف‌های قدیمی oauth_states) منقضی است
+OAUTH_STATE_SWEEP_SECONDS = int(os.getenv('OAUTH_STATE_SWEEP_SECONDS', 3600)) # فاصله پاکسازی ردیف‌های منقضی oauth_states
+
+# دستور ادمین /bulk_subscriptions: تعداد ردیف در هر تراکنش و حداکثر اندازه فایل (Bot API فایل‌های بزرگ‌تر از 20MB را نمی‌دهد)
+BULK_SUBSCRIPTION_CHUNK_SIZE = int(os.getenv('BULK_SUBSCRIPTION_CHUNK_SIZE', 500))
+BULK_SUBSCRIPTION_MAX_FILE_BYTES = int(os.getenv('BULK_SUBSCRIPTION_MAX_FILE_BYTES', 20 * 1024 * 1024))
+
+# دستور ادمین /stats: فاصله بازسازی توزیع مصرف سهمیه توسط پردازه‌های واکشی
+ADMIN_STATS_QUOTA_SNAPSHOT_SECONDS = int(os.getenv('ADMIN_STATS_QUOTA_SNAPSHOT_SECONDS', 900))
+
+# حالت ارسال خلاصه (قابل انتخاب برای هر حساب از منوی ایمیل‌های متصل)
+DIGEST_WINDOW_SECONDS = int(os.getenv('DIGEST_WINDOW_SECONDS', 3600)) # پیام‌های جدید تا این مدت پس از اولین پیام در یک خلاصه جمع می‌شوند
+DIGEST_PAGE_SIZE = int(os.getenv('DIGEST_PAGE_SIZE', 8)) # تعداد ایمیل در هر صفحه خلاصه
+DIGEST_POLL_SECONDS = float(os.getenv('DIGEST_POLL_SECONDS', 30)) # فاصله بررسی خلاصه‌های سررسید شده
+DIGEST_RETENTION_DAYS = int(os.getenv('DIGEST_RETENTION_DAYS', 7)) # پس از این مدت خلاصه‌ها و دکمه‌هایشان پاک می‌شوند
+DIGEST_EXPANDED_BODY_CHARS = int(os.getenv('DIGEST_EXPANDED_BODY_CHARS', 3500)) # حداکثر طول متن ایمیل باز شده از خلاصه
+
+# اعلان‌های push جیمیل (Pub/Sub)؛ با تنظیم GMAIL_PUSH_TOPIC فعال می‌شود و polling فقط پشتیبان کند می‌ماند
+GMAIL_PUSH_TOPIC = os.getenv('GMAIL_PUSH_TOPIC') # مثال: projects/my-project/topics/gmail-push
+EMAIL_PUSH_FALLBACK_INTERVAL_SECONDS = int(os.getenv('EMAIL_PUSH_FALLBACK_INTERVAL_SECONDS', 1800))
+PUSH_QUEUE_POLL_SECONDS = float(os.getenv('PUSH_QUEUE_POLL_SECONDS', 2))
+PUSH_QUEUE_BATCH_SIZE = int(os.getenv('PUSH_QUEUE_BATCH_SIZE', 200))
+GMAIL_WATCH_RENEWAL_CHECK_SECONDS = int(os.getenv('GMAIL_WATCH_RENEWAL_CHECK_SECONDS', 3600))
+GMAIL_WATCH_RENEWAL_MARGIN_SECONDS = int(os.getenv('GMAIL_WATCH_RENEWAL_MARGIN_SECONDS', 86400)) # تمدید یک روز قبل از انقضا
+
+# متریک‌ها با قالب Prometheus روی http://METRICS_BIND_HOST:METRICS_PORT/metrics (0 یعنی غیرفعال)
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))
+METRICS_BIND_HOST = os.getenv('METRICS_BIND_HOST', '127.0.0.1')
+
+# حالت webhook: اگر TELEGRAM_WEBHOOK_URL تنظیم شود، به‌روزرسانی‌های تلگرام و /oauth2callback روی یک سرور در همین پردازه دریافت می‌شوند
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL') # آدرس عمومی پایه، مثلاً https://bot.example.com
+TELEGRAM_WEBHOOK_PATH = os.getenv('TELEGRAM_WEBHOOK_PATH', '/telegram')
+TELEGRAM_WEBHOOK_SECRET = os.getenv('TELEGRAM_WEBHOOK_SECRET') # در صورت خالی بودن در هر اجرا تصادفی ساخته می‌شود
+WEBHOOK_LISTEN_HOST = os.getenv('WEBHOOK_LISTEN_HOST', '0.0.0.0')
+WEBHOOK_LISTEN_PORT = int(os.getenv('WEBHOOK_LISTEN_PORT', 8080))
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_POOL_MAX_LIFETIME_SECONDS = int(os.getenv('DB_POOL_MAX_LIFETIME_SECONDS', 1800))
+DB_POOL_HEALTHCHECK_IDLE_SECONDS = int(os.getenv('DB_POOL_HEALTHCHECK_IDLE_SECONDS', 30))
+DB_POOL_ACQUIRE_TIMEOUT_SECONDS = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT_SECONDS', 10))
+USER_CACHE_MAX_ENTRIES = int(os.getenv('USER_CACHE_MAX_ENTRIES', 10000))
+USER_CACHE_TTL_SECONDS = float(os.getenv('USER_CACHE_TTL_SECONDS', 60))
+# تعداد نخ‌های executor پایگاه داده برای کنترل‌کننده‌های async (نباید از اندازه استخر بیشتر باشد)
+DB_EXECUTOR_WORKERS = min(int(os.getenv('DB_EXECUTOR_WORKERS', DB_POOL_SIZE)), DB_POOL_SIZE)
 
 # اعتبارسنجی متغیرهای محیطی ضروری
 essential_vars = {
@@ -72,6 +187,7 @@ try:
 except Exception as e:
     logger.critical(f"Invalid ENCRYPTION_KEY: {e}. Exiting.")
     exit(1)
+oauth_state_signer = oauth_flow.OAuthStateSigner(ENCRYPTION_KEY_STR, OAUTH_STATE_MAX_AGE_SECONDS)
 
 def encrypt_data(data: str) -> str:
     if not data: return ""
@@ -94,11 +210,43 @@ if ADMIN_TELEGRAM_IDS_STR:
         logger.warning("Invalid ADMIN_TELEGRAM_IDS format. Should be comma-separated integers.")
 logger.info(f"Admin IDs loaded: {ADMIN_TELEGRAM_IDS}")
 
+# --- سقف هم‌زمانی واکشی برای هر ارائه‌دهنده ---
+EMAIL_FETCH_PROVIDER_LIMITS = {}
+if EMAIL_FETCH_PROVIDER_LIMITS_STR:
+    try:
+        for provider_limit in EMAIL_FETCH_PROVIDER_LIMITS_STR.split(','):
+            if not provider_limit.strip(): continue
+            provider_name, limit = provider_limit.split(':')
+            EMAIL_FETCH_PROVIDER_LIMITS[provider_name.strip()] = max(1, int(limit))
+    except ValueError:
+        logger.warning("Invalid EMAIL_FETCH_PROVIDER_LIMITS format. Should be comma-separated provider:limit pairs.")
+        EMAIL_FETCH_PROVIDER_LIMITS = {}
+
 
 # --- تنظیمات پایگاه داده (MySQL) ---
+# استخر اتصال برای پایگاه داده اصلی؛ اتصال‌ها به صورت تنبل (در اولین درخواست) ساخته می‌شوند
+db_pool = MySQLPool(
+    "main_bot",
+    {
+        'host': MYSQL_HOST, 'user': MYSQL_USER, 'password': MYSQL_PASSWORD, 'port': MYSQL_PORT,
+        'database': MYSQL_DATABASE_NAME_ENV, 'autocommit': False, 'connection_timeout': 10
+    },
+    size=DB_POOL_SIZE,
+    max_lifetime_seconds=DB_POOL_MAX_LIFETIME_SECONDS,
+    healthcheck_idle_seconds=DB_POOL_HEALTHCHECK_IDLE_SECONDS,
+    acquire_timeout_seconds=DB_POOL_ACQUIRE_TIMEOUT_SECONDS,
+)
+metrics.register_stats_collectors(
+    "mailtotelbot_db_pool", "MySQL connection pool", db_pool.stats, labels={'pool': 'bot'},
+    counter_keys=('acquired', 'waits', 'wait_seconds_total', 'timeouts', 'created', 'recycled_lifetime', 'discarded_unhealthy'),
+    keys=('acquired', 'waits', 'wait_seconds_total', 'wait_seconds_max', 'timeouts', 'created', 'recycled_lifetime', 'discarded_unhealthy', 'idle', 'size'),
+)
+
 def get_db_connection(db_name=None):
-    """برقراری اتصال جدید به پایگاه داده MySQL."""
+    """دریافت اتصال به MySQL: برای پایگاه داده اصلی از استخر، در غیر این صورت اتصال مستقیم (مثلاً برای CREATE DATABASE)."""
     try:
+        if db_name and db_name == MYSQL_DATABASE_NAME_ENV:
+            return db_pool.get_connection() # close() روی این اتصال آن را به استخر بازمی‌گرداند
         conn_params = {
             'host': MYSQL_HOST,
             'user': MYSQL_USER,
@@ -143,85 +291,55 @@ def create_database_if_not_exists():
         return False
     finally:
         if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+        if conn: conn.close()
+
+def init_db_main():
+    """تابع اصلی برای مقداردهی اولیه پایگاه داده: اعمال مهاجرت‌های باقی مانده طرح (schema_migrations.py).
 
-def create_tables_in_database():
-    """ایجاد جداول در پایگاه داده مشخص شده در صورت عدم وجود."""
+    اگر طرح به‌روز باشد فقط نسخه آن خوانده می‌شود؛ CREATE DATABASE فقط وقتی اجرا می‌شود که پایگاه داده وجود نداشته باشد.
+    """
+    if not MYSQL_DATABASE_NAME_ENV:
+        logger.critical("MYSQL_DATABASE environment variable is not set. Cannot proceed with DB initialization.")
+        exit(1)
     conn = None
-    cursor = None
     try:
-        conn = get_db_connection(db_name=MYSQL_DATABASE_NAME_ENV)
-        cursor = conn.cursor()
-        logger.info(f"Successfully connected to MySQL database '{MYSQL_DATABASE_NAME_ENV}' for table creation.")
-
-        # جدول کاربران
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            telegram_id BIGINT PRIMARY KEY,
-            username VARCHAR(255),
-            is_admin BOOLEAN DEFAULT FALSE,
-            subscription_expiry_timestamp BIGINT,
-            max_allowed_emails INT DEFAULT 1,
-            monthly_email_quota INT DEFAULT 10,
-            current_month_emails_received INT DEFAULT 0,
-            last_quota_reset_month VARCHAR(7)
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
-        """)
-        # جدول وضعیت‌های OAuth
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS oauth_states (
-            state_uuid VARCHAR(36) PRIMARY KEY,
-            telegram_id BIGINT NOT NULL,
-            provider VARCHAR(50) NOT NULL,
-            timestamp_created BIGINT NOT NULL
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
-        """)
-        # جدول ایمیل‌های متصل شده با OAuth
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS connected_oauth_emails (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            user_telegram_id BIGINT NOT NULL,
-            provider VARCHAR(50) NOT NULL,
-            email_address VARCHAR(255) NOT NULL,
-            encrypted_access_token TEXT,
-            encrypted_refresh_token TEXT,
-            token_expiry_timestamp BIGINT,
-            is_active BOOLEAN DEFAULT TRUE,
-            last_processed_email_marker TEXT,
-            timestamp_added BIGINT NOT NULL,
-            FOREIGN KEY (user_telegram_id) REFERENCES users(telegram_id) ON DELETE CASCADE,
-            UNIQUE KEY idx_user_email_provider (user_telegram_id, email_address, provider)
-        ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
-        """)
-        conn.commit()
-        logger.info(f"Database tables initialized/checked successfully in '{MYSQL_DATABASE_NAME_ENV}'.")
-    except mysql.connector.Error as err:
-        logger.critical(f"Failed to initialize database tables in '{MYSQL_DATABASE_NAME_ENV}': {err}. Exiting.")
-        if conn: conn.rollback()
-        exit(1)
+        try:
+            conn = get_db_connection(db_name=MYSQL_DATABASE_NAME_ENV)
+        except mysql.connector.Error as err:
+            if err.errno != errorcode.ER_BAD_DB_ERROR: raise
+            create_database_if_not_exists()
+            conn = get_db_connection(db_name=MYSQL_DATABASE_NAME_ENV)
+        applied = schema_migrations.migrate(conn, MYSQL_DATABASE_NAME_ENV)
+        if applied:
+            logger.info(f"Applied {applied} schema migration(s); '{MYSQL_DATABASE_NAME_ENV}' is at version {schema_migrations.LATEST_VERSION}.")
+        else:
+            logger.info(f"Database schema of '{MYSQL_DATABASE_NAME_ENV}' is current; skipped DDL.")
     except Exception as e:
-        logger.critical(f"An unexpected error occurred during table creation: {e}. Exiting.")
+        logger.critical(f"Failed to initialize database schema in '{MYSQL_DATABASE_NAME_ENV}': {e}. Exiting.")
         if conn: conn.rollback()
         exit(1)
     finally:
-        if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+        if conn: conn.close()
 
-def init_db_main():
-    """تابع اصلی برای مقداردهی اولیه پایگاه داده: ایجاد دیتابیس (در صورت امکان) و سپس جداول."""
-    if not MYSQL_DATABASE_NAME_ENV:
-        logger.critical("MYSQL_DATABASE environment variable is not set. Cannot proceed with DB initialization.")
-        exit(1)
-    create_database_if_not_exists() # این تابع خطاها را لاگ می‌کند اما برنامه را متوقف نمی‌کند
-    create_tables_in_database() # این تابع در صورت بروز خطا، برنامه را متوقف خواهد کرد
+# --- متریک‌های مسیرهای پرتکرار ---
+HANDLER_SECONDS = metrics.Histogram("mailtotelbot_handler_seconds", "Telegram handler latency by command or callback pattern", ('handler',))
+HANDLER_ERRORS = metrics.Counter("mailtotelbot_handler_errors", "Telegram handler exceptions by command or callback pattern", ('handler',))
+ACCOUNT_FETCH_SECONDS = metrics.Histogram(
+    "mailtotelbot_account_fetch_seconds", "Per-account email fetch latency", ('result',),
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+)
+TOKEN_REFRESHES = metrics.Counter("mailtotelbot_token_refreshes", "Google access token refreshes by result", ('result',))
 
 # --- تابع کمکی برای اجرای کوئری‌های پایگاه داده ---
-def db_execute(query, params=None, fetchone=False, fetchall=False, commit=False, last_row_id=False):
-    """اجرای کوئری پایگاه داده. نتیجه یا شناسه آخرین ردیف را برمی‌گرداند."""
+def db_execute(query, params=None, fetchone=False, fetchall=False, commit=False, last_row_id=False, row_count=False):
+    """اجرای کوئری پایگاه داده. نتیجه، شناسه آخرین ردیف یا (با row_count) تعداد ردیف‌های تغییر یافته را برمی‌گرداند."""
     result = None
     row_id = None
+    affected_rows = 0 # در صورت خطا صفر
     conn = None
     cursor = None
+    operation = query.lstrip()[:6].upper() # SELECT، UPDATE، INSERT، DELETE (برچسب متریک با تعداد مقادیر محدود)
+    started = time.perf_counter()
     try:
         conn = get_db_connection(db_name=MYSQL_DATABASE_NAME_ENV)
         cursor = conn.cursor(dictionary=True if (fetchone or fetchall) else False) # dictionary=True برای دسترسی به ستون‌ها با نام
@@ -234,43 +352,100 @@ def db_execute(query, params=None, fetchone=False, fetchall=False, commit=False,
             result = cursor.fetchall()
         if last_row_id:
             row_id = cursor.lastrowid
+        if row_count:
+            affected_rows = cursor.rowcount
     except mysql.connector.Error as err:
         logger.error(f"MySQL Database error: {err} \nQuery: {query} \nParams: {params}")
+        metrics.DB_QUERY_ERRORS.inc(1, 'bot', operation)
         if conn: conn.rollback() # بازگرداندن تغییرات در صورت بروز خطا برای DML
     except Exception as e:
         logger.error(f"An unexpected error occurred in db_execute: {e}")
+        metrics.DB_QUERY_ERRORS.inc(1, 'bot', operation)
         if conn: conn.rollback()
     finally:
         if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+        if conn: conn.close() # برای اتصال استخر، بازگرداندن به استخر
+        metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - started, 'bot', operation)
+    if row_count: return affected_rows
     return (result, row_id) if last_row_id else result
 
+# --- دسترسی ناهمگام به پایگاه داده برای کنترل‌کننده‌های async ---
+# کوئری‌ها در executor اختصاصی با هم‌روندی محدود اجرا می‌شوند تا حلقه رویداد تلگرام مسدود نشود
+db_executor = ThreadPoolExecutor(max_workers=max(1, DB_EXECUTOR_WORKERS), thread_name_prefix="db_exec")
+
+async def run_db(func, *args, **kwargs):
+    """اجرای یک تابع همگام مرتبط با پایگاه داده در executor پایگاه داده و انتظار برای نتیجه آن."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(func, *args, **kwargs))
+
+async def db_execute_async(query, params=None, **kwargs):
+    """نسخه awaitable از db_execute با همان آرگومان‌ها و مقدار بازگشتی."""
+    return await run_db(db_execute, query, params, **kwargs)
+
+# execute برای توابع admin_stats در مسیرهایی که تراکنش باز ندارند (هر کوئری جداگانه commit می‌شود)
+stats_execute = functools.partial(db_execute, commit=True)
+
 # --- وضعیت‌های مکالمه برای دستور ادمین ---
-A_TARGET_USER_ID, A_SUB_DAYS, A_MAX_EMAILS, A_MONTHLY_QUOTA = range(4)
+A_TARGET_USER_ID, A_SUB_DAYS, A_MAX_EMAILS, A_MONTHLY_QUOTA, A_BULK_FILE, U_FILTER_RULE = range(6)
 
 # --- توابع کمکی (is_user_admin, check_and_create_user, check_and_reset_quota_for_user) ---
 def is_user_admin(telegram_user_id: int) -> bool:
     """بررسی می‌کند که آیا کاربر ادمین است یا خیر."""
     return telegram_user_id in ADMIN_TELEGRAM_IDS
 
+# --- کش پروفایل کاربران ---
+# پروفایل کاربر (ردیف users به همراه تعداد ایمیل‌های متصل) بر اساس telegram_id کش می‌شود.
+# هر مسیری که این داده‌ها را تغییر می‌دهد باید invalidate_user_profile را فراخوانی کند.
+# مقادیر کش شده بین فراخوانی‌ها مشترک‌اند و نباید تغییر داده شوند.
+user_profile_cache = TTLCache(maxsize=USER_CACHE_MAX_ENTRIES, ttl_seconds=USER_CACHE_TTL_SECONDS)
+metrics.register_stats_collectors(
+    "mailtotelbot_user_cache", "User profile cache", user_profile_cache.stats,
+    counter_keys=('hits', 'misses', 'evictions', 'expirations', 'invalidations')
+)
+
+def get_user_profile(telegram_id: int) -> dict | None:
+    """پروفایل کاربر از کش، یا در صورت نبود، از پایگاه داده با یک کوئری (read-through)."""
+    profile = user_profile_cache.get(telegram_id)
+    if profile is not None:
+        return profile
+    profile = db_execute(
+        """SELECT u.telegram_id, u.username, u.is_admin, u.subscription_expiry_timestamp, u.max_allowed_emails,
+                  u.monthly_email_quota, u.current_month_emails_received, u.last_quota_reset_month,
+                  (SELECT COUNT(*) FROM connected_oauth_emails coe WHERE coe.user_telegram_id = u.telegram_id) AS connected_emails_count
+           FROM users u WHERE u.telegram_id = %s""",
+        (telegram_id,), fetchone=True
+    )
+    if profile:
+        user_profile_cache.set(telegram_id, profile)
+    return profile
+
+def invalidate_user_profile(telegram_id: int):
+    """حذف پروفایل کاربر از کش پس از هر تغییر در ردیف users یا ایمیل‌های متصل او."""
+    user_profile_cache.invalidate(telegram_id)
+
 def check_and_create_user(telegram_id: int, username: str = None):
     """بررسی وجود کاربر، ایجاد در صورت عدم وجود، و به‌روزرسانی وضعیت ادمین."""
-    user_row = db_execute("SELECT is_admin FROM users WHERE telegram_id = %s", (telegram_id,), fetchone=True)
+    user_row = get_user_profile(telegram_id)
     admin_flag = True if is_user_admin(telegram_id) else False # MySQL BOOLEAN can be True/False
     if not user_row:
         current_month_year_str = datetime.now(timezone.utc).strftime("%Y-%m")
-        db_execute(
+        inserted = db_execute(
             "INSERT INTO users (telegram_id, username, is_admin, last_quota_reset_month, subscription_expiry_timestamp, max_allowed_emails, monthly_email_quota, current_month_emails_received) VALUES (%s, %s, %s, %s, NULL, 1, 10, 0)",
-            (telegram_id, username, admin_flag, current_month_year_str), commit=True
+            (telegram_id, username, admin_flag, current_month_year_str), commit=True, row_count=True
         )
+        if inserted:
+            admin_stats.add_to_counters(stats_execute, {admin_stats.USERS_TOTAL: 1})
+            admin_stats.move_subscription_expiry(stats_execute, {admin_stats.NO_EXPIRY_DAY: 1})
+        invalidate_user_profile(telegram_id)
         logger.info(f"New user {telegram_id} (Admin: {admin_flag}) created.")
     elif user_row['is_admin'] != admin_flag: # is_admin در MySQL به صورت 0 یا 1 ذخیره می‌شود
         db_execute("UPDATE users SET is_admin = %s WHERE telegram_id = %s", (admin_flag, telegram_id), commit=True)
+        invalidate_user_profile(telegram_id)
         logger.info(f"Admin status for user {telegram_id} updated to: {admin_flag}.")
 
 def check_and_reset_quota_for_user(telegram_id: int):
     """بازنشانی سهمیه ماهانه ایمیل در صورت شروع ماه جدید."""
-    user_data = db_execute("SELECT last_quota_reset_month FROM users WHERE telegram_id = %s", (telegram_id,), fetchone=True)
+    user_data = get_user_profile(telegram_id)
     now = datetime.now(timezone.utc)
     current_month_year_str = now.strftime("%Y-%m")
     if not user_data or not user_data['last_quota_reset_month'] or user_data['last_quota_reset_month'] != current_month_year_str:
@@ -278,8 +453,33 @@ def check_and_reset_quota_for_user(telegram_id: int):
             "UPDATE users SET current_month_emails_received = 0, last_quota_reset_month = %s WHERE telegram_id = %s",
             (current_month_year_str, telegram_id), commit=True
         )
+        invalidate_user_profile(telegram_id)
         logger.info(f"Initialized/Reset monthly email quota for user {telegram_id} for {current_month_year_str}")
 
+def set_user_subscription(telegram_id: int, expiry_timestamp: int | None, max_allowed_emails: int, monthly_email_quota: int):
+    """به‌روزرسانی اشتراک کاربر و جابه‌جایی او در subscription_expiry_days (آمار /stats) در یک تراکنش."""
+    conn = get_db_connection(db_name=MYSQL_DATABASE_NAME_ENV)
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT subscription_expiry_timestamp FROM users WHERE telegram_id = %s FOR UPDATE", (telegram_id,))
+        user_row = cursor.fetchone()
+        if user_row is None: raise ValueError(f"user {telegram_id} not found")
+        cursor.execute(
+            "UPDATE users SET subscription_expiry_timestamp = %s, max_allowed_emails = %s, monthly_email_quota = %s WHERE telegram_id = %s",
+            (expiry_timestamp, max_allowed_emails, monthly_email_quota, telegram_id)
+        )
+        old_day, new_day = admin_stats.expiry_day(user_row[0]), admin_stats.expiry_day(expiry_timestamp)
+        if old_day != new_day: admin_stats.move_subscription_expiry(cursor.execute, {old_day: -1, new_day: 1})
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if cursor: cursor.close()
+        conn.close()
+    invalidate_user_profile(telegram_id)
+
 # --- کیبورد اصلی ---
 def get_main_keyboard():
     keyboard = [
@@ -292,7 +492,7 @@ def get_main_keyboard():
 # --- کنترل‌کننده‌های دستورات و پاسخ‌ها ---
 async def start_command(update: Update, context: CallbackContext) -> None:
     user = update.effective_user
-    check_and_create_user(user.id, user.username)
+    await run_db(check_and_create_user, user.id, user.username)
     await update.message.reply_text(
         f"سلام {user.mention_markdown_v2()} عزیز!\nبه ربات مدیریت ایمیل با OAuth خوش آمدید.",
         reply_markup=get_main_keyboard(),
@@ -303,11 +503,8 @@ async def account_info_callback(update: Update, context: CallbackContext) -> Non
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    check_and_reset_quota_for_user(user_id)
-    user_data_row = db_execute(
-        "SELECT username, is_admin, subscription_expiry_timestamp, max_allowed_emails, monthly_email_quota, current_month_emails_received FROM users WHERE telegram_id = %s",
-        (user_id,), fetchone=True
-    )
+    await run_db(check_and_reset_quota_for_user, user_id)
+    user_data_row = await run_db(get_user_profile, user_id)
     if not user_data_row:
         await query.edit_message_text("اطلاعات کاربری یافت نشد. لطفاً /start را مجددا اجرا کنید."); return
     sub_expiry_ts = user_data_row['subscription_expiry_timestamp']
@@ -317,8 +514,7 @@ async def account_info_callback(update: Update, context: CallbackContext) -> Non
             sub_expiry_dt = datetime.fromtimestamp(sub_expiry_ts, timezone.utc)
             sub_expiry_formatted = sub_expiry_dt.strftime("%Y-%m-%d %H:%M UTC")
         except Exception: sub_expiry_formatted = "تاریخ نامعتبر"
-    connected_emails_count_row = db_execute("SELECT COUNT(*) AS count FROM connected_oauth_emails WHERE user_telegram_id = %s", (user_id,), fetchone=True)
-    connected_emails_count = connected_emails_count_row['count'] if connected_emails_count_row else 0
+    connected_emails_count = user_data_row['connected_emails_count']
     monthly_quota_val = user_data_row['monthly_email_quota']
     message = (
         f"👤 **اطلاعات حساب کاربری**\n\n"
@@ -335,25 +531,29 @@ async def connect_oauth_email_init_callback(update: Update, context: CallbackCon
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    user_limits_row = db_execute("SELECT max_allowed_emails FROM users WHERE telegram_id = %s", (user_id,), fetchone=True)
+    user_limits_row = await run_db(get_user_profile, user_id)
     if not user_limits_row:
         await query.edit_message_text("خطا: کاربر یافت نشد. /start را بزنید."); return
     max_allowed = user_limits_row['max_allowed_emails']
-    connected_count_row = db_execute("SELECT COUNT(*) AS count FROM connected_oauth_emails WHERE user_telegram_id = %s", (user_id,), fetchone=True)
-    connected_count = connected_count_row['count'] if connected_count_row else 0
+    connected_count = user_limits_row['connected_emails_count']
     if connected_count >= max_allowed:
         await query.edit_message_text(f"شما به سقف مجاز ({max_allowed}) اتصال ایمیل رسیده‌اید."); return
     if not GOOGLE_CLIENT_ID or not GOOGLE_REDIRECT_URI:
         await query.edit_message_text("پیکربندی OAuth ناقص است. امکان اتصال وجود ندارد."); return
-    oauth_state = str(uuid.uuid4())
-    try:
-        db_execute(
-            "INSERT INTO oauth_states (state_uuid, telegram_id, provider, timestamp_created) VALUES (%s, %s, %s, %s)",
-            (oauth_state, user_id, "google", int(datetime.now(timezone.utc).timestamp())), commit=True
-        )
-    except Exception as e:
-        logger.error(f"Error storing OAuth state for user {user_id}: {e}")
-        await query.edit_message_text("خطا در شروع فرآیند اتصال. لطفاً دوباره تلاش کنید."); return
+    # پیامی که اکنون ویرایش می‌شود همان پیامی است که پس از تکمیل اتصال به‌روزرسانی خواهد شد
+    if OAUTH_STATE_MODE == 'signed':
+        oauth_state, state_nonce, issued_at = oauth_state_signer.issue(user_id, "google", query.message.chat_id, query.message.message_id)
+        check_state_ref = f"{state_nonce}_{issued_at}" # کل state در سقف 64 بایتی callback_data جا نمی‌شود
+    else:
+        oauth_state = check_state_ref = str(uuid.uuid4())
+        try:
+            await db_execute_async(
+                "INSERT INTO oauth_states (state_uuid, telegram_id, provider, timestamp_created, chat_id, message_id) VALUES (%s, %s, %s, %s, %s, %s)",
+                (oauth_state, user_id, "google", int(datetime.now(timezone.utc).timestamp()), query.message.chat_id, query.message.message_id), commit=True
+            )
+        except Exception as e:
+            logger.error(f"Error storing OAuth state for user {user_id}: {e}")
+            await query.edit_message_text("خطا در شروع فرآیند اتصال. لطفاً دوباره تلاش کنید."); return
     params = {
         "client_id": GOOGLE_CLIENT_ID, "redirect_uri": GOOGLE_REDIRECT_URI, "response_type": "code",
         "scope": "https://www.googleapis.com/auth/gmail.readonly https://www.googleapis.com/auth/userinfo.email",
@@ -361,31 +561,43 @@ async def connect_oauth_email_init_callback(update: Update, context: CallbackCon
     }
     auth_url = f"https://accounts.google.com/o/oauth2/v2/auth?{urlencode(params)}"
     message_text = ("برای اتصال حساب Gmail خود، روی دکمه زیر کلیک کرده و مراحل را در مرورگر دنبال کنید.\n\n"
-                    "پس از اعطای دسترسی در صفحه گوگل و مشاهده پیام موفقیت از طرف سرویس وب ما، "
-                    "به ربات بازگشته و روی دکمه '✅ بررسی اتصال' کلیک کنید.")
+                    "پس از اعطای دسترسی در صفحه گوگل، همین پیام به صورت خودکار به‌روزرسانی می‌شود. "
+                    "اگر به‌روزرسانی نشد، روی دکمه '✅ بررسی اتصال' کلیک کنید.")
     keyboard = [[InlineKeyboardButton("اتصال به گوگل (Gmail)", url=auth_url)],
-                [InlineKeyboardButton("✅ بررسی اتصال و تکمیل", callback_data=f'check_oauth_done_{oauth_state}')],
+                [InlineKeyboardButton("✅ بررسی اتصال و تکمیل", callback_data=f'check_oauth_done_{check_state_ref}')],
                 [InlineKeyboardButton("بازگشت", callback_data='back_to_main')]]
     await query.edit_message_text(text=message_text, reply_markup=InlineKeyboardMarkup(keyboard))
+    watch_oauth_completions(user_id)
 
 async def check_oauth_done_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query; await query.answer("در حال بررسی...")
     user_id = query.from_user.id
-    try: original_state_from_callback = query.data.split('_')[-1]
-    except IndexError: await query.edit_message_text("خطا: اطلاعات state یافت نشد.", reply_markup=get_main_keyboard()); return
-    
-    # سرویس redirect_uri باید state را پس از پردازش موفق حذف کند
-    state_row = db_execute("SELECT telegram_id FROM oauth_states WHERE state_uuid = %s", (original_state_from_callback,), fetchone=True)
-    
+    original_state_from_callback = query.data[len('check_oauth_done_'):]
+    if not original_state_from_callback:
+        await query.edit_message_text("خطا: اطلاعات state یافت نشد.", reply_markup=get_main_keyboard()); return
+    # state امضا شده: "<nonce>_<زمان صدور>" (ردیفی در پایگاه داده ندارد)؛ state قدیمی: UUID ردیف oauth_states
+    state_key, _, issued_at = original_state_from_callback.partition('_')
+    if issued_at:
+        state_row, connected_after = None, int(issued_at) if issued_at.isdigit() else 0
+    else:
+        # سرویس redirect_uri باید state را پس از پردازش موفق حذف کند
+        state_row = await db_execute_async("SELECT telegram_id FROM oauth_states WHERE state_uuid = %s", (state_key,), fetchone=True)
+        connected_after = 0
+
     newly_connected_email_address = None
     if not state_row: # اگر state وجود نداشته باشد، یعنی redirect_handler آن را پردازش و حذف کرده است
-        email_row = db_execute(
-            "SELECT email_address FROM connected_oauth_emails WHERE user_telegram_id = %s AND provider = %s ORDER BY timestamp_added DESC LIMIT 1",
-            (user_id, "google"), fetchone=True
+        email_row = await db_execute_async(
+            "SELECT email_address FROM connected_oauth_emails WHERE user_telegram_id = %s AND provider = %s AND timestamp_added >= %s ORDER BY timestamp_added DESC LIMIT 1",
+            (user_id, "google", connected_after), fetchone=True
         )
         if email_row: newly_connected_email_address = email_row['email_address']
     
     if newly_connected_email_address:
+        invalidate_user_profile(user_id) # ردیف جدید توسط redirect_handler_app.py درج شده است
+        email_poll_refresh_event.set()
+        oauth_completion_pending.pop(user_id, None)
+        # رویداد تکمیل این state دیگر لازم نیست (پیام همین الان ویرایش می‌شود)
+        await db_execute_async("DELETE FROM oauth_completion_events WHERE state_uuid = %s", (state_key,), commit=True)
         await query.edit_message_text(f"اتصال ایمیل {newly_connected_email_address} با موفقیت در سیستم ثبت شد!", reply_markup=get_main_keyboard())
     else:
         message_text = ("به نظر می‌رسد فرآیند اتصال هنوز کامل نشده یا مشکلی رخ داده است.\n"
@@ -401,7 +613,10 @@ async def check_oauth_done_callback(update: Update, context: CallbackContext) ->
 async def my_oauth_emails_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query; await query.answer()
     user_id = query.from_user.id
-    accounts_rows = db_execute("SELECT id, email_address, provider, is_active FROM connected_oauth_emails WHERE user_telegram_id = %s", (user_id,), fetchall=True)
+    accounts_rows = await db_execute_async(
+        "SELECT id, email_address, provider, is_active, delivery_mode, filter_rules FROM connected_oauth_emails WHERE user_telegram_id = %s",
+        (user_id,), fetchall=True
+    )
     if not accounts_rows:
         await query.edit_message_text("شما هیچ حساب ایمیلی با OAuth متصل نکرده‌اید.", reply_markup=get_main_keyboard()); return
     keyboard = []
@@ -411,7 +626,12 @@ async def my_oauth_emails_callback(update: Update, context: CallbackContext) ->
         keyboard.extend([
             [InlineKeyboardButton(f"{status_emoji} {email_addr} ({provider.capitalize()})", callback_data=f"noop_{acc_id}")],
             [InlineKeyboardButton(toggle_text, callback_data=f"toggle_email_{acc_id}"),
-             InlineKeyboardButton("🗑️ قطع اتصال", callback_data=f"disconnect_email_{acc_id}")]
+             InlineKeyboardButton("🗑️ قطع اتصال", callback_data=f"disconnect_email_{acc_id}")],
+            [InlineKeyboardButton(
+                "🗂 ارسال: خلاصه (تغییر به فوری)" if acc_row['delivery_mode'] == email_digest.DELIVERY_DIGEST else "⚡ ارسال: فوری (تغییر به خلاصه)",
+                callback_data=f"delivery_mode_{acc_id}"
+            )],
+            [InlineKeyboardButton(f"🔎 فیلترها ({len(email_filters.load_rules(acc_row['filter_rules']))})", callback_data=f"filters_menu_{acc_id}")]
         ])
         if len(accounts_rows) > 1 and acc_row != accounts_rows[-1]: # جداکننده بین آیتم‌ها
              keyboard.append([InlineKeyboardButton(" ", callback_data=f"noop_sep_{acc_id}")])
@@ -422,13 +642,20 @@ async def toggle_email_callback(update: Update, context: CallbackContext) -> Non
     query = update.callback_query; await query.answer()
     user_id = query.from_user.id
     email_db_id = int(query.data.split('_')[-1])
-    current_status_row = db_execute(
-        "SELECT is_active, email_address FROM connected_oauth_emails WHERE id = %s AND user_telegram_id = %s",
+    current_status_row = await db_execute_async(
+        "SELECT is_active, email_address, provider FROM connected_oauth_emails WHERE id = %s AND user_telegram_id = %s",
         (email_db_id, user_id), fetchone=True
     )
     if not current_status_row: await query.message.reply_text("خطا: ایمیل یافت نشد یا متعلق به شما نیست."); return
     new_status_bool = not bool(current_status_row['is_active'])
-    db_execute("UPDATE connected_oauth_emails SET is_active = %s WHERE id = %s", (new_status_bool, email_db_id), commit=True)
+    changed = await db_execute_async(
+        "UPDATE connected_oauth_emails SET is_active = %s WHERE id = %s AND is_active <> %s",
+        (new_status_bool, email_db_id, new_status_bool), commit=True, row_count=True
+    )
+    if changed: # دو کلیک هم‌زمان شمارنده را دو بار تغییر نمی‌دهند
+        await run_db(admin_stats.add_to_counters, stats_execute, {admin_stats.accounts_active_counter(current_status_row['provider']): 1 if new_status_bool else -1})
+    invalidate_user_profile(user_id)
+    email_poll_refresh_event.set()
     status_text = "فعال" if new_status_bool else "غیرفعال"
     await query.message.reply_text(f"دریافت ایمیل برای {current_status_row['email_address']} {status_text} شد.")
     await my_oauth_emails_callback(update, context) # به‌روزرسانی لیست
@@ -437,15 +664,152 @@ async def disconnect_email_callback(update: Update, context: CallbackContext) ->
     query = update.callback_query; await query.answer()
     user_id = query.from_user.id
     email_db_id = int(query.data.split('_')[-1])
-    email_data_row = db_execute(
-        "SELECT email_address FROM connected_oauth_emails WHERE id = %s AND user_telegram_id = %s",
+    email_data_row = await db_execute_async(
+        "SELECT email_address, provider, is_active FROM connected_oauth_emails WHERE id = %s AND user_telegram_id = %s",
         (email_db_id, user_id), fetchone=True
     )
     if not email_data_row: await query.message.reply_text("خطا: ایمیل یافت نشد یا متعلق به شما نیست."); return
-    db_execute("DELETE FROM connected_oauth_emails WHERE id = %s", (email_db_id,), commit=True)
+    deleted = await db_execute_async("DELETE FROM connected_oauth_emails WHERE id = %s", (email_db_id,), commit=True, row_count=True)
+    if deleted:
+        provider = email_data_row['provider']
+        await run_db(admin_stats.add_to_counters, stats_execute, {
+            admin_stats.accounts_total_counter(provider): -1,
+            admin_stats.accounts_active_counter(provider): -1 if email_data_row['is_active'] else 0,
+        })
+    invalidate_user_profile(user_id)
+    access_token_cache.invalidate(email_db_id)
     await query.message.reply_text(f"اتصال ایمیل {email_data_row['email_address']} با موفقیت قطع شد.")
     await my_oauth_emails_callback(update, context) # به‌روزرسانی لیست
 
+async def delivery_mode_callback(update: Update, context: CallbackContext) -> None:
+    """تغییر حالت ارسال یک حساب بین فوری (هر ایمیل یک پیام) و خلاصه (email_digest.py)."""
+    query = update.callback_query; await query.answer()
+    user_id = query.from_user.id
+    email_db_id = int(query.data.split('_')[-1])
+    account_row = await db_execute_async(
+        "SELECT email_address, delivery_mode FROM connected_oauth_emails WHERE id = %s AND user_telegram_id = %s",
+        (email_db_id, user_id), fetchone=True
+    )
+    if not account_row: await query.message.reply_text("خطا: ایمیل یافت نشد یا متعلق به شما نیست."); return
+    new_mode = email_digest.DELIVERY_IMMEDIATE if account_row['delivery_mode'] == email_digest.DELIVERY_DIGEST else email_digest.DELIVERY_DIGEST
+    await db_execute_async("UPDATE connected_oauth_emails SET delivery_mode = %s WHERE id = %s", (new_mode, email_db_id), commit=True)
+    email_poll_refresh_event.set()
+    if new_mode == email_digest.DELIVERY_DIGEST:
+        await query.message.reply_text(
+            f"ایمیل‌های جدید {account_row['email_address']} از این پس هر {max(1, DIGEST_WINDOW_SECONDS // 60)} دقیقه در یک پیام خلاصه ارسال می‌شوند "
+            f"(تغییر حداکثر ظرف چند دقیقه اعمال می‌شود)."
+        )
+    else:
+        await query.message.reply_text(f"ایمیل‌های جدید {account_row['email_address']} از این پس بلافاصله و جداگانه ارسال می‌شوند.")
+    await my_oauth_emails_callback(update, context) # به‌روزرسانی لیست
+
+# --- قوانین فیلتر هر حساب ---
+async def load_account_filter_rules(account_id: int, user_id: int):
+    """(آدرس ایمیل، قوانین) حساب کاربر؛ None اگر حساب وجود نداشته یا متعلق به کاربر نباشد."""
+    account_row = await db_execute_async(
+        "SELECT email_address, filter_rules FROM connected_oauth_emails WHERE id = %s AND user_telegram_id = %s",
+        (account_id, user_id), fetchone=True
+    )
+    return (account_row['email_address'], email_filters.load_rules(account_row['filter_rules'])) if account_row else None
+
+async def save_account_filter_rules(account_id: int, user_id: int, rules: list):
+    await db_execute_async(
+        "UPDATE connected_oauth_emails SET filter_rules = %s WHERE id = %s AND user_telegram_id = %s",
+        (email_filters.dump_rules(rules), account_id, user_id), commit=True
+    )
+    email_poll_refresh_event.set() # مجموعه کار (و قوانین همراه آن) دوباره خوانده شود
+
+def filters_menu_content(account_id: int, email_address: str, rules: list):
+    lines = [f"🔎 فیلترهای {email_address}"]
+    if rules:
+        lines.append("فقط ایمیل‌هایی ارسال و از سهمیه کم می‌شوند که با این قوانین منطبق باشند (قوانین هم‌نوع: «یا»، انواع مختلف: «و»):")
+        lines.extend(f"{number}. {email_filters.describe_rule(rule)}" for number, rule in enumerate(rules, 1))
+    else:
+        lines.append("هیچ فیلتری تعریف نشده است؛ همه ایمیل‌های جدید ارسال می‌شوند.")
+    keyboard = [[InlineKeyboardButton(f"🗑️ حذف قانون {number}", callback_data=f"filter_del_{account_id}_{number - 1}")] for number in range(1, len(rules) + 1)]
+    if len(rules) < email_filters.MAX_RULES_PER_ACCOUNT:
+        keyboard.append([InlineKeyboardButton("➕ افزودن قانون", callback_data=f"filter_add_{account_id}")])
+    keyboard.append([InlineKeyboardButton("بازگشت به ایمیل‌ها", callback_data='my_oauth_emails')])
+    return "\n".join(lines), InlineKeyboardMarkup(keyboard)
+
+async def filters_menu_callback(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query; await query.answer()
+    account_id = int(query.data.split('_')[-1])
+    loaded = await load_account_filter_rules(account_id, query.from_user.id)
+    if not loaded: await query.message.reply_text("خطا: ایمیل یافت نشد یا متعلق به شما نیست."); return
+    text, reply_markup = filters_menu_content(account_id, *loaded)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def filter_delete_callback(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query; await query.answer()
+    _, _, account_id, rule_index = query.data.split('_')
+    account_id, rule_index = int(account_id), int(rule_index)
+    loaded = await load_account_filter_rules(account_id, query.from_user.id)
+    if not loaded: await query.message.reply_text("خطا: ایمیل یافت نشد یا متعلق به شما نیست."); return
+    email_address, rules = loaded
+    if rule_index < len(rules):
+        del rules[rule_index]
+        await save_account_filter_rules(account_id, query.from_user.id, rules)
+    text, reply_markup = filters_menu_content(account_id, email_address, rules)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def filter_add_callback(update: Update, context: CallbackContext) -> int:
+    query = update.callback_query; await query.answer()
+    context.user_data['filter_account_id'] = int(query.data.split('_')[-1])
+    await query.message.reply_text(
+        "قانون جدید را به صورت «نوع: مقدار» ارسال کنید (یا /cancel):\n"
+        "▫️ from: boss@example.com (فرستنده شامل)\n"
+        "▫️ -from: newsletter@example.com (فرستنده نباشد)\n"
+        "▫️ subject: فاکتور (موضوع شامل)\n"
+        "▫️ label: important (برچسب جیمیل)\n"
+        "▫️ larger: 500K / smaller: 5M (اندازه ایمیل)",
+        reply_markup=ForceReply(selective=True, input_field_placeholder="from: boss@example.com")
+    )
+    return U_FILTER_RULE
+
+async def received_filter_rule(update: Update, context: CallbackContext) -> int:
+    try:
+        rule = email_filters.parse_rule(update.message.text)
+    except ValueError as e:
+        await update.message.reply_text(f"{e}\nدوباره ارسال کنید یا /cancel بزنید."); return U_FILTER_RULE
+    account_id, user_id = context.user_data.pop('filter_account_id', None), update.effective_user.id
+    loaded = await load_account_filter_rules(account_id, user_id) if account_id else None
+    if not loaded: await update.message.reply_text("خطا: ایمیل یافت نشد یا متعلق به شما نیست."); return ConversationHandler.END
+    email_address, rules = loaded
+    if len(rules) >= email_filters.MAX_RULES_PER_ACCOUNT:
+        await update.message.reply_text(f"حداکثر {email_filters.MAX_RULES_PER_ACCOUNT} قانون برای هر حساب مجاز است."); return ConversationHandler.END
+    if rule not in rules:
+        rules.append(rule)
+        await save_account_filter_rules(account_id, user_id, rules)
+    text, reply_markup = filters_menu_content(account_id, email_address, rules)
+    await update.message.reply_text(text, reply_markup=reply_markup)
+    return ConversationHandler.END
+
+async def cancel_filter_conversation(update: Update, context: CallbackContext) -> int:
+    context.user_data.pop('filter_account_id', None)
+    await update.message.reply_text("افزودن فیلتر لغو شد.", reply_markup=get_main_keyboard())
+    return ConversationHandler.END
+
+async def digest_page_callback(update: Update, context: CallbackContext) -> None:
+    query = update.callback_query
+    _, _, digest_id, page = query.data.split('_')
+    loaded = await run_db(email_digest.load_page, db_execute, int(digest_id), query.from_user.id, int(page), DIGEST_PAGE_SIZE)
+    if not loaded: await query.answer("این خلاصه دیگر در دسترس نیست.", show_alert=True); return
+    await query.answer()
+    text, reply_markup = email_digest.render_page(*loaded, DIGEST_PAGE_SIZE)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def digest_open_callback(update: Update, context: CallbackContext) -> None:
+    """نمایش یک ایمیل از خلاصه؛ متن کامل فقط در این لحظه از Gmail گرفته می‌شود."""
+    query = update.callback_query
+    _, _, item_id, page = query.data.split('_')
+    item = await run_db(email_digest.load_item, db_execute, int(item_id), query.from_user.id)
+    if not item: await query.answer("این ایمیل دیگر در دسترس نیست.", show_alert=True); return
+    await query.answer()
+    body_text = await run_db(fetch_digest_item_body, query.from_user.id, item)
+    text, reply_markup = email_digest.render_item(item, body_text, int(page), DIGEST_EXPANDED_BODY_CHARS)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
 async def back_to_main_callback(update: Update, context: CallbackContext) -> None:
     query = update.callback_query; await query.answer()
     await query.edit_message_text("منوی اصلی:", reply_markup=get_main_keyboard())
@@ -461,7 +825,7 @@ async def set_subscription_command(update: Update, context: CallbackContext) ->
 async def received_target_user_id(update: Update, context: CallbackContext) -> int:
     try:
         target_user_id = int(update.message.text)
-        check_and_create_user(target_user_id, f"User_{target_user_id}") # اطمینان از وجود کاربر در دیتابیس
+        await run_db(check_and_create_user, target_user_id, f"User_{target_user_id}") # اطمینان از وجود کاربر در دیتابیس
         context.user_data['target_user_id'] = target_user_id
         await update.message.reply_text("مدت زمان اشتراک به روز (مثلاً 30، 90، 365) یا 0 برای حذف/نامحدود وارد کنید:", reply_markup=ForceReply(selective=True, input_field_placeholder="تعداد روز (0 برای نامحدود)"))
         return A_SUB_DAYS
@@ -495,10 +859,8 @@ async def received_monthly_quota(update: Update, context: CallbackContext) -> in
         new_expiry_timestamp = None
         if sub_days > 0:
             new_expiry_timestamp = int((datetime.now(timezone.utc) + timedelta(days=sub_days)).timestamp())
-        db_execute(
-            "UPDATE users SET subscription_expiry_timestamp = %s, max_allowed_emails = %s, monthly_email_quota = %s WHERE telegram_id = %s",
-            (new_expiry_timestamp, max_allowed_emails, monthly_q, target_user_id), commit=True
-        )
+        await run_db(set_user_subscription, target_user_id, new_expiry_timestamp, max_allowed_emails, monthly_q)
+        email_poll_refresh_event.set() # حساب‌های پارک شده کاربر پس از تمدید اشتراک دوباره زمان‌بندی شوند
         expiry_text = f"تا {datetime.fromtimestamp(new_expiry_timestamp, timezone.utc).strftime('%Y-%m-%d %H:%M UTC')}" if new_expiry_timestamp else "نامحدود/حذف شد"
         await update.message.reply_text(
             f"✅ اشتراک کاربر {target_user_id} به‌روزرسانی شد:\n"
@@ -513,6 +875,140 @@ async def received_monthly_quota(update: Update, context: CallbackContext) -> in
     finally: context.user_data.clear()
     return ConversationHandler.END
 
+# --- دستور ادمین: /bulk_subscriptions ---
+async def bulk_subscriptions_command(update: Update, context: CallbackContext) -> int:
+    if not is_user_admin(update.effective_user.id):
+        await update.message.reply_text("شما اجازه استفاده از این دستور را ندارید."); return ConversationHandler.END
+    await update.message.reply_text(
+        "فایل CSV یا JSON اشتراک‌ها را ارسال کنید (یا /cancel).\n"
+        "ستون‌ها: telegram_id,days,max_emails,quota\n"
+        "▫️ days=0 یعنی بدون انقضا و quota=0 یعنی سهمیه نامحدود (مانند /set_subscription).\n"
+        "▫️ JSON: آرایه‌ای از اشیا با همین کلیدها یا یک شیء در هر خط."
+    )
+    return A_BULK_FILE
+
+def invalidate_user_profiles(telegram_ids: list):
+    for telegram_id in telegram_ids: invalidate_user_profile(telegram_id)
+
+async def received_bulk_subscriptions_file(update: Update, context: CallbackContext) -> int:
+    document = update.message.document
+    file_name = document.file_name or ""
+    if not file_name.lower().endswith(('.csv', '.json', '.jsonl')):
+        await update.message.reply_text("فقط فایل‌های .csv، .json یا .jsonl پذیرفته می‌شوند. دوباره ارسال کنید یا /cancel بزنید."); return A_BULK_FILE
+    if document.file_size and document.file_size > BULK_SUBSCRIPTION_MAX_FILE_BYTES:
+        await update.message.reply_text(f"حجم فایل بیش از {BULK_SUBSCRIPTION_MAX_FILE_BYTES // (1024 * 1024)}MB است. فایل را تقسیم کنید."); return A_BULK_FILE
+    status_message = await update.message.reply_text("در حال پردازش فایل...")
+    try:
+        # فایل‌های کوچک در حافظه و بزرگ‌تر روی دیسک نگه داشته و ردیف به ردیف خوانده می‌شوند
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as spooled_file:
+            await (await document.get_file()).download_to_memory(out=spooled_file)
+            spooled_file.seek(0)
+            report = await run_db(
+                bulk_subscriptions.import_subscriptions, spooled_file, file_name,
+                lambda: get_db_connection(db_name=MYSQL_DATABASE_NAME_ENV), ADMIN_TELEGRAM_IDS,
+                chunk_size=BULK_SUBSCRIPTION_CHUNK_SIZE, on_chunk_applied=invalidate_user_profiles
+            )
+    except Exception as e:
+        logger.error(f"Bulk subscription import of '{file_name}' failed: {e}")
+        await status_message.edit_text(f"خطا در پردازش فایل: {e}"); return ConversationHandler.END
+    if report['applied']: email_poll_refresh_event.set() # حساب‌های پارک شده کاربران تمدید شده دوباره زمان‌بندی شوند
+    logger.info(f"Bulk subscription import of '{file_name}' by {update.effective_user.id}: {report}")
+    summary = (f"📋 نتیجه اعمال گروهی اشتراک ({file_name}):\n"
+               f"▫️ ردیف‌های خوانده شده: {report['rows']}\n"
+               f"▫️ اعمال شده: {report['applied']} (در {report['chunks']} تراکنش)\n"
+               f"▫️ نامعتبر: {report['invalid']}\n"
+               f"▫️ تکراری (آخرین ردیف اعمال شد): {report['duplicates']}\n"
+               f"▫️ ناموفق در پایگاه داده: {report['failed']}")
+    if report['errors']:
+        summary += "\n\nخطاها (ردیف: توضیح):\n" + "\n".join(report['errors'])
+        if report['errors_omitted']: summary += f"\n... و {report['errors_omitted']} خطای دیگر"
+    await status_message.edit_text(summary[:4096])
+    return ConversationHandler.END
+
+# --- دستور ادمین: /stats ---
+def load_admin_stats() -> dict:
+    """خواندن آمار پیش‌محاسبه شده (admin_stats.py)؛ هیچ‌کدام از کوئری‌ها جداول users یا connected_oauth_emails را نمی‌خوانند."""
+    counters = db_execute("SELECT name, value FROM stats_counters", fetchall=True) or []
+    expiry_rows = db_execute("SELECT expiry_day, users FROM subscription_expiry_days WHERE users <> 0", fetchall=True) or []
+    snapshots = db_execute("SELECT name, payload, updated_at FROM stats_snapshots", fetchall=True) or []
+    return {
+        'counters': {row['name']: row['value'] for row in counters},
+        'expiry_rows': expiry_rows,
+        'snapshots': {row['name']: (json.loads(row['payload']), row['updated_at']) for row in snapshots},
+    }
+
+def rebuild_admin_stats():
+    """بازسازی کامل شمارنده‌ها از جداول در یک تراکنش (/stats rebuild)، برای اصلاح انحراف احتمالی."""
+    conn = get_db_connection(db_name=MYSQL_DATABASE_NAME_ENV)
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        admin_stats.rebuild_counters(cursor.execute)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        if cursor: cursor.close()
+        conn.close()
+
+def format_age(seconds: int) -> str:
+    if seconds < 120: return f"{seconds} ثانیه پیش"
+    if seconds < 7200: return f"{seconds // 60} دقیقه پیش"
+    return f"{seconds // 3600} ساعت پیش"
+
+def format_admin_stats(stats: dict, now_timestamp: int) -> str:
+    counters = stats['counters']
+    summary = admin_stats.subscription_summary(stats['expiry_rows'], now_timestamp)
+    lines = [
+        "📊 آمار ربات:",
+        f"👥 کاربران: {counters.get(admin_stats.USERS_TOTAL, 0)}",
+        f"▫️ اشتراک فعال: {summary['active']} | بدون انقضا: {summary['no_expiry']}",
+        f"▫️ انقضا امروز: {summary['expiring_today']} | منقضی شده: {summary['expired']}",
+        "",
+        "📧 حساب‌های متصل (فعال / کل):",
+    ]
+    providers = sorted(name.split(':', 1)[1] for name in counters if name.startswith('accounts_total:'))
+    for provider in providers:
+        lines.append(f"▫️ {provider}: {counters.get(admin_stats.accounts_active_counter(provider), 0)} / {counters[admin_stats.accounts_total_counter(provider)]}")
+    if not providers: lines.append("▫️ هیچ حسابی متصل نیست.")
+    quota_payload, quota_updated_at = stats['snapshots'].get(admin_stats.QUOTA_DISTRIBUTION_SNAPSHOT, ({}, 0))
+    lines.append("")
+    if quota_updated_at:
+        lines.append(f"📈 مصرف سهمیه ماهانه ({format_age(now_timestamp - quota_updated_at)}):")
+        for bucket in admin_stats.QUOTA_BUCKETS:
+            label = "نامحدود" if bucket == 'unlimited' else f"{bucket}%"
+            lines.append(f"▫️ {label}: {quota_payload.get(bucket, 0)}")
+    else:
+        lines.append("📈 مصرف سهمیه: هنوز توسط پردازه واکشی محاسبه نشده است.")
+    fetch_windows = sorted(
+        (name[len(admin_stats.FETCH_CYCLE_SNAPSHOT_PREFIX):], payload, updated_at)
+        for name, (payload, updated_at) in stats['snapshots'].items() if name.startswith(admin_stats.FETCH_CYCLE_SNAPSHOT_PREFIX)
+    )
+    if fetch_windows:
+        lines.append("")
+        lines.append("🔄 آخرین پنجره واکشی هر پردازه:")
+        for worker_id, payload, updated_at in fetch_windows:
+            lines.append(
+                f"▫️ {worker_id} ({format_age(now_timestamp - updated_at)}): {payload.get('accounts', 0)} بررسی در "
+                f"{payload.get('wall_seconds', 0):.0f} ثانیه، {payload.get('scheduled_accounts', 0)} حساب زمان‌بندی شده، "
+                f"بیشترین تأخیر {payload.get('max_lag_seconds', 0):.1f} ثانیه"
+            )
+    return "\n".join(lines)
+
+async def stats_command(update: Update, context: CallbackContext) -> None:
+    if not is_user_admin(update.effective_user.id):
+        await update.message.reply_text("شما اجازه استفاده از این دستور را ندارید."); return
+    if context.args and context.args[0].lower() == 'rebuild':
+        try:
+            await run_db(rebuild_admin_stats)
+        except Exception as e:
+            logger.error(f"Rebuilding admin stats failed: {e}")
+            await update.message.reply_text(f"خطا در بازسازی آمار: {e}"); return
+        logger.info(f"Admin stats counters rebuilt by {update.effective_user.id}.")
+    stats = await run_db(load_admin_stats)
+    await update.message.reply_text(format_admin_stats(stats, int(datetime.now(timezone.utc).timestamp()))[:4096])
+
 async def cancel_admin_conversation(update: Update, context: CallbackContext) -> int:
     user = update.effective_user
     if is_user_admin(user.id): await update.message.reply_text("عملیات ادمین لغو شد.")
@@ -520,12 +1016,42 @@ async def cancel_admin_conversation(update: Update, context: CallbackContext) ->
     return ConversationHandler.END
 
 # --- واکشی ایمیل در پس‌زمینه (مفهومی و بازآوری توکن) ---
-def refresh_google_token_if_needed(user_telegram_id: int, account_db_id: int) -> str | None:
-    """بازآوری توکن دسترسی گوگل با استفاده از توکن بازآوری ذخیره شده در دیتابیس."""
-    account_row = db_execute(
-        "SELECT encrypted_refresh_token, email_address FROM connected_oauth_emails WHERE id = %s AND user_telegram_id = %s",
-        (account_db_id, user_telegram_id), fetchone=True
-    )
+GOOGLE_TOKEN_URI = "https://oauth2.googleapis.com/token"
+google_http_session = requests.Session() # اتصال keep-alive به endpoint توکن گوگل
+
+# توکن‌های دسترسی رمزگشایی شده: account id -> (access_token, token_expiry_timestamp)
+access_token_cache = TTLCache(maxsize=ACCESS_TOKEN_CACHE_MAX_ENTRIES, ttl_seconds=3600)
+metrics.register_stats_collectors(
+    "mailtotelbot_access_token_cache", "Access token cache", access_token_cache.stats,
+    counter_keys=('hits', 'misses', 'evictions', 'expirations', 'invalidations')
+)
+# بازآوری‌های در جریان: account id -> threading.Event (حداکثر یک بازآوری هم‌زمان برای هر حساب)
+token_refresh_inflight = {}
+token_refresh_inflight_lock = threading.Lock()
+# بازآوری‌های ناموفق پیاپی: account id -> (تعداد خطا، زمان مجاز تلاش بعدی)؛ با خطای موقت گوگل طوفان تلاش مجدد ایجاد نمی‌شود
+token_refresh_failures = {}
+
+def note_token_refresh_failure(account_db_id: int):
+    """ثبت بازآوری ناموفق و تعیین زمان تلاش بعدی با تأخیر نمایی (و کمی jitter تا حساب‌ها هم‌زمان تلاش نکنند)."""
+    with token_refresh_inflight_lock:
+        failures = token_refresh_failures.get(account_db_id, (0, 0))[0] + 1
+        delay = min(TOKEN_REFRESH_MAX_BACKOFF_SECONDS, TOKEN_REFRESH_RETRY_SECONDS * 2 ** min(failures - 1, 16))
+        token_refresh_failures[account_db_id] = (failures, time.time() + random.uniform(0.8, 1.0) * delay)
+
+def token_refresh_retry_at(account_db_id: int) -> float:
+    """زمانی که بازآوری بعدی این حساب مجاز است (0 اگر خطای اخیری ثبت نشده باشد)."""
+    return token_refresh_failures.get(account_db_id, (0, 0))[1]
+
+def refresh_google_token_if_needed(user_telegram_id: int, account_db_id: int, account_row: dict = None) -> str | None:
+    """بازآوری توکن دسترسی گوگل با استفاده از توکن بازآوری ذخیره شده در دیتابیس.
+
+    اگر account_row (شامل encrypted_refresh_token و email_address) داده شود، ردیف دوباره از پایگاه داده خوانده نمی‌شود.
+    """
+    if not account_row or 'encrypted_refresh_token' not in account_row:
+        account_row = db_execute(
+            "SELECT encrypted_refresh_token, email_address FROM connected_oauth_emails WHERE id = %s AND user_telegram_id = %s",
+            (account_db_id, user_telegram_id), fetchone=True
+        )
     if not account_row or not account_row['encrypted_refresh_token']:
         logger.warning(f"No refresh token found for user {user_telegram_id}, account_id {account_db_id} to refresh.")
         return None
@@ -536,104 +1062,1088 @@ def refresh_google_token_if_needed(user_telegram_id: int, account_db_id: int) ->
         return None
     if not GOOGLE_CLIENT_ID or not GOOGLE_CLIENT_SECRET:
         logger.error("Google Client ID or Secret not configured for token refresh."); return None
-    token_uri = "https://oauth2.googleapis.com/token"
     payload = {
         'client_id': GOOGLE_CLIENT_ID, 'client_secret': GOOGLE_CLIENT_SECRET,
         'refresh_token': refresh_token, 'grant_type': 'refresh_token'
     }
     try:
         logger.info(f"Attempting to refresh token for user {user_telegram_id}, email {email_address}")
-        response = requests.post(token_uri, data=payload, timeout=10)
+        response = google_http_session.post(GOOGLE_TOKEN_URI, data=payload, timeout=10)
         response.raise_for_status()
         token_data = response.json()
         new_access_token, new_expires_in = token_data.get('access_token'), token_data.get('expires_in')
         if not new_access_token or new_expires_in is None:
-            logger.error(f"Failed to get new access token from refresh response for {email_address}: {token_data}"); return None
+            logger.error(f"Failed to get new access token from refresh response for {email_address}: {token_data}")
+            note_token_refresh_failure(account_db_id)
+            TOKEN_REFRESHES.inc(1, 'failed'); return None
         new_encrypted_access_token = encrypt_data(new_access_token)
         new_token_expiry_timestamp = int(datetime.now(timezone.utc).timestamp()) + new_expires_in
         db_execute(
             "UPDATE connected_oauth_emails SET encrypted_access_token = %s, token_expiry_timestamp = %s WHERE id = %s",
             (new_encrypted_access_token, new_token_expiry_timestamp, account_db_id), commit=True
         )
+        access_token_cache.set(account_db_id, (new_access_token, new_token_expiry_timestamp), ttl_seconds=new_expires_in)
+        token_refresh_failures.pop(account_db_id, None)
         logger.info(f"Successfully refreshed access token for user {user_telegram_id}, email {email_address}")
+        TOKEN_REFRESHES.inc(1, 'success')
         return new_access_token # برگرداندن توکن جدید رمزگشایی شده
     except requests.exceptions.RequestException as e:
         logger.error(f"HTTP error during token refresh for {email_address}: {e}")
+        revoked = False
         if e.response is not None:
             logger.error(f"Refresh token error response: {e.response.text}")
             if "invalid_grant" in e.response.text.lower() or "token has been expired or revoked" in e.response.text.lower():
                 logger.warning(f"Refresh token for {email_address} is invalid/revoked. Disabling account.")
-                db_execute("UPDATE connected_oauth_emails SET is_active = FALSE WHERE id = %s", (account_db_id,), commit=True)
+                if db_execute("UPDATE connected_oauth_emails SET is_active = FALSE WHERE id = %s AND is_active = TRUE", (account_db_id,), commit=True, row_count=True):
+                    admin_stats.add_to_counters(stats_execute, {admin_stats.accounts_active_counter('google'): -1})
+                access_token_cache.invalidate(account_db_id)
+                token_refresh_failures.pop(account_db_id, None) # حساب غیرفعال شد؛ اتصال دوباره با توکن تازه شروع می‌شود
+                revoked = True
+        if not revoked: note_token_refresh_failure(account_db_id)
+        TOKEN_REFRESHES.inc(1, 'revoked' if revoked else 'failed')
         return None
-    except Exception as e: logger.error(f"Unexpected error during token refresh for {email_address}: {e}"); return None
+    except Exception as e:
+        logger.error(f"Unexpected error during token refresh for {email_address}: {e}")
+        note_token_refresh_failure(account_db_id)
+        TOKEN_REFRESHES.inc(1, 'failed'); return None
 
-def fetch_emails_for_account(user_telegram_id: int, account_details: dict, bot_instance_ref):
-    """مفهومی: واکشی ایمیل‌ها برای یک حساب متصل شده با OAuth."""
+def refresh_google_token_single_flight(user_telegram_id: int, account_db_id: int, account_row: dict = None, wait_timeout: float = 30) -> str | None:
+    """بازآوری توکن با تضمین حداکثر یک درخواست هم‌زمان برای هر حساب؛ فراخوانی‌های هم‌زمان منتظر نتیجه همان درخواست می‌مانند."""
+    with token_refresh_inflight_lock:
+        refresh_done = token_refresh_inflight.get(account_db_id)
+        is_leader = refresh_done is None
+        if is_leader:
+            refresh_done = token_refresh_inflight[account_db_id] = threading.Event()
+    if not is_leader:
+        refresh_done.wait(wait_timeout)
+        cached = access_token_cache.get(account_db_id)
+        return cached[0] if cached else None
+    try:
+        if token_refresh_retry_at(account_db_id) > time.time(): # در دوره تأخیر پس از خطای اخیر
+            logger.debug(f"Token refresh for account {account_db_id} backing off after recent failures.")
+            return None
+        return refresh_google_token_if_needed(user_telegram_id, account_db_id, account_row)
+    finally:
+        with token_refresh_inflight_lock:
+            token_refresh_inflight.pop(account_db_id, None)
+        refresh_done.set()
+
+def get_valid_access_token(user_telegram_id: int, account_details: dict) -> str | None:
+    """توکن دسترسی معتبر حساب؛ ابتدا از کش حافظه، سپس با رمزگشایی مقدار ذخیره شده و در آخر با بازآوری."""
+    current_ts = int(datetime.now(timezone.utc).timestamp())
+    account_db_id = account_details['id']
+    cached = access_token_cache.get(account_db_id)
+    if cached and cached[1] > current_ts + 120:
+        return cached[0]
+    token_expiry_ts = account_details['token_expiry_timestamp']
+    if token_expiry_ts and token_expiry_ts > current_ts + 120: # بازآوری اگر منقضی شده یا تا 2 دقیقه دیگر منقضی می‌شود
+        access_token = decrypt_data(account_details['encrypted_access_token'])
+        if access_token:
+            access_token_cache.set(account_db_id, (access_token, token_expiry_ts), ttl_seconds=token_expiry_ts - current_ts)
+            return access_token
+    logger.info(f"Access token for {account_details['email_address']} expired or needs refresh. Attempting.")
+    return refresh_google_token_single_flight(user_telegram_id, account_db_id, account_details)
+
+def token_refresh_scheduler_loop():
+    """توکن‌های حساب‌های اجاره شده توسط همین پردازه را پیش از انقضا (به ترتیب زمان انقضا در یک صف اولویت) بازآوری می‌کند تا مسیر واکشی منتظر بازآوری نماند."""
+    refresh_executor = ThreadPoolExecutor(max_workers=max(1, TOKEN_REFRESH_WORKERS), thread_name_prefix="token_refresh")
+    refresh_heap = [] # (refresh_at, account id, ردیف حساب شامل توکن بازآوری رمزنگاری شده)
+    scheduled_refresh_at = {} # account id -> refresh_at معتبر؛ ورودی‌های قدیمی‌تر heap نادیده گرفته می‌شوند
+    next_scan_at = 0
+    while True:
+        now = time.time()
+        if now >= next_scan_at:
+            try:
+                expiring_rows = db_execute(
+                    """SELECT coe.id, coe.user_telegram_id, coe.email_address, coe.encrypted_refresh_token, coe.token_expiry_timestamp
+                       FROM connected_oauth_emails coe
+                       JOIN users u ON coe.user_telegram_id = u.telegram_id
+                       WHERE coe.lease_owner = %s AND coe.is_active = TRUE AND coe.encrypted_refresh_token IS NOT NULL
+                         AND (coe.token_expiry_timestamp IS NULL OR coe.token_expiry_timestamp < %s)
+                         AND (u.subscription_expiry_timestamp IS NULL OR u.subscription_expiry_timestamp > %s)""",
+                    (FETCH_WORKER_ID, int(now) + TOKEN_REFRESH_SCAN_SECONDS + TOKEN_REFRESH_MARGIN_SECONDS, int(now)), fetchall=True
+                ) or []
+                for row in expiring_rows:
+                    refresh_at = max((row['token_expiry_timestamp'] or 0) - TOKEN_REFRESH_MARGIN_SECONDS, token_refresh_retry_at(row['id']))
+                    if scheduled_refresh_at.get(row['id']) != refresh_at:
+                        scheduled_refresh_at[row['id']] = refresh_at
+                        heapq.heappush(refresh_heap, (refresh_at, row['id'], row))
+            except Exception as e: logger.error(f"Error scanning expiring tokens: {e}")
+            next_scan_at = now + TOKEN_REFRESH_SCAN_SECONDS
+        while refresh_heap and refresh_heap[0][0] <= now:
+            refresh_at, account_db_id, account_row = heapq.heappop(refresh_heap)
+            if scheduled_refresh_at.get(account_db_id) != refresh_at: continue
+            del scheduled_refresh_at[account_db_id]
+            refresh_executor.submit(refresh_google_token_single_flight, account_row['user_telegram_id'], account_db_id, account_row)
+        wake_at = min(refresh_heap[0][0], next_scan_at) if refresh_heap else next_scan_at
+        time.sleep(min(max(0.5, wake_at - time.time()), TOKEN_REFRESH_SCAN_SECONDS))
+
+# همه پیام‌های خروجی ایمیل (و کارهای ارسال پیوست) از این صف عبور می‌کنند؛ ارسال روی حلقه رویداد ربات انجام می‌شود
+delivery_queue = TelegramDeliveryQueue(
+    db_execute, run_db,
+    global_rate_per_second=DELIVERY_GLOBAL_RATE_PER_SECOND,
+    per_chat_rate_per_second=DELIVERY_PER_CHAT_RATE_PER_SECOND,
+    per_chat_burst=DELIVERY_PER_CHAT_BURST,
+    coalesce_max_chars=DELIVERY_COALESCE_MAX_CHARS,
+    poll_seconds=DELIVERY_POLL_SECONDS,
+    attachment_sender=lambda chat_id, job, caption: send_outbox_attachment(chat_id, job, caption),
+    max_concurrent_uploads=DELIVERY_MAX_CONCURRENT_UPLOADS,
+)
+delivery_task = None
+metrics.register_stats_collectors(
+    "mailtotelbot_delivery", "Telegram delivery queue", delivery_queue.stats,
+    counter_keys=('enqueued', 'sent_messages', 'sent_items', 'retry_after', 'retries', 'dropped')
+)
+# بایت‌های پیوست هنگام ارسال از صف، جریانی از Gmail خوانده و بدون نگه داشتن کل فایل در حافظه آپلود می‌شوند
+document_sender = TelegramDocumentSender(TELEGRAM_BOT_TOKEN)
+attachment_max_bytes = min(EMAIL_ATTACHMENT_MAX_BYTES, TELEGRAM_UPLOAD_MAX_BYTES)
+metrics.register_stats_collectors(
+    "mailtotelbot_attachments", "Forwarded email attachments", document_sender.stats,
+    counter_keys=('sent', 'errors', 'bytes_sent')
+)
+metrics.register_stats_collectors(
+    "mailtotelbot_gmail_batch", "Gmail batch requests", lambda: dict(gmail_client.batch_stats),
+    counter_keys=('batches', 'messages', 'failed_items', 'seconds_total')
+)
+
+# --- رویدادهای تکمیل OAuth ---
+# redirect handler (یا webhook_server) پس از ذخیره حساب یک ردیف در oauth_completion_events درج می‌کند و ربات پیام اتصال را ویرایش می‌کند؛
+# جدول فقط تا وقتی کاربری اتصال در جریان دارد بررسی می‌شود: هر کاربر پس از تحویل پیام اتصالش یا پس از
+# OAUTH_COMPLETION_WATCH_SECONDS از فهرست انتظار خارج می‌شود و فاصله بررسی‌های بی‌نتیجه تا OAUTH_COMPLETION_MAX_POLL_SECONDS بیشتر می‌شود.
+# در حالت webhook، redirect همین پردازه حلقه را بی‌درنگ بیدار می‌کند و بررسی دوره‌ای فقط پشتیبان است.
+oauth_completion_wakeup = asyncio.Event()
+oauth_completion_pending = {} # telegram_id -> پایان بازه انتظار (monotonic)
+oauth_completion_task = None
+
+def watch_oauth_completions(telegram_id: int, seconds: float = OAUTH_COMPLETION_WATCH_SECONDS):
+    """افزودن کاربر به فهرست انتظار رویداد تکمیل اتصال؛ باید روی حلقه رویداد ربات فراخوانی شود."""
+    oauth_completion_pending[telegram_id] = time.monotonic() + seconds
+    oauth_completion_wakeup.set()
+
+def prune_oauth_completion_watches() -> bool:
+    """حذف کاربرانی که بازه انتظارشان گذشته است؛ True اگر هنوز کاربری منتظر باشد."""
+    now = time.monotonic()
+    for telegram_id in [t for t, watch_until in oauth_completion_pending.items() if watch_until <= now]:
+        del oauth_completion_pending[telegram_id]
+    return bool(oauth_completion_pending)
+
+async def deliver_oauth_completions(bot) -> int:
+    """ویرایش پیام‌های اتصال برای رویدادهای ثبت شده و حذف رویدادهای پردازش شده؛ تعداد رویدادهای خوانده شده را برمی‌گرداند."""
+    events = await db_execute_async(
+        "SELECT id, telegram_id, chat_id, message_id, email_address FROM oauth_completion_events ORDER BY id LIMIT 100", fetchall=True
+    ) or []
+    processed_ids = []
+    for event in events:
+        invalidate_user_profile(event['telegram_id'])
+        text = f"اتصال ایمیل {event['email_address']} با موفقیت در سیستم ثبت شد!"
+        try:
+            if event['chat_id'] and event['message_id']:
+                await bot.edit_message_text(text, chat_id=event['chat_id'], message_id=event['message_id'], reply_markup=get_main_keyboard())
+            else:
+                await bot.send_message(event['telegram_id'], text, reply_markup=get_main_keyboard())
+        except BadRequest as e: # پیام حذف یا قبلاً با دکمه بررسی ویرایش شده است
+            logger.info(f"Could not update OAuth message for user {event['telegram_id']}: {e}")
+        except (RetryAfter, NetworkError) as e: # رویدادهای باقی مانده در دور بعد دوباره ارسال می‌شوند
+            logger.warning(f"Deferring OAuth completion messages: {e}")
+            break
+        except TelegramError as e: # مثلاً ربات توسط کاربر مسدود شده است
+            logger.warning(f"Dropping OAuth completion message for user {event['telegram_id']}: {e}")
+        processed_ids.append(event['id'])
+        oauth_completion_pending.pop(event['telegram_id'], None)
+    if processed_ids:
+        email_poll_refresh_event.set()
+        placeholders = ", ".join(["%s"] * len(processed_ids))
+        await db_execute_async(f"DELETE FROM oauth_completion_events WHERE id IN ({placeholders})", tuple(processed_ids), commit=True)
+    return len(events)
+
+def oauth_state_sweeper_loop():
+    """حذف دوره‌ای ردیف‌های oauth_states که کاربر فرآیند اتصال آن‌ها را رها کرده است (redirect handler فقط ردیف‌های تکمیل شده را حذف می‌کند)."""
+    while True:
+        try:
+            expired_before = int(datetime.now(timezone.utc).timestamp()) - OAUTH_STATE_MAX_AGE_SECONDS
+            db_execute("DELETE FROM oauth_states WHERE timestamp_created < %s", (expired_before,), commit=True)
+        except Exception as e: logger.error(f"Error sweeping expired OAuth states: {e}")
+        time.sleep(OAUTH_STATE_SWEEP_SECONDS)
+
+async def oauth_completion_loop(bot):
+    """بدون کاربر منتظر فقط منتظر oauth_completion_wakeup می‌ماند؛ در غیر این صورت جدول را با فاصله‌ای از
+    OAUTH_COMPLETION_POLL_SECONDS تا OAUTH_COMPLETION_MAX_POLL_SECONDS می‌خواند (هر بیدار شدن فاصله را به حداقل برمی‌گرداند)."""
+    poll_seconds = OAUTH_COMPLETION_POLL_SECONDS
+    while True:
+        if not prune_oauth_completion_watches() and not oauth_completion_wakeup.is_set():
+            await oauth_completion_wakeup.wait()
+            poll_seconds = OAUTH_COMPLETION_POLL_SECONDS
+        oauth_completion_wakeup.clear()
+        try:
+            await deliver_oauth_completions(bot)
+        except Exception as e:
+            logger.error(f"Error delivering OAuth completion events: {e}")
+        if not prune_oauth_completion_watches(): continue
+        try:
+            await asyncio.wait_for(oauth_completion_wakeup.wait(), poll_seconds)
+            poll_seconds = OAUTH_COMPLETION_POLL_SECONDS
+        except asyncio.TimeoutError:
+            poll_seconds = min(poll_seconds * 2, max(OAUTH_COMPLETION_POLL_SECONDS, OAUTH_COMPLETION_MAX_POLL_SECONDS))
+
+# --- ارسال خلاصه ایمیل‌ها ---
+# پردازه‌های واکشی پیام‌های حساب‌های حالت خلاصه را در digest_items ذخیره می‌کنند و ربات پس از DIGEST_WINDOW_SECONDS آن‌ها را
+# در یک پیام صفحه‌بندی شده ارسال می‌کند؛ متن کامل ایمیل‌های باز شده مدتی در حافظه می‌ماند تا کلیک‌های بعدی دوباره از Gmail نخوانند
+digest_body_cache = TTLCache(maxsize=1000, ttl_seconds=600)
+email_digest_task = None
+
+def fetch_digest_item_body(user_telegram_id: int, item: dict) -> str | None:
+    """متن کامل یک ایمیل خلاصه از Gmail؛ None اگر حساب قطع شده یا دریافت ناموفق باشد."""
+    cached = digest_body_cache.get(item['id'])
+    if cached is not None: return cached
+    account_row = db_execute(
+        """SELECT id, user_telegram_id, provider, email_address, encrypted_access_token, encrypted_refresh_token, token_expiry_timestamp
+           FROM connected_oauth_emails WHERE id = %s AND user_telegram_id = %s""",
+        (item['account_id'], user_telegram_id), fetchone=True
+    )
+    if not account_row or account_row['provider'] != 'google': return None
+    access_token = get_valid_access_token(user_telegram_id, account_row)
+    if not access_token: return None
+    try:
+        message = gmail_client.get_message(access_token, item['gmail_message_id'], "full")
+    except Exception as e: # پیام حذف شده یا خطای موقت Gmail
+        logger.warning(f"Could not fetch digest message {item['gmail_message_id']} for {account_row['email_address']}: {e}")
+        return None
+    body_text = mime_pipeline.extract_body_text(
+        message, DIGEST_EXPANDED_BODY_CHARS, fetch_part_chunks=gmail_part_chunks(access_token, item['gmail_message_id'])
+    ) or message.get('snippet', '')
+    digest_body_cache.set(item['id'], body_text)
+    return body_text
+
+async def send_due_digests(bot) -> int:
+    """بستن خلاصه کاربران سررسید شده و ارسال خلاصه‌های ارسال نشده؛ تعداد خلاصه‌های ارسال شده را برمی‌گرداند."""
+    now_ts = int(datetime.now(timezone.utc).timestamp())
+    for user_id in await run_db(email_digest.due_user_ids, db_execute, DIGEST_WINDOW_SECONDS, now_ts):
+        await run_db(email_digest.create_digest, lambda: get_db_connection(db_name=MYSQL_DATABASE_NAME_ENV), user_id, now_ts)
+    sent = 0
+    for digest_row in await run_db(email_digest.unsent_digests, db_execute):
+        loaded = await run_db(email_digest.load_page, db_execute, digest_row['id'], digest_row['user_telegram_id'], 0, DIGEST_PAGE_SIZE)
+        try:
+            if loaded:
+                text, reply_markup = email_digest.render_page(*loaded, DIGEST_PAGE_SIZE)
+                await bot.send_message(digest_row['user_telegram_id'], text, reply_markup=reply_markup)
+                sent += 1
+        except RetryAfter as e: # خلاصه‌های باقی مانده در دور بعد ارسال می‌شوند
+            logger.warning(f"Telegram flood control while sending digests; retrying in {e.retry_after}s.")
+            break
+        except NetworkError as e:
+            logger.warning(f"Deferring digest {digest_row['id']} for user {digest_row['user_telegram_id']}: {e}")
+            break
+        except TelegramError as e: # مثلاً ربات توسط کاربر مسدود شده است
+            logger.warning(f"Dropping digest {digest_row['id']} for user {digest_row['user_telegram_id']}: {e}")
+        await run_db(email_digest.mark_sent, db_execute, digest_row['id'], now_ts)
+        await asyncio.sleep(1 / max(1.0, DELIVERY_GLOBAL_RATE_PER_SECOND)) # سهم صف ارسال اصلی از محدودیت سراسری تلگرام حفظ می‌شود
+    return sent
+
+async def email_digest_loop(bot):
+    next_purge_at = 0.0
+    while True:
+        try:
+            sent = await send_due_digests(bot)
+            if sent: logger.info(f"Sent {sent} email digest(s).")
+            if time.monotonic() >= next_purge_at:
+                retention_cutoff = int(datetime.now(timezone.utc).timestamp()) - DIGEST_RETENTION_DAYS * 86400
+                await run_db(email_digest.purge_old_digests, db_execute, retention_cutoff)
+                next_purge_at = time.monotonic() + 3600
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in email digest loop: {e}")
+        await asyncio.sleep(DIGEST_POLL_SECONDS)
+
+# هر حساب در هر لحظه فقط توسط یک نخ واکشی می‌شود (چرخه polling و اعلان‌های push ممکن است هم‌زمان برسند)
+account_fetch_locks = {}
+account_fetch_locks_guard = threading.Lock()
+latest_history_markers = {} # account id -> آخرین historyId ثبت شده در همین فرآیند (تازه‌تر از ردیف خوانده شده در ابتدای چرخه)
+# با از دست رفتن lease یک حساب، مدخل آن حذف می‌شود تا پس از بازگشت، marker تازه از پایگاه داده خوانده شود
+
+def get_account_fetch_lock(account_db_id: int) -> threading.Lock:
+    with account_fetch_locks_guard:
+        return account_fetch_locks.setdefault(account_db_id, threading.Lock())
+
+def format_email_notification(email_address: str, message: dict, body_text: str = None, attachments: list = None) -> str:
+    """متن پیام تلگرام برای یک ایمیل جدید (سرآیندها، فهرست پیوست‌ها و متن کوتاه شده یا snippet)؛ ممکن است از 4096 کاراکتر بلندتر باشد."""
+    preview = message.get('snippet', '')
+    if body_text:
+        preview = body_text.strip()
+        if len(preview) > EMAIL_BODY_PREVIEW_CHARS: preview = preview[:EMAIL_BODY_PREVIEW_CHARS] + "…"
+    attachment_line = ""
+    if attachments:
+        attachment_line = "📎 پیوست‌ها: " + "، ".join(
+            f"{attachment['filename']} ({mime_pipeline.format_size(attachment['size'])}"
+            f"{'، ارسال نمی‌شود' if attachment['size'] > attachment_max_bytes else ''})" for attachment in attachments
+        ) + "\n"
+    return (
+        f"📧 ایمیل جدید در {email_address}\n"
+        f"از: {gmail_client.get_header(message, 'From') or '-'}\n"
+        f"موضوع: {gmail_client.get_header(message, 'Subject') or '(بدون موضوع)'}\n"
+        f"{attachment_line}\n"
+        f"{preview}"
+    )
+
+def gmail_part_chunks(access_token: str, message_id: str):
+    """تابع fetch_part_chunks برای mime_pipeline: بایت‌های رمزگشایی شده یک بخش (attachmentId) به صورت جریانی."""
+    return lambda attachment_id: mime_pipeline.iter_json_base64_field(
+        gmail_client.iter_attachment_chunks(access_token, message_id, attachment_id)
+    )
+
+def gmail_attachment_jobs(account_db_id: int, message_id: str, attachments: list, caption: str) -> list:
+    """(caption، job) برای پیوست‌های قابل ارسال یک ایمیل، جهت ذخیره در telegram_outbox پشت پیام متنی آن.
+
+    job فقط شناسه‌ها را نگه می‌دارد (به جز پیوست‌های کوچکی که Gmail داده‌شان را درون پیام فرستاده است).
+    """
+    return [(caption, {
+        'account_id': account_db_id, 'message_id': message_id, 'attachment_id': attachment['attachment_id'],
+        'data': None if attachment['attachment_id'] else attachment['data'], 'filename': attachment['filename'], 'size': attachment['size'],
+    }) for attachment in attachments[:EMAIL_ATTACHMENTS_PER_MESSAGE]
+        # پیوست‌های بزرگ‌تر از سقف در متن پیام به عنوان «ارسال نمی‌شود» آمده‌اند
+        if attachment['size'] <= attachment_max_bytes and (attachment['attachment_id'] or attachment['data'])]
+
+def send_outbox_attachment(chat_id: int, job: dict, caption: str):
+    """ارسال یک کار پیوست از صف (در نخ ارسال پیوست): دریافت جریانی از Gmail در فایل موقت و آپلود آن.
+
+    خطاهای تلگرام به صورت خطاهای PTB به صف می‌رسند؛ خطای موقت Gmail NetworkError و پیوست غیرقابل دریافت AttachmentUnavailableError است.
+    """
+    account_row = db_execute(
+        """SELECT id, user_telegram_id, provider, email_address, encrypted_access_token, encrypted_refresh_token, token_expiry_timestamp
+           FROM connected_oauth_emails WHERE id = %s AND user_telegram_id = %s AND is_active = TRUE""",
+        (job['account_id'], chat_id), fetchone=True
+    )
+    if not account_row: raise AttachmentUnavailableError(f"account {job['account_id']} is no longer connected")
+    if job.get('data'):
+        byte_chunks = mime_pipeline.iter_base64url_chunks(job['data'])
+    else:
+        access_token = get_valid_access_token(chat_id, account_row)
+        if not access_token: raise AttachmentUnavailableError(f"no valid access token for {account_row['email_address']}")
+        byte_chunks = gmail_part_chunks(access_token, job['message_id'])(job['attachment_id'])
+    try:
+        with mime_pipeline.spool_chunks(byte_chunks, attachment_max_bytes, EMAIL_ATTACHMENT_SPOOL_BYTES) as attachment_file:
+            document_sender.upload(chat_id, attachment_file, job['filename'], caption)
+    except mime_pipeline.AttachmentTooLargeError as e: # اندازه اعلام شده در payload کمتر از واقعی بوده است
+        raise AttachmentUnavailableError(f"attachment '{job['filename']}' of message {job['message_id']}: {e}") from e
+    except requests.exceptions.HTTPError as e:
+        status_code = e.response.status_code if e.response is not None else None
+        if status_code and status_code < 500 and status_code != 429: # پیام یا پیوست حذف شده است
+            raise AttachmentUnavailableError(f"Gmail returned {status_code} for attachment of message {job['message_id']}") from e
+        raise NetworkError(f"Gmail attachment download failed: {e}") from e
+    except requests.exceptions.RequestException as e:
+        raise NetworkError(f"Gmail attachment download failed: {e}") from e
+
+def select_messages_to_forward(message_ids: list, metadata_by_id: dict) -> list:
+    """انتخاب پیام‌های قابل ارسال بر اساس metadata (به ترتیب رسیدن)؛ پیام‌های حذف شده یا اسپم کنار گذاشته می‌شوند."""
+    selected = []
+    for message_id in message_ids:
+        message = metadata_by_id.get(message_id)
+        if not message: continue # پیام در این فاصله حذف شده است
+        if {'SPAM', 'TRASH'} & set(message.get('labelIds', [])): continue
+        selected.append(message_id)
+    return selected
+
+def filter_gmail_message_ids(access_token: str, message_ids: list, message_filter: email_filters.MessageFilter) -> list:
+    """اعمال قوانین فیلتر در سمت Gmail پیش از دریافت هر پیام.
+
+    history.list پارامتر q ندارد؛ پیام‌های منطبق صندوق با messages.list (فقط شناسه‌ها، جدیدترین‌ها اول) صفحه به صفحه گرفته
+    می‌شوند تا همه شناسه‌های history دیده شوند یا نتایج تمام شوند (در این حالت شناسه‌های دیده نشده منطبق نیستند).
+    پیام‌های با تاریخ قدیمی (مثلاً وارد شده یا با تأخیر رسیده) ممکن است پایین‌تر از این پنجره باشند؛ اگر پس از
+    GMAIL_FILTER_QUERY_MAX_PAGES صفحه پوشش کامل ثابت نشود، شناسه‌های پوشش داده نشده برای matcher محلی نگه داشته می‌شوند.
+    در صورت خطا همه شناسه‌ها برمی‌گردند و فقط matcher محلی اعمال می‌شود.
+    """
+    uncovered_ids, matching_ids = set(message_ids), set()
+    try:
+        pages = gmail_client.iter_message_id_pages(access_token, f"in:inbox {message_filter.gmail_query}", len(message_ids) + 50)
+        for page_number, (page_ids, has_more) in enumerate(pages, 1):
+            for message_id in page_ids:
+                if message_id in uncovered_ids:
+                    uncovered_ids.discard(message_id)
+                    matching_ids.add(message_id)
+            if not has_more: uncovered_ids.clear() # همه نتایج جستجو دیده شده‌اند
+            if not uncovered_ids or page_number >= GMAIL_FILTER_QUERY_MAX_PAGES: break
+    except Exception as e:
+        logger.warning(f"Gmail filter query failed; falling back to local filter matching: {e}")
+        return message_ids
+    if uncovered_ids:
+        logger.info(f"Gmail filter query did not cover {len(uncovered_ids)} message(s) within {GMAIL_FILTER_QUERY_MAX_PAGES} pages; "
+                    f"matching them locally.")
+    return [message_id for message_id in message_ids if message_id in matching_ids or message_id in uncovered_ids]
+
+def collect_new_gmail_message_ids(access_token: str, account_details: dict, message_filter: email_filters.MessageFilter = None):
+    """شناسه پیام‌های جدید (در صورت وجود قوانین فیلتر، فقط پیام‌های منطبق) و historyId جدید را برمی‌گرداند.
+
+    پیام‌هایی که تا last_forwarded_message_id (پیشرفت ثبت شده واکشی قطع شده با همین marker) ارسال شده‌اند دوباره برنمی‌گردند.
+    """
+    email_address = account_details['email_address']
+    marker = latest_history_markers.get(account_details['id']) or account_details.get('last_processed_email_marker')
+    forwarded_through = account_details.get('last_forwarded_message_id') if marker == account_details.get('last_processed_email_marker') else None
+    if not marker:
+        # اولین همگام‌سازی: فقط نقطه شروع ثبت می‌شود تا صندوق قدیمی دوباره ارسال نشود
+        profile = gmail_client.get_profile(access_token)
+        logger.info(f"Initial Gmail sync for {email_address}: starting from historyId {profile['historyId']}.")
+        return [], str(profile['historyId'])
+    try:
+        message_ids, new_marker = gmail_client.list_history_message_ids(access_token, marker)
+        message_ids = gmail_client.skip_forwarded_message_ids(message_ids, forwarded_through)
+        if message_ids and message_filter: message_ids = filter_gmail_message_ids(access_token, message_ids, message_filter)
+        return message_ids, new_marker
+    except gmail_client.GmailHistoryExpiredError:
+        # history منقضی شده: همگام‌سازی کامل ولی محدود به پیام‌های خوانده نشده اخیر
+        logger.warning(f"Gmail history for {email_address} expired (marker {marker}). Running bounded full resync.")
+        profile = gmail_client.get_profile(access_token) # historyId قبل از جستجو گرفته می‌شود تا پیامی از قلم نیفتد
+        resync_query = f"in:inbox is:unread newer_than:{GMAIL_RESYNC_WINDOW_DAYS}d"
+        if message_filter: resync_query += f" {message_filter.gmail_query}"
+        message_ids = gmail_client.list_message_ids(access_token, resync_query, GMAIL_RESYNC_MAX_MESSAGES)
+        return gmail_client.skip_forwarded_message_ids(message_ids, forwarded_through), str(profile['historyId'])
+
+# --- حسابداری سهمیه ماهانه ---
+last_quota_rollover_month = None # ماهی که بازنشانی گروهی سهمیه‌ها در این فرآیند برای آن انجام شده است
+quota_release_buffer = {} # telegram_id -> تعداد سهمیه رزرو شده و استفاده نشده، منتظر بازگرداندن
+quota_release_buffer_lock = threading.Lock()
+
+def rollover_monthly_quotas_if_needed():
+    """بازنشانی سهمیه همه کاربرانی که در ماه جاری بازنشانی نشده‌اند، با یک کوئری؛ در هر ماه فقط یک بار اجرا می‌شود."""
+    global last_quota_rollover_month
+    current_month_year_str = datetime.now(timezone.utc).strftime("%Y-%m")
+    if last_quota_rollover_month == current_month_year_str: return
+    db_execute(
+        """UPDATE users SET current_month_emails_received = 0, last_quota_reset_month = %s
+           WHERE last_quota_reset_month IS NULL OR last_quota_reset_month <> %s""",
+        (current_month_year_str, current_month_year_str), commit=True
+    )
+    last_quota_rollover_month = current_month_year_str
+    user_profile_cache.clear()
+    logger.info(f"Monthly email quotas rolled over for {current_month_year_str}.")
+
+def refresh_quota_distribution_snapshot(current_timestamp: int):
+    """بازسازی توزیع مصرف سهمیه برای /stats، حداکثر یک بار در هر ADMIN_STATS_QUOTA_SNAPSHOT_SECONDS بین همه پردازه‌های واکشی.
+
+    مصرف سهمیه با رزرو هر ایمیل تغییر می‌کند؛ به جای شمارنده در آن مسیر، تصویر دوره‌ای با یک GROUP BY ساخته می‌شود.
+    پردازه‌ای که UPDATE روی updated_at را برنده شود کوئری را اجرا می‌کند.
+    """
+    claimed = db_execute(
+        "UPDATE stats_snapshots SET updated_at = %s WHERE name = %s AND updated_at <= %s",
+        (current_timestamp, admin_stats.QUOTA_DISTRIBUTION_SNAPSHOT, current_timestamp - ADMIN_STATS_QUOTA_SNAPSHOT_SECONDS),
+        commit=True, row_count=True
+    )
+    if not claimed: return
+    bucket_rows = db_execute(admin_stats.QUOTA_DISTRIBUTION_QUERY, fetchall=True)
+    if bucket_rows is None: return
+    admin_stats.save_snapshot(
+        stats_execute, admin_stats.QUOTA_DISTRIBUTION_SNAPSHOT, {row['bucket']: row['users'] for row in bucket_rows}, current_timestamp
+    )
+
+def reserve_email_quota(telegram_id: int, requested: int) -> int:
+    """رزرو اتمی سهمیه برای یک دسته پیام با یک UPDATE؛ تعداد رزرو شده (بین 0 و requested) را برمی‌گرداند.
+
+    مقدار رزرو شده از طریق LAST_INSERT_ID(expr) در همان UPDATE برگردانده می‌شود، پس بین خواندن و نوشتن رقابتی نیست.
+    """
+    if requested <= 0: return 0
+    _, reserved = db_execute(
+        """UPDATE users SET current_month_emails_received = current_month_emails_received + LAST_INSERT_ID(
+               IF(monthly_email_quota <= 0, %s, LEAST(%s, GREATEST(monthly_email_quota - current_month_emails_received, 0))))
+           WHERE telegram_id = %s""",
+        (requested, requested, telegram_id), commit=True, last_row_id=True
+    )
+    invalidate_user_profile(telegram_id)
+    return reserved or 0 # در صورت خطای پایگاه داده چیزی رزرو نمی‌شود
+
+def release_email_quota(telegram_id: int, count: int):
+    """ثبت سهمیه استفاده نشده در بافر؛ در پایان چرخه با flush_quota_releases به صورت گروهی بازگردانده می‌شود."""
+    with quota_release_buffer_lock:
+        quota_release_buffer[telegram_id] = quota_release_buffer.get(telegram_id, 0) + count
+
+def flush_quota_releases():
+    """بازگرداندن همه سهمیه‌های بافر شده با یک UPDATE."""
+    with quota_release_buffer_lock:
+        releases = dict(quota_release_buffer)
+        quota_release_buffer.clear()
+    if not releases: return
+    case_sql = ' '.join(['WHEN %s THEN %s'] * len(releases))
+    case_params = [value for item in releases.items() for value in item]
+    db_execute(
+        f"""UPDATE users SET current_month_emails_received = GREATEST(current_month_emails_received - CASE telegram_id {case_sql} ELSE 0 END, 0)
+            WHERE telegram_id IN ({', '.join(['%s'] * len(releases))})""",
+        (*case_params, *releases.keys()), commit=True
+    )
+    for telegram_id in releases: invalidate_user_profile(telegram_id)
+
+def save_forwarding_progress(account_db_id: int, message_id: str):
+    """ثبت آخرین پیام ارسال شده با marker فعلی؛ دور بعد با همان marker پیام‌های تا این شناسه را رد می‌کند (gmail_client.skip_forwarded_message_ids)."""
+    db_execute("UPDATE connected_oauth_emails SET last_forwarded_message_id = %s WHERE id = %s", (message_id, account_db_id), commit=True)
+
+def fetch_emails_for_account(user_telegram_id: int, account_details: dict, bot_instance_ref) -> dict | None:
+    """واکشی افزایشی ایمیل‌ها برای یک حساب متصل شده با OAuth و ارسال آن‌ها به کاربر.
+
+    نتیجه ({'new_messages': ...، 'quota_exhausted': ...}) برای تنظیم بازه زمان‌بند برگردانده می‌شود؛ در صورت خطا None.
+    """
     email_address = account_details['email_address']
     account_db_id = account_details['id']
     logger.info(f"Checking emails for user {user_telegram_id}, account {email_address} (ID: {account_db_id})")
-    user_subs_data = db_execute(
-        "SELECT monthly_email_quota, current_month_emails_received FROM users WHERE telegram_id = %s",
-        (user_telegram_id,), fetchone=True
-    )
-    if not user_subs_data: logger.warning(f"User {user_telegram_id} not found for email fetching."); return
-    monthly_quota, received_this_month = user_subs_data['monthly_email_quota'], user_subs_data['current_month_emails_received']
-    if monthly_quota > 0 and received_this_month >= monthly_quota:
-        logger.info(f"User {user_telegram_id} reached monthly quota ({received_this_month}/{monthly_quota}). Skipping fetch for {email_address}."); return
-    current_ts = int(datetime.now(timezone.utc).timestamp())
-    access_token = decrypt_data(account_details['encrypted_access_token'])
-    if not access_token or account_details['token_expiry_timestamp'] <= current_ts + 120: # بازآوری اگر منقضی شده یا تا 2 دقیقه دیگر منقضی می‌شود
-        logger.info(f"Access token for {email_address} expired or needs refresh. Attempting.")
-        access_token = refresh_google_token_if_needed(user_telegram_id, account_db_id)
+    # کاربرانی که سهمیه‌شان تمام شده در کوئری مجموعه کار چرخه کنار گذاشته می‌شوند؛ سهمیه دقیق هنگام رزرو بررسی می‌شود
+    access_token = get_valid_access_token(user_telegram_id, account_details)
     if not access_token:
-        logger.warning(f"No valid access token for {email_address} after attempting refresh. Skipping fetch."); return
+        logger.warning(f"No valid access token for {email_address} after attempting refresh. Skipping fetch."); return None
+    reserved_count = forwarded_count = 0
+    last_forwarded_id = saved_forwarded_id = None # پیشرفت ارسال در حالت فوری (شناسه آخرین پیام ذخیره شده در صف)
+    outcome = None
     if account_details['provider'] == 'google':
         try:
-            # --- منطق واقعی تعامل با Gmail API در اینجا قرار می‌گیرد ---
-            # از کتابخانه google-api-python-client استفاده کنید
-            logger.info(f"CONCEPTUAL: Would fetch emails for {email_address} using token. (Not implemented)")
-            # مثال:
-            # creds = Credentials(token=access_token)
-            # service = build('gmail', 'v1', credentials=creds)
-            # results = service.users().messages().list(userId='me', q='is:unread', maxResults=5).execute()
-            # messages = results.get('messages', [])
-            # for msg_summary in messages:
-            #     # پردازش هر پیام، ارسال به کاربر، به‌روزرسانی سهمیه و last_processed_email_marker
-            #     pass
+            message_filter = email_filters.compile_rules(account_details.get('filter_rules'))
+            message_ids, new_marker = collect_new_gmail_message_ids(access_token, account_details, message_filter)
+            # مرحله اول: فقط سرآیندها و snippet به صورت گروهی؛ مرحله دوم: متن کامل فقط برای پیام‌های انتخاب شده
+            metadata_by_id = gmail_client.batch_get_messages(
+                access_token, message_ids, "metadata", GMAIL_METADATA_HEADERS, GMAIL_BATCH_SIZE
+            ) if message_ids else {}
+            selected_ids = select_messages_to_forward(message_ids, metadata_by_id)
+            if message_filter: # matcher محلی برای پیام‌هایی که جستجوی سمت سرور روی آن‌ها اعمال نشده است
+                selected_ids = [message_id for message_id in selected_ids if message_filter.matches(
+                    metadata_by_id[message_id], gmail_client.get_header(metadata_by_id[message_id], 'From'),
+                    gmail_client.get_header(metadata_by_id[message_id], 'Subject')
+                )]
+            # سهمیه فقط برای پیام‌هایی رزرو می‌شود که واقعاً ارسال می‌شوند (نه هرزنامه، حذف شده یا رد شده توسط فیلتر)
+            reserved_count = reserve_email_quota(user_telegram_id, len(selected_ids)) if selected_ids else 0
+            outcome = {'new_messages': len(message_ids), 'quota_exhausted': reserved_count < len(selected_ids)}
+            if reserved_count < len(selected_ids):
+                logger.info(f"User {user_telegram_id} reached monthly quota while forwarding from {email_address}; "
+                            f"{len(selected_ids) - reserved_count} message(s) skipped.")
+                selected_ids = selected_ids[:reserved_count]
+            if account_details.get('delivery_mode') == email_digest.DELIVERY_DIGEST:
+                # حالت خلاصه: فقط سرآیندها ذخیره می‌شوند و مرحله دوم (متن کامل) تا باز شدن ایمیل در خلاصه انجام نمی‌شود
+                forwarded_count = email_digest.store_items(db_execute, user_telegram_id, account_db_id, email_address, [
+                    {'message_id': message_id, 'sender': gmail_client.get_header(metadata_by_id[message_id], 'From'),
+                     'subject': gmail_client.get_header(metadata_by_id[message_id], 'Subject'), 'snippet': metadata_by_id[message_id].get('snippet', '')}
+                    for message_id in selected_ids
+                ], int(datetime.now(timezone.utc).timestamp()))
+            else:
+                full_by_id = {}
+                for position, message_id in enumerate(selected_ids, 1):
+                    if (position - 1) % GMAIL_BATCH_SIZE == 0:
+                        # قالب full (با بدنه‌های درون پیام) فقط برای یک دسته در حافظه است و دسته قبلی پیش از آن رها می‌شود
+                        full_by_id = None
+                        full_by_id = gmail_client.batch_get_messages(
+                            access_token, selected_ids[position - 1:position - 1 + GMAIL_BATCH_SIZE], "full", batch_size=GMAIL_BATCH_SIZE
+                        ) if GMAIL_BODY_FORMAT == 'full' else {}
+                    body_text = attachments = None
+                    if message_id in full_by_id: # متن و پیوست‌های بزرگ با attachments.get به صورت جریانی خوانده می‌شوند
+                        try:
+                            body_text = mime_pipeline.extract_body_text(
+                                full_by_id[message_id], EMAIL_BODY_PREVIEW_CHARS, fetch_part_chunks=gmail_part_chunks(access_token, message_id)
+                            )
+                        except Exception as e: # در صورت خطا snippet ارسال می‌شود
+                            logger.warning(f"Could not read body of message {message_id} for {email_address}: {e}")
+                        attachments = mime_pipeline.list_attachments(full_by_id[message_id].get('payload', {})) if EMAIL_ATTACHMENT_MAX_BYTES > 0 else []
+                    full_by_id.pop(message_id, None)
+                    notification = format_email_notification(email_address, metadata_by_id[message_id], body_text, attachments)
+                    # متن و پیوست‌های یک ایمیل با یک INSERT و به همین ترتیب در صف قرار می‌گیرند
+                    delivery_queue.enqueue_many(user_telegram_id, mime_pipeline.split_text(notification), gmail_attachment_jobs(
+                        account_db_id, message_id, attachments or [],
+                        f"📎 {gmail_client.get_header(metadata_by_id[message_id], 'Subject') or email_address}"
+                    ))
+                    forwarded_count += 1
+                    last_forwarded_id = message_id
+                    if position % GMAIL_BATCH_SIZE == 0 and position < len(selected_ids):
+                        # ثبت پیشرفت پس از هر دسته تا خطا یا توقف فرآیند، پیام‌های ارسال شده را دوباره ارسال نکند
+                        save_forwarding_progress(account_db_id, last_forwarded_id)
+                        saved_forwarded_id = last_forwarded_id
+            if (new_marker != (latest_history_markers.get(account_db_id) or account_details.get('last_processed_email_marker'))
+                    or account_details.get('last_forwarded_message_id')):
+                db_execute(
+                    "UPDATE connected_oauth_emails SET last_processed_email_marker = %s, last_forwarded_message_id = NULL WHERE id = %s",
+                    (new_marker, account_db_id), commit=True
+                )
+                latest_history_markers[account_db_id] = new_marker
+            last_forwarded_id = saved_forwarded_id = None # پیشرفت در marker جدید لحاظ شده است
+            logger.info(f"Forwarded {forwarded_count} new email(s) for {email_address}; history marker now {new_marker}.")
+        except (OutboxWriteError, email_digest.DigestStoreError) as e: # marker جلو نمی‌رود تا پیام‌های ذخیره نشده در دور بعد دوباره واکشی شوند
+            logger.error(f"Stopped forwarding for {email_address} (User: {user_telegram_id}) after {forwarded_count} email(s): {e}")
         except Exception as e:
             logger.error(f"Error fetching Google emails for {email_address} (User: {user_telegram_id}): {e}")
             # مدیریت خطاهای خاص API، مثلاً اگر توکن نامعتبر شد، حساب را غیرفعال کنید
+        if last_forwarded_id != saved_forwarded_id: # قطع شدن در میانه دسته؛ پیشرفت تا آخرین پیام ذخیره شده ثبت می‌شود
+            save_forwarding_progress(account_db_id, last_forwarded_id)
+    if forwarded_count < reserved_count: # سهمیه رزرو شده برای پیام‌های ارسال نشده (یا در صورت خطا) بازگردانده می‌شود
+        release_email_quota(user_telegram_id, reserved_count - forwarded_count)
+    return outcome
+
+# سمافورهای هر ارائه‌دهنده تا یک ارائه‌دهنده همه workerها را اشغال نکند
+provider_fetch_semaphores = {
+    provider_name: threading.BoundedSemaphore(limit) for provider_name, limit in EMAIL_FETCH_PROVIDER_LIMITS.items()
+}
+fetch_executor = ThreadPoolExecutor(max_workers=max(1, EMAIL_FETCH_WORKERS), thread_name_prefix="email_fetch")
+last_fetch_cycle_stats = {} # آمار آخرین چرخه واکشی (زمان شروع، مدت، تعداد حساب‌ها و ...)
+metrics.register_stats_collectors(
+    "mailtotelbot_fetch_window", "Last fetch scheduler window", lambda: last_fetch_cycle_stats,
+    keys=('started_at', 'wall_seconds', 'accounts', 'max_account_seconds', 'sum_account_seconds', 'max_lag_seconds', 'scheduled_accounts')
+)
+
+def process_account_fetch(acc_row: dict, bot_instance_ref):
+    """واکشی ایمیل یک حساب با رعایت سقف هم‌زمانی ارائه‌دهنده. (مدت زمان پردازش، نتیجه واکشی) را برمی‌گرداند."""
+    started = time.monotonic()
+    outcome = None
+    semaphore = provider_fetch_semaphores.get(acc_row['provider'])
+    if semaphore: semaphore.acquire()
+    try:
+        with get_account_fetch_lock(acc_row['id']):
+            outcome = fetch_emails_for_account(acc_row['user_telegram_id'], acc_row, bot_instance_ref)
+    except Exception as e:
+        logger.error(f"Error processing account {acc_row.get('email_address')} (ID: {acc_row.get('id')}): {e}")
+    finally:
+        if semaphore: semaphore.release()
+    duration = time.monotonic() - started
+    ACCOUNT_FETCH_SECONDS.observe(duration, 'error' if outcome is None else 'quota_exhausted' if outcome['quota_exhausted'] else 'ok')
+    return duration, outcome
+
+def run_fetch_cycle(active_accounts_rows, bot_instance_ref, fetch_executor: ThreadPoolExecutor) -> dict:
+    """اجرای یک چرخه واکشی به صورت موازی روی fetch_executor و بازگرداندن آمار چرخه.
+
+    active_accounts_rows می‌تواند یک generator باشد؛ تعداد حساب‌های در جریان محدود است تا حافظه ثابت بماند.
+    """
+    started_at = int(datetime.now(timezone.utc).timestamp())
+    cycle_started = time.monotonic()
+    max_in_flight = max(1, EMAIL_FETCH_WORKERS) * 4
+    in_flight = deque()
+    accounts_count, max_account_seconds, sum_account_seconds = 0, 0.0, 0.0
+    def record(duration):
+        nonlocal max_account_seconds, sum_account_seconds
+        max_account_seconds = max(max_account_seconds, duration)
+        sum_account_seconds += duration
+    for acc_row in active_accounts_rows:
+        in_flight.append(fetch_executor.submit(process_account_fetch, acc_row, bot_instance_ref))
+        accounts_count += 1
+        if len(in_flight) >= max_in_flight:
+            record(in_flight.popleft().result()[0])
+    while in_flight:
+        record(in_flight.popleft().result()[0])
+    flush_quota_releases()
+    return {
+        'started_at': started_at,
+        'wall_seconds': time.monotonic() - cycle_started,
+        'accounts': accounts_count,
+        'workers': max(1, EMAIL_FETCH_WORKERS),
+        'max_account_seconds': max_account_seconds,
+        'sum_account_seconds': sum_account_seconds,
+    }
 
-def email_check_loop(application: Application):
-    """به صورت دوره‌ای ایمیل‌ها را برای تمام حساب‌های فعال با اشتراک معتبر بررسی می‌کند."""
-    bot_instance_ref = application.bot
+# ستون‌های لازم برای واکشی یک حساب (شامل سهمیه کاربر و توکن‌ها) تا در مسیر واکشی کوئری دیگری لازم نباشد
+WORK_SET_COLUMNS = """coe.id, coe.user_telegram_id, coe.provider, coe.email_address,
+                      coe.encrypted_access_token, coe.encrypted_refresh_token, coe.token_expiry_timestamp,
+                      coe.last_processed_email_marker, u.monthly_email_quota, u.current_month_emails_received,
+                      u.subscription_expiry_timestamp, coe.delivery_mode, coe.filter_rules, coe.last_forwarded_message_id"""
+
+# شرط حساب‌های قابل واکشی: فعال، با اشتراک معتبر و سهمیه باقی مانده (یک پارامتر: زمان فعلی)
+FETCHABLE_ACCOUNT_CONDITIONS = """coe.is_active = TRUE
+                  AND (u.subscription_expiry_timestamp IS NULL OR u.subscription_expiry_timestamp > %s)
+                  AND (u.monthly_email_quota <= 0 OR u.current_month_emails_received < u.monthly_email_quota)"""
+
+def iter_active_accounts(current_timestamp: int, page_size: int = EMAIL_FETCH_PAGE_SIZE, lease_owner: str = None,
+                         columns: str = WORK_SET_COLUMNS):
+    """حساب‌های فعال قابل واکشی را صفحه به صفحه (بر اساس کلید اصلی) برمی‌گرداند تا کل جدول در حافظه بارگذاری نشود.
+
+    با lease_owner فقط حساب‌هایی که lease آن‌ها در اختیار آن پردازه است برگردانده می‌شوند؛ columns باید شامل coe.id باشد.
+    """
+    lease_condition, lease_params = ("AND coe.lease_owner = %s", (lease_owner,)) if lease_owner else ("", ())
+    last_id = 0
+    while True:
+        page_rows = db_execute(
+            f"""SELECT {columns} FROM connected_oauth_emails coe
+                JOIN users u ON coe.user_telegram_id = u.telegram_id
+                WHERE coe.id > %s {lease_condition} AND {FETCHABLE_ACCOUNT_CONDITIONS}
+                ORDER BY coe.id LIMIT %s""",
+            (last_id, *lease_params, current_timestamp, page_size), fetchall=True
+        )
+        if not page_rows: return
+        yield from page_rows
+        if len(page_rows) < page_size: return
+        last_id = page_rows[-1]['id']
+
+def load_fetchable_accounts(account_ids: list, current_timestamp: int, lease_owner: str) -> dict | None:
+    """ردیف کامل (WORK_SET_COLUMNS) حساب‌های داده شده که هنوز قابل واکشی و در lease این پردازه‌اند: account_id -> ردیف؛ None در صورت خطای پایگاه داده."""
+    if not account_ids: return {}
+    rows = db_execute(
+        f"""SELECT {WORK_SET_COLUMNS} FROM connected_oauth_emails coe
+            JOIN users u ON coe.user_telegram_id = u.telegram_id
+            WHERE coe.id IN ({', '.join(['%s'] * len(account_ids))}) AND coe.lease_owner = %s AND {FETCHABLE_ACCOUNT_CONDITIONS}""",
+        (*account_ids, lease_owner, current_timestamp), fetchall=True
+    )
+    return None if rows is None else {row['id']: row for row in rows}
+
+# --- اجاره (lease) حساب‌ها بین پردازه‌های واکشی ---
+def claim_account_leases(limit: int, current_timestamp: int, lease_expires_at: int) -> int:
+    """ادعای حداکثر limit حساب قابل واکشی بدون مالک یا با lease منقضی؛ تعداد حساب‌های ادعا شده را برمی‌گرداند.
+
+    ردیف‌ها با SELECT ... FOR UPDATE SKIP LOCKED قفل می‌شوند تا پردازه‌های هم‌زمان ردیف‌های یکسانی برندارند.
+    """
+    conn = None
+    cursor = None
+    try:
+        conn = get_db_connection(db_name=MYSQL_DATABASE_NAME_ENV)
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""SELECT coe.id FROM connected_oauth_emails coe
+                JOIN users u ON coe.user_telegram_id = u.telegram_id
+                WHERE (coe.lease_owner IS NULL OR coe.lease_expires_at < %s) AND {FETCHABLE_ACCOUNT_CONDITIONS}
+                ORDER BY coe.id LIMIT %s
+                FOR UPDATE OF coe SKIP LOCKED""",
+            (current_timestamp, current_timestamp, limit)
+        )
+        account_ids = [row[0] for row in cursor.fetchall()]
+        if account_ids:
+            cursor.execute(
+                f"UPDATE connected_oauth_emails SET lease_owner = %s, lease_expires_at = %s WHERE id IN ({', '.join(['%s'] * len(account_ids))})",
+                (FETCH_WORKER_ID, lease_expires_at, *account_ids)
+            )
+        conn.commit()
+        return len(account_ids)
+    except mysql.connector.Error as err:
+        logger.error(f"MySQL error while claiming account leases: {err}")
+        if conn: conn.rollback()
+        return 0
+    finally:
+        if cursor: cursor.close()
+        if conn: conn.close()
+
+def sync_account_leases(current_timestamp: int):
+    """ثبت ضربان قلب این پردازه، تمدید leaseهای آن و تنظیم تعداد حساب‌ها به سهم عادلانه آن.
+
+    سهم هر پردازه سقف (تعداد حساب‌های قابل واکشی / تعداد پردازه‌های زنده) است؛ پردازه‌ای که بیش از سهم خود دارد
+    مازاد را آزاد می‌کند و leaseهای پردازه‌های متوقف شده پس از FETCH_LEASE_TTL_SECONDS توسط بقیه برداشته می‌شوند.
+    """
+    lease_expires_at = current_timestamp + FETCH_LEASE_TTL_SECONDS
+    db_execute(
+        "INSERT INTO fetch_workers (worker_id, heartbeat_at) VALUES (%s, %s) ON DUPLICATE KEY UPDATE heartbeat_at = VALUES(heartbeat_at)",
+        (FETCH_WORKER_ID, current_timestamp), commit=True
+    )
+    db_execute("DELETE FROM fetch_workers WHERE heartbeat_at < %s", (current_timestamp - FETCH_LEASE_TTL_SECONDS,), commit=True)
+    # تمدید leaseهای حساب‌های هنوز قابل واکشی و آزاد کردن بقیه در یک کوئری
+    db_execute(
+        f"""UPDATE connected_oauth_emails coe JOIN users u ON coe.user_telegram_id = u.telegram_id
+            SET coe.lease_expires_at = IF({FETCHABLE_ACCOUNT_CONDITIONS}, %s, NULL),
+                coe.lease_owner = IF({FETCHABLE_ACCOUNT_CONDITIONS}, coe.lease_owner, NULL)
+            WHERE coe.lease_owner = %s""",
+        (current_timestamp, lease_expires_at, current_timestamp, FETCH_WORKER_ID), commit=True
+    )
+    counts = db_execute(
+        f"""SELECT (SELECT COUNT(*) FROM fetch_workers) AS live_workers,
+                   (SELECT COUNT(*) FROM connected_oauth_emails coe JOIN users u ON coe.user_telegram_id = u.telegram_id
+                    WHERE {FETCHABLE_ACCOUNT_CONDITIONS}) AS fetchable_accounts,
+                   (SELECT COUNT(*) FROM connected_oauth_emails WHERE lease_owner = %s) AS held_accounts""",
+        (current_timestamp, FETCH_WORKER_ID), fetchone=True
+    )
+    if not counts: return
+    fair_share = -(-counts['fetchable_accounts'] // max(1, counts['live_workers']))
+    held_accounts = counts['held_accounts']
+    if held_accounts > fair_share:
+        db_execute(
+            "UPDATE connected_oauth_emails SET lease_owner = NULL, lease_expires_at = NULL WHERE lease_owner = %s ORDER BY id DESC LIMIT %s",
+            (FETCH_WORKER_ID, held_accounts - fair_share), commit=True
+        )
+        logger.info(f"Worker {FETCH_WORKER_ID} released {held_accounts - fair_share} account lease(s) to rebalance (fair share {fair_share}).")
+        return
+    while held_accounts < fair_share:
+        claimed = claim_account_leases(min(EMAIL_FETCH_PAGE_SIZE, fair_share - held_accounts), current_timestamp, lease_expires_at)
+        if not claimed: break
+        held_accounts += claimed
+        logger.info(f"Worker {FETCH_WORKER_ID} claimed {claimed} account lease(s); holding {held_accounts} of fair share {fair_share}.")
+
+def release_account_leases():
+    """آزاد کردن همه leaseهای این پردازه هنگام خاموش شدن تا پردازه‌های دیگر بلافاصله آن‌ها را بردارند."""
+    db_execute("UPDATE connected_oauth_emails SET lease_owner = NULL, lease_expires_at = NULL WHERE lease_owner = %s", (FETCH_WORKER_ID,), commit=True)
+    db_execute("DELETE FROM fetch_workers WHERE worker_id = %s", (FETCH_WORKER_ID,), commit=True)
+    logger.info(f"Worker {FETCH_WORKER_ID} released its account leases.")
+
+# --- زمان‌بند تطبیقی واکشی ---
+email_poll_refresh_event = threading.Event() # درخواست بازخوانی فوری مجموعه حساب‌ها (اتصال حساب جدید، تمدید اشتراک و ...)
+
+def next_poll_interval(current_interval: float, new_messages: int, min_interval: float, max_interval: float) -> float:
+    """بازه بررسی بعدی یک حساب: با رسیدن پیام جدید نصف می‌شود و در صندوق‌های ساکت به تدریج افزایش می‌یابد."""
+    if new_messages > 0:
+        return max(min_interval, current_interval / 2)
+    return min(max_interval, current_interval * EMAIL_POLL_BACKOFF_FACTOR)
+
+def email_check_loop(bot_instance_ref=None):
+    """زمان‌بند واکشی: هر حساب زمان سررسید و بازه مخصوص خود را دارد و در یک صف اولویت (heap) نگهداری می‌شود.
+
+    مجموعه حساب‌های قابل واکشی هر EMAIL_POLL_REFRESH_SECONDS (یا با email_poll_refresh_event) از پایگاه داده خوانده می‌شود؛
+    فقط حساب‌هایی که این پردازه lease آن‌ها را دارد زمان‌بندی می‌شوند (sync_account_leases).
+    حساب‌های کاربرانی که سهمیه ماهانه‌شان تمام شده یا اشتراکشان منقضی شده در این مجموعه نیستند و تا بازنشانی
+    ماهانه سهمیه یا تمدید اشتراک زمان‌بندی نمی‌شوند.
+    در حافظه فقط شناسه‌ها و وضعیت زمان‌بندی نگه داشته می‌شود؛ ردیف کامل (با توکن‌های رمز شده) برای هر دسته سررسید شده خوانده می‌شود.
+    """
+    global last_fetch_cycle_stats
+    # وقتی اعلان‌های push فعال است، polling فقط برای جبران اعلان‌های از دست رفته است و بازه از fallback کوتاه‌تر نمی‌شود
+    base_interval = EMAIL_PUSH_FALLBACK_INTERVAL_SECONDS if GMAIL_PUSH_TOPIC else EMAIL_FETCH_INTERVAL_SECONDS
+    min_interval = base_interval if GMAIL_PUSH_TOPIC else min(EMAIL_POLL_MIN_INTERVAL_SECONDS, base_interval)
+    max_interval = max(EMAIL_POLL_MAX_INTERVAL_SECONDS, base_interval)
+    max_in_flight = max(1, EMAIL_FETCH_WORKERS) * 4
+    account_users = {} # account_id -> user_telegram_id، فقط برای حساب‌های زمان‌بندی شده (پارک نشده)
+    poll_intervals = {} # account_id -> بازه فعلی بررسی
+    next_due = {} # account_id -> زمان سررسید معتبر؛ مدخل‌های قدیمی heap با آن مقایسه و نادیده گرفته می‌شوند
+    due_heap = [] # (due_at, account_id)
+    in_flight = {} # future -> (account_id, due_at)
+    next_refresh_at = 0.0
+    initial_load = True
+    window, window_started = None, 0.0
+
+    def schedule(account_id, due_at):
+        next_due[account_id] = due_at
+        heapq.heappush(due_heap, (due_at, account_id))
+
+    def park(account_ids):
+        for account_id in account_ids:
+            account_users.pop(account_id, None)
+            next_due.pop(account_id, None)
+            poll_intervals.pop(account_id, None)
+            latest_history_markers.pop(account_id, None)
+
+    while True:
+        try:
+            now = time.monotonic()
+            if now >= next_refresh_at or email_poll_refresh_event.is_set():
+                email_poll_refresh_event.clear()
+                if window and window['accounts']:
+                    last_fetch_cycle_stats = dict(window, wall_seconds=now - window_started, scheduled_accounts=len(account_users))
+                    logger.info(
+                        f"Fetch scheduler: {last_fetch_cycle_stats['accounts']} account polls in {last_fetch_cycle_stats['wall_seconds']:.0f}s "
+                        f"with {last_fetch_cycle_stats['workers']} workers (slowest account {last_fetch_cycle_stats['max_account_seconds']:.2f}s, "
+                        f"total account time {last_fetch_cycle_stats['sum_account_seconds']:.2f}s, max lag {last_fetch_cycle_stats['max_lag_seconds']:.1f}s)."
+                    )
+                    logger.debug(f"DB pool stats: {db_pool.stats()}")
+                    logger.debug(f"User profile cache stats: {user_profile_cache.stats()}")
+                    logger.info(f"Delivery queue stats: {delivery_queue.stats()}")
+                    admin_stats.save_snapshot(
+                        stats_execute, admin_stats.FETCH_CYCLE_SNAPSHOT_PREFIX + FETCH_WORKER_ID, last_fetch_cycle_stats,
+                        int(datetime.now(timezone.utc).timestamp())
+                    )
+                # آمار هر بازه بازخوانی، جایگزین آمار «چرخه» در حلقه قبلی
+                window, window_started = {'started_at': int(datetime.now(timezone.utc).timestamp()), 'accounts': 0,
+                          'workers': max(1, EMAIL_FETCH_WORKERS), 'max_account_seconds': 0.0, 'sum_account_seconds': 0.0, 'max_lag_seconds': 0.0}, now
+                rollover_monthly_quotas_if_needed()
+                flush_quota_releases()
+                current_timestamp = int(datetime.now(timezone.utc).timestamp())
+                refresh_quota_distribution_snapshot(current_timestamp)
+                sync_account_leases(current_timestamp)
+                fresh_users = {row['id']: row['user_telegram_id'] for row in iter_active_accounts(
+                    current_timestamp, lease_owner=FETCH_WORKER_ID, columns="coe.id, coe.user_telegram_id"
+                )}
+                park([account_id for account_id in account_users if account_id not in fresh_users])
+                running_ids = {account_id for account_id, _ in in_flight.values()}
+                for account_id, user_telegram_id in fresh_users.items():
+                    if account_id not in account_users and account_id not in running_ids:
+                        poll_intervals[account_id] = base_interval
+                        # در شروع فرآیند، بررسی‌ها در طول یک بازه پخش می‌شوند تا همه حساب‌ها هم‌زمان سررسید نشوند
+                        schedule(account_id, now + (random.uniform(0, base_interval) if initial_load else 0))
+                    account_users[account_id] = user_telegram_id
+                del fresh_users
+                initial_load = False
+                next_refresh_at = now + EMAIL_POLL_REFRESH_SECONDS
+                logger.info(f"Fetch scheduler: {len(account_users)} account(s) scheduled.")
+
+            due_batch = []
+            while due_heap and due_heap[0][0] <= now and len(in_flight) + len(due_batch) < max_in_flight:
+                due_at, account_id = heapq.heappop(due_heap)
+                if next_due.get(account_id) != due_at: continue
+                del next_due[account_id]
+                due_batch.append((account_id, due_at))
+            if due_batch:
+                # ردیف‌ها تازه خوانده می‌شوند؛ حساب غیرفعال، با اشتراک منقضی، سهمیه تمام شده یا lease از دست رفته برنمی‌گردد
+                due_rows = load_fetchable_accounts([account_id for account_id, _ in due_batch],
+                                                   int(datetime.now(timezone.utc).timestamp()), FETCH_WORKER_ID)
+                if due_rows is None: # خطای پایگاه داده: دسته کمی بعد دوباره امتحان می‌شود
+                    for account_id, _ in due_batch: schedule(account_id, now + 5)
+                    due_batch = []
+                for account_id, due_at in due_batch:
+                    acc_row = due_rows.get(account_id)
+                    if acc_row is None:
+                        park([account_id])
+                        logger.info(f"Account {account_id} is no longer fetchable by this worker; parked until the next refresh.")
+                        continue
+                    window['max_lag_seconds'] = max(window['max_lag_seconds'], now - due_at)
+                    in_flight[fetch_executor.submit(process_account_fetch, acc_row, bot_instance_ref)] = (account_id, due_at)
+                del due_rows
+
+            # اگر همه جایگاه‌ها پر باشند، تا پایان یکی از واکشی‌ها صبر می‌شود (نه تا سررسید بعدی)
+            next_wake_at = next_refresh_at if not due_heap or len(in_flight) >= max_in_flight else min(next_refresh_at, due_heap[0][0])
+            wait_seconds = max(0.0, next_wake_at - time.monotonic())
+            if in_flight:
+                done, _ = wait_for_futures(list(in_flight), timeout=wait_seconds, return_when=FIRST_COMPLETED)
+            else:
+                email_poll_refresh_event.wait(wait_seconds)
+                done = ()
+            for future in done:
+                account_id, _ = in_flight.pop(future)
+                duration, outcome = future.result()
+                window['accounts'] += 1
+                window['max_account_seconds'] = max(window['max_account_seconds'], duration)
+                window['sum_account_seconds'] += duration
+                user_telegram_id = account_users.get(account_id)
+                if user_telegram_id is None: continue # در حین واکشی پارک یا حذف شده است
+                if outcome and outcome['quota_exhausted']:
+                    park([a for a, u in account_users.items() if u == user_telegram_id])
+                    logger.info(f"User {user_telegram_id} reached monthly quota; accounts parked until the quota rolls over.")
+                    continue
+                poll_intervals[account_id] = next_poll_interval(
+                    poll_intervals.get(account_id, base_interval), outcome['new_messages'] if outcome else 0, min_interval, max_interval
+                )
+                schedule(account_id, time.monotonic() + poll_intervals[account_id])
+        except Exception as e:
+            logger.error(f"Error in email_check_loop: {e}")
+            time.sleep(5)
+
+# --- اعلان‌های push جیمیل: مصرف صف و تمدید watch ---
+def push_notification_loop(bot_instance_ref=None):
+    """اعلان‌های ذخیره شده در gmail_push_notifications برای حساب‌های اجاره شده توسط همین پردازه را مصرف کرده و آن حساب‌ها را فوراً واکشی می‌کند."""
+    next_cleanup_at = 0
     while True:
-        logger.info("Starting email check cycle...")
         try:
+            notification_rows = db_execute(
+                """SELECT DISTINCT n.id, n.email_address FROM gmail_push_notifications n
+                   JOIN connected_oauth_emails coe ON coe.email_address = n.email_address
+                   WHERE coe.provider = 'google' AND coe.lease_owner = %s
+                   ORDER BY n.id LIMIT %s""",
+                (FETCH_WORKER_ID, PUSH_QUEUE_BATCH_SIZE), fetchall=True
+            )
+            if not notification_rows:
+                if time.time() >= next_cleanup_at:
+                    # اعلان‌های حساب‌هایی که هیچ پردازه‌ای lease آن‌ها را ندارد (مثلاً سهمیه تمام شده)؛
+                    # پس از بازگشت حساب به زمان‌بند، history جیمیل این پیام‌ها را پوشش می‌دهد
+                    db_execute(
+                        "DELETE FROM gmail_push_notifications WHERE received_at < %s",
+                        (int(time.time()) - FETCH_LEASE_TTL_SECONDS,), commit=True
+                    )
+                    next_cleanup_at = time.time() + 60
+                time.sleep(PUSH_QUEUE_POLL_SECONDS); continue
+            # چند اعلان برای یک صندوق در یک واکشی ادغام می‌شوند
+            email_addresses = sorted({row['email_address'] for row in notification_rows})
+            placeholders = ', '.join(['%s'] * len(email_addresses))
+            rollover_monthly_quotas_if_needed()
             current_timestamp = int(datetime.now(timezone.utc).timestamp())
-            active_accounts_rows = db_execute(
-                """SELECT coe.* FROM connected_oauth_emails coe
-                   JOIN users u ON coe.user_telegram_id = u.telegram_id
-                   WHERE coe.is_active = TRUE 
-                     AND (u.subscription_expiry_timestamp IS NULL OR u.subscription_expiry_timestamp > %s)""",
-                (current_timestamp,), fetchall=True
+            accounts_rows = db_execute(
+                f"""SELECT {WORK_SET_COLUMNS} FROM connected_oauth_emails coe
+                    JOIN users u ON coe.user_telegram_id = u.telegram_id
+                    WHERE coe.provider = 'google' AND coe.lease_owner = %s AND coe.email_address IN ({placeholders})
+                      AND {FETCHABLE_ACCOUNT_CONDITIONS}""",
+                (FETCH_WORKER_ID, *email_addresses, current_timestamp), fetchall=True
+            )
+            if accounts_rows:
+                logger.info(f"Push: {len(notification_rows)} notification(s) for {len(email_addresses)} mailbox(es); fetching {len(accounts_rows)} account(s).")
+                run_fetch_cycle(accounts_rows, bot_instance_ref, fetch_executor)
+            # حذف اعلان‌ها فقط پس از واکشی، تا در صورت توقف فرآیند دوباره پردازش شوند
+            notification_ids = [row['id'] for row in notification_rows]
+            db_execute(
+                f"DELETE FROM gmail_push_notifications WHERE id IN ({', '.join(['%s'] * len(notification_ids))})",
+                tuple(notification_ids), commit=True
             )
-            if active_accounts_rows:
-                logger.info(f"Found {len(active_accounts_rows)} active email accounts to check.")
-                for acc_row in active_accounts_rows:
-                    check_and_reset_quota_for_user(acc_row['user_telegram_id'])
-                    fetch_emails_for_account(acc_row['user_telegram_id'], acc_row, bot_instance_ref)
-            else: logger.info("No active email accounts with valid subscriptions to check.")
-        except Exception as e: logger.error(f"Error in email_check_loop: {e}")
-        logger.info(f"Email check cycle finished. Sleeping for {EMAIL_FETCH_INTERVAL_SECONDS} seconds.")
-        time.sleep(EMAIL_FETCH_INTERVAL_SECONDS)
+        except Exception as e:
+            logger.error(f"Error in push_notification_loop: {e}")
+            time.sleep(PUSH_QUEUE_POLL_SECONDS)
 
-def run_bot():
-    """ربات را راه‌اندازی و اجرا می‌کند."""
-    # مقداردهی اولیه پایگاه داده در ابتدای اجرای ربات
-    init_db_main()
+def gmail_watch_renewal_loop():
+    """به صورت دوره‌ای watch جیمیل را برای حساب‌های اجاره شده‌ای که watch ندارند یا نزدیک انقضا هستند، ثبت/تمدید می‌کند."""
+    while True:
+        try:
+            renew_before = int(datetime.now(timezone.utc).timestamp()) + GMAIL_WATCH_RENEWAL_MARGIN_SECONDS
+            accounts_rows = db_execute(
+                """SELECT id, user_telegram_id, email_address, encrypted_access_token, token_expiry_timestamp
+                   FROM connected_oauth_emails
+                   WHERE provider = 'google' AND is_active = TRUE AND lease_owner = %s
+                     AND (gmail_watch_expiration_timestamp IS NULL OR gmail_watch_expiration_timestamp < %s)""",
+                (FETCH_WORKER_ID, renew_before), fetchall=True
+            ) or []
+            renewed = 0
+            for acc_row in accounts_rows:
+                access_token = get_valid_access_token(acc_row['user_telegram_id'], acc_row)
+                if not access_token: continue
+                try:
+                    watch_response = gmail_client.watch_mailbox(access_token, GMAIL_PUSH_TOPIC)
+                except requests.exceptions.RequestException as e:
+                    logger.error(f"Failed to renew Gmail watch for {acc_row['email_address']}: {e}"); continue
+                expiration_ts = int(watch_response['expiration']) // 1000 # گوگل زمان انقضا را به میلی‌ثانیه برمی‌گرداند
+                db_execute(
+                    "UPDATE connected_oauth_emails SET gmail_watch_expiration_timestamp = %s WHERE id = %s",
+                    (expiration_ts, acc_row['id']), commit=True
+                )
+                renewed += 1
+            if accounts_rows: logger.info(f"Gmail watch renewed for {renewed}/{len(accounts_rows)} account(s).")
+        except Exception as e: logger.error(f"Error in gmail_watch_renewal_loop: {e}")
+        time.sleep(GMAIL_WATCH_RENEWAL_CHECK_SECONDS)
+
+def start_email_fetching(bot_instance_ref=None):
+    """شروع نخ‌های پس‌زمینه واکشی (زمان‌بند، بازآوری توکن و در صورت فعال بودن push، مصرف اعلان‌ها و تمدید watch).
+
+    هم ربات و هم fetch_worker.py از این تابع استفاده می‌کنند؛ پیام‌ها از طریق telegram_outbox به ربات می‌رسند.
+    """
+    threading.Thread(target=email_check_loop, args=(bot_instance_ref,), daemon=True).start()
+    logger.info(f"Email fetching thread started (worker {FETCH_WORKER_ID}).")
+    threading.Thread(target=token_refresh_scheduler_loop, daemon=True).start()
+    logger.info("Token refresh scheduler started.")
+    if GMAIL_PUSH_TOPIC:
+        threading.Thread(target=push_notification_loop, args=(bot_instance_ref,), daemon=True).start()
+        threading.Thread(target=gmail_watch_renewal_loop, daemon=True).start()
+        logger.info(f"Gmail push notifications enabled (topic {GMAIL_PUSH_TOPIC}); polling fallback every {EMAIL_PUSH_FALLBACK_INTERVAL_SECONDS}s.")
+
+async def on_application_startup(application: Application) -> None:
+    """پس از راه‌اندازی برنامه: شروع صف ارسال پیام‌ها، ارسال خلاصه‌ها، رویدادهای تکمیل OAuth و نخ واکشی ایمیل در پس‌زمینه (در صورت فعال بودن)."""
+    global delivery_task, oauth_completion_task, email_digest_task
+    delivery_task = asyncio.get_running_loop().create_task(delivery_queue.run(application.bot))
+    email_digest_task = asyncio.get_running_loop().create_task(email_digest_loop(application.bot))
+    oauth_completion_task = asyncio.get_running_loop().create_task(oauth_completion_loop(application.bot))
+    oauth_completion_wakeup.set() # یک بار بررسی برای اتصال‌هایی که هنگام خاموش بودن ربات کامل شده‌اند
+    threading.Thread(target=oauth_state_sweeper_loop, name="oauth_state_sweeper", daemon=True).start()
+    if ENABLE_EMAIL_FETCHING:
+        start_email_fetching(application.bot)
+    else:
+        logger.info("Email fetching is disabled via ENABLE_EMAIL_FETCHING environment variable.")
+
+async def on_application_shutdown(application: Application) -> None:
+    """توقف صف ارسال و حذف ردیف‌های تحویل شده؛ پیام‌های باقی مانده در telegram_outbox برای اجرای بعدی می‌مانند."""
+    if delivery_task:
+        delivery_task.cancel()
+    if oauth_completion_task:
+        oauth_completion_task.cancel()
+    if email_digest_task:
+        email_digest_task.cancel()
+    await delivery_queue.flush()
+    logger.info(f"Delivery queue stopped: {delivery_queue.stats()}")
+    if ENABLE_EMAIL_FETCHING:
+        await run_db(release_account_leases)
 
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+def instrument_handlers(handlers: list) -> list:
+    """پوشش callback کنترل‌کننده‌ها (و کنترل‌کننده‌های داخل ConversationHandler) برای ثبت تأخیر و خطاهای آن‌ها.
+
+    برچسب متریک الگوی callback_data، نام دستور یا نام تابع است تا تعداد مقادیر برچسب محدود بماند.
+    """
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points + handler.fallbacks + [h for hs in handler.states.values() for h in hs])
+            continue
+        if isinstance(handler, CallbackQueryHandler) and handler.pattern is not None:
+            label = getattr(handler.pattern, 'pattern', str(handler.pattern))
+        elif isinstance(handler, CommandHandler):
+            label = '/' + sorted(handler.commands)[0]
+        else:
+            label = getattr(handler.callback, '__name__', 'handler')
+        handler.callback = timed_handler_callback(handler.callback, label)
+    return handlers
+
+def timed_handler_callback(callback, label: str):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(1, label)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, label)
+    return wrapper
+
+def build_application(builder=None) -> Application:
+    """ساخت Application با همه کنترل‌کننده‌ها؛ builder سفارشی (مثلاً با base_url سرور جایگزین در benchmark.py) اختیاری است."""
+    builder = builder or Application.builder().token(TELEGRAM_BOT_TOKEN)
+    application = builder.post_init(on_application_startup).post_shutdown(on_application_shutdown).build()
 
     # کنترل‌کننده مکالمه برای دستور ادمین
     admin_conv_handler = ConversationHandler(
@@ -646,28 +2156,71 @@ def run_bot():
         },
         fallbacks=[CommandHandler('cancel', cancel_admin_conversation, filters=filters.ChatType.PRIVATE)],
     )
+    bulk_subscriptions_conv_handler = ConversationHandler(
+        entry_points=[CommandHandler("bulk_subscriptions", bulk_subscriptions_command, filters=filters.ChatType.PRIVATE)],
+        states={
+            A_BULK_FILE: [MessageHandler(filters.Document.ALL & filters.ChatType.PRIVATE, received_bulk_subscriptions_file)],
+        },
+        fallbacks=[CommandHandler('cancel', cancel_admin_conversation, filters=filters.ChatType.PRIVATE)],
+    )
 
-    application.add_handler(CommandHandler("start", start_command, filters=filters.ChatType.PRIVATE))
-    application.add_handler(admin_conv_handler)
+    # ورود به مکالمه با دکمه شیشه‌ای است؛ دنبال کردن مکالمه برای هر کاربر (نه هر پیام) عمدی است
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", message="If 'per_message=False'", category=PTBUserWarning)
+        filter_rule_conv_handler = ConversationHandler(
+            entry_points=[CallbackQueryHandler(filter_add_callback, pattern='^filter_add_')],
+            states={
+                U_FILTER_RULE: [MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, received_filter_rule)],
+            },
+            fallbacks=[CommandHandler('cancel', cancel_filter_conversation, filters=filters.ChatType.PRIVATE)],
+        )
 
-    # کنترل‌کننده‌های پاسخ به دکمه‌های شیشه‌ای
-    application.add_handler(CallbackQueryHandler(account_info_callback, pattern='^account_info$'))
-    application.add_handler(CallbackQueryHandler(connect_oauth_email_init_callback, pattern='^connect_oauth_email_init$'))
-    application.add_handler(CallbackQueryHandler(check_oauth_done_callback, pattern='^check_oauth_done_'))
-    application.add_handler(CallbackQueryHandler(my_oauth_emails_callback, pattern='^my_oauth_emails$'))
-    application.add_handler(CallbackQueryHandler(toggle_email_callback, pattern='^toggle_email_'))
-    application.add_handler(CallbackQueryHandler(disconnect_email_callback, pattern='^disconnect_email_'))
-    application.add_handler(CallbackQueryHandler(back_to_main_callback, pattern='^back_to_main$'))
-    application.add_handler(CallbackQueryHandler(lambda u,c: u.callback_query.answer("این دکمه عملیاتی ندارد."), pattern='^noop_')) # برای جداکننده‌ها و غیره
+    application.add_handlers(instrument_handlers([
+        CommandHandler("start", start_command, filters=filters.ChatType.PRIVATE),
+        CommandHandler("stats", stats_command, filters=filters.ChatType.PRIVATE),
+        admin_conv_handler,
+        bulk_subscriptions_conv_handler,
+        filter_rule_conv_handler,
+        # کنترل‌کننده‌های پاسخ به دکمه‌های شیشه‌ای
+        CallbackQueryHandler(account_info_callback, pattern='^account_info$'),
+        CallbackQueryHandler(connect_oauth_email_init_callback, pattern='^connect_oauth_email_init$'),
+        CallbackQueryHandler(check_oauth_done_callback, pattern='^check_oauth_done_'),
+        CallbackQueryHandler(my_oauth_emails_callback, pattern='^my_oauth_emails$'),
+        CallbackQueryHandler(toggle_email_callback, pattern='^toggle_email_'),
+        CallbackQueryHandler(disconnect_email_callback, pattern='^disconnect_email_'),
+        CallbackQueryHandler(delivery_mode_callback, pattern='^delivery_mode_'),
+        CallbackQueryHandler(filters_menu_callback, pattern='^filters_menu_'),
+        CallbackQueryHandler(filter_delete_callback, pattern='^filter_del_'),
+        CallbackQueryHandler(digest_page_callback, pattern='^digest_page_'),
+        CallbackQueryHandler(digest_open_callback, pattern='^digest_open_'),
+        CallbackQueryHandler(back_to_main_callback, pattern='^back_to_main$'),
+        CallbackQueryHandler(lambda u,c: u.callback_query.answer("این دکمه عملیاتی ندارد."), pattern='^noop_'), # برای جداکننده‌ها و غیره
+    ]))
+    return application
 
-    # شروع نخ واکشی ایمیل در پس‌زمینه (در صورت فعال بودن)
-    if ENABLE_EMAIL_FETCHING:
-        email_thread = threading.Thread(target=email_check_loop, args=(application,), daemon=True)
-        email_thread.start()
-        logger.info("Email fetching thread started.")
-    else:
-        logger.info("Email fetching is disabled via ENABLE_EMAIL_FETCHING environment variable.")
+def run_bot():
+    """ربات را راه‌اندازی و اجرا می‌کند."""
+    # مقداردهی اولیه پایگاه داده در ابتدای اجرای ربات
+    init_db_main()
+    application = build_application()
+
+    if METRICS_PORT: metrics.start_metrics_server(METRICS_PORT, METRICS_BIND_HOST)
+    if TELEGRAM_WEBHOOK_URL:
+        import webhook_server # starlette و uvicorn فقط در حالت webhook لازم‌اند
 
+        def on_account_connected(telegram_id: int):
+            invalidate_user_profile(telegram_id)
+            email_poll_refresh_event.set()
+            oauth_completion_wakeup.set() # رویداد همین الان درج شده است؛ بدون انتظار برای دور بعدی بررسی
+
+        server = webhook_server.BotWebhookServer(
+            application, db_execute, run_db, encrypt_data, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_REDIRECT_URI,
+            webhook_path=TELEGRAM_WEBHOOK_PATH, secret_token=TELEGRAM_WEBHOOK_SECRET, on_account_connected=on_account_connected,
+            oauth_state_signer=oauth_state_signer
+        )
+        logger.info(f"Bot starting in webhook mode ({TELEGRAM_WEBHOOK_URL})...")
+        asyncio.run(server.serve(WEBHOOK_LISTEN_HOST, WEBHOOK_LISTEN_PORT, TELEGRAM_WEBHOOK_URL))
+        return
     logger.info("Bot starting to poll...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 
@@ -0,0 +1,185 @@
+# metrics.py
+# متریک‌های سبک با خروجی متنی سازگار با Prometheus (بدون وابستگی خارجی)، مشترک بین ربات، fetch_worker.py و redirect_handler_app.py.
+# متریک‌هایی که چند جزء ثبت می‌کنند (مثل DB_QUERY_SECONDS) یک بار در همین ماژول تعریف و با برچسب component از هم جدا می‌شوند.
+# ثبت مقدار در مسیرهای پرتکرار فقط یک جستجوی دیکشنری و افزایش شمارنده زیر قفل است؛ متریک‌های حاصل از stats()
+# اجزای دیگر (استخر، صف ارسال و ...) فقط هنگام درخواست /metrics خوانده می‌شوند.
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = [] # متریک‌ها و collectorها به ترتیب ثبت
+_registry_lock = threading.Lock()
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels: return ''
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value) -> str:
+    if value == float('inf'): return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {} # مقادیر برچسب‌ها (tuple) -> وضعیت
+        self._lock = threading.Lock()
+        with _registry_lock: _registry.append(self)
+
+    def _label_dict(self, label_values) -> dict:
+        return dict(zip(self.labelnames, label_values))
+
+
+class Counter(_Metric):
+    """شمارنده افزایشی (نام نهایی با پسوند _total)؛ مقدار برچسب‌ها به ترتیب labelnames پس از amount داده می‌شود."""
+    metric_type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name + '_total', documentation, labelnames)
+
+    def inc(self, amount: float = 1, *label_values):
+        with self._lock:
+            self._children[label_values] = self._children.get(label_values, 0) + amount
+
+    def _samples(self):
+        with self._lock: children = dict(self._children)
+        for label_values, value in children.items():
+            yield self.name, self._label_dict(label_values), value
+
+
+class Histogram(_Metric):
+    """هیستوگرام با bucketهای ثابت (ثانیه)."""
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._children.get(label_values)
+            if state is None:
+                state = self._children[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - started, *label_values)
+
+    def _samples(self):
+        with self._lock:
+            children = {label_values: (list(state[0]), state[1]) for label_values, state in self._children.items()}
+        for label_values, (bucket_counts, total) in children.items():
+            labels = self._label_dict(label_values)
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + (float('inf'),), bucket_counts):
+                cumulative += count
+                yield self.name + '_bucket', dict(labels, le=_format_value(upper_bound)), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+class _Collector:
+    """متریکی که مقدارش هنگام درخواست /metrics از یک تابع خوانده می‌شود (مثلاً stats() استخر)."""
+
+    def __init__(self, name: str, documentation: str, metric_type: str, collect):
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self._collect = collect
+        with _registry_lock: _registry.append(self)
+
+    def _samples(self):
+        for labels, value in self._collect():
+            yield self.name, labels, value
+
+
+def register_collector(name: str, documentation: str, metric_type: str, collect):
+    """ثبت متریک gauge/counter که collect() آن فهرست (برچسب‌ها، مقدار) را برمی‌گرداند."""
+    return _Collector(name, documentation, metric_type, collect)
+
+
+def register_stats_collectors(prefix: str, component: str, stats_fn, counter_keys=(), keys=None, labels=None):
+    """ثبت هر کلید عددی stats_fn() (مثلاً MySQLPool.stats) به عنوان یک متریک جدا با نام prefix_key.
+
+    کلیدهای counter_keys شمارنده‌اند (با پسوند _total)؛ بقیه gauge. اگر keys داده نشود، کلیدها از اولین فراخوانی خوانده می‌شوند.
+    """
+    labels = labels or {}
+    for key in keys or [k for k, v in stats_fn().items() if isinstance(v, (int, float))]:
+        is_counter = key in counter_keys
+        register_collector(
+            f"{prefix}_{key}" if not is_counter or key.endswith('_total') else f"{prefix}_{key}_total", f"{component}: {key}",
+            'counter' if is_counter else 'gauge',
+            lambda key=key: [(labels, stats_fn().get(key, 0))]
+        )
+
+
+# --- متریک‌های مشترک بین اجزا (ربات و redirect handler ممکن است در یک پردازه بارگذاری شوند) ---
+DB_QUERY_SECONDS = Histogram("mailtotelbot_db_query_seconds", "Database query latency by component and statement type", ('component', 'operation'))
+DB_QUERY_ERRORS = Counter("mailtotelbot_db_query_errors", "Database query errors by component and statement type", ('component', 'operation'))
+
+
+def render_text() -> str:
+    """همه متریک‌ها در قالب متنی Prometheus؛ متریک‌های هم‌نام (مثلاً آمار دو استخر با برچسب‌های متفاوت) در یک خانواده می‌آیند."""
+    with _registry_lock: metrics = list(_registry)
+    families = {} # نام -> (اولین متریک ثبت شده، نمونه‌ها)
+    for metric in metrics:
+        try:
+            samples = list(metric._samples())
+        except Exception as e: # خطای یک collector نباید کل خروجی را خراب کند
+            logger.warning(f"Metric {metric.name} could not be collected: {e}")
+            continue
+        families.setdefault(metric.name, (metric, []))[1].extend(samples)
+    lines = []
+    for name, (metric, samples) in families.items():
+        lines.append(f"# HELP {name} {metric.documentation}")
+        lines.append(f"# TYPE {name} {metric.metric_type}")
+        for sample_name, labels, value in samples:
+            lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404); return
+        body = render_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # درخواست‌های scrape در لاگ نوشته نمی‌شوند
+        pass
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0"):
+    """اجرای سرور HTTP کوچک /metrics در یک نخ پس‌زمینه (برای پردازه‌هایی که وب‌سرور ندارند)."""
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics_http", daemon=True).start()
+    logger.info(f"Metrics endpoint listening on http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,296 @@
+# mime_pipeline.py
+# تبدیل پیام Gmail (قالب full) به پیام‌های تلگرام با حافظه محدود، مستقل از اندازه پیام:
+#   1. پیمایش ساختار MIME (payload/parts) برای یافتن بدنه متنی و پیوست‌ها
+#   2. رمزگشایی تکه‌ای base64 و تبدیل HTML به متن؛ خواندن پس از رسیدن به سقف طول متوقف می‌شود
+#   3. تقسیم متن به تکه‌هایی در حد مجاز طول پیام تلگرام
+#   4. دریافت جریانی پیوست‌ها در SpooledTemporaryFile (در حافظه تا آستانه، سپس روی دیسک) با سقف اندازه
+# بخش‌های بزرگ (پیوست‌ها و بدنه‌های بزرگ) در قالب full فقط attachmentId دارند و با fetch_part_chunks به صورت جریانی خوانده می‌شوند.
+import base64
+import codecs
+import json
+import re
+import tempfile
+import unicodedata
+from html.parser import HTMLParser
+
+TELEGRAM_MESSAGE_MAX_CHARS = 4096
+DECODE_CHUNK_CHARS = 64 * 1024 # مضربی از 4 تا هر تکه base64 مستقل رمزگشایی شود
+TEXT_READ_CHUNK_BYTES = 16 * 1024
+
+BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'table', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ul', 'ol', 'blockquote', 'pre', 'hr'}
+SKIPPED_TAGS = {'script', 'style', 'head', 'title', 'template'}
+_CHARSET_PATTERN = re.compile(r'charset="?([\w.:-]+)"?', re.IGNORECASE)
+_WHITESPACE_PATTERN = re.compile(r'[ \t\r\f\v\xa0]+')
+_BLANK_LINES_PATTERN = re.compile(r'\n\s*\n\s*\n+')
+
+
+class AttachmentTooLargeError(Exception):
+    """پیوست از سقف اندازه بزرگ‌تر است؛ دریافت آن در همان لحظه متوقف می‌شود."""
+
+
+# --- مرحله 1: ساختار MIME ---
+def iter_leaf_parts(payload: dict):
+    """بخش‌های برگ payload به ترتیب ظاهر شدن در پیام (بدون بازگشت، برای پیام‌های با تودرتویی زیاد)."""
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get('parts'): stack.extend(reversed(part['parts']))
+        else: yield part
+
+
+def _is_attachment(part: dict) -> bool:
+    return bool(part.get('filename'))
+
+
+def _part_charset(part: dict) -> str:
+    for header in part.get('headers', []):
+        if header.get('name', '').lower() == 'content-type':
+            match = _CHARSET_PATTERN.search(header.get('value', ''))
+            if match:
+                try: return codecs.lookup(match.group(1)).name
+                except LookupError: break
+    return 'utf-8'
+
+
+def find_text_parts(payload: dict) -> tuple:
+    """(اولین بخش text/plain، اولین بخش text/html) که پیوست نیستند؛ هر کدام ممکن است None باشد."""
+    plain_part = html_part = None
+    for part in iter_leaf_parts(payload):
+        if _is_attachment(part): continue
+        mime_type = part.get('mimeType', '').lower()
+        if mime_type == 'text/plain' and plain_part is None: plain_part = part
+        elif mime_type == 'text/html' and html_part is None: html_part = part
+    return plain_part, html_part
+
+
+def list_attachments(payload: dict) -> list:
+    """توصیف پیوست‌ها: filename، mime_type، size (بایت)، attachment_id و data (فقط برای پیوست‌های کوچک درون پیام)."""
+    return [{
+        'filename': part['filename'],
+        'mime_type': part.get('mimeType') or 'application/octet-stream',
+        'size': part.get('body', {}).get('size', 0),
+        'attachment_id': part.get('body', {}).get('attachmentId'),
+        'data': part.get('body', {}).get('data'),
+    } for part in iter_leaf_parts(payload) if _is_attachment(part)]
+
+
+# --- مرحله 2: رمزگشایی و تبدیل به متن ---
+def iter_base64url_chunks(data: str, chunk_chars: int = DECODE_CHUNK_CHARS):
+    """رمزگشایی تکه به تکه یک رشته base64url (بدون ساختن کل بایت‌ها در حافظه)."""
+    chunk_chars = max(4, chunk_chars - chunk_chars % 4) # فقط مرز گروه‌های 4 کاراکتری؛ padding فقط در تکه آخر
+    for offset in range(0, len(data), chunk_chars):
+        chunk = data[offset:offset + chunk_chars]
+        yield base64.urlsafe_b64decode(chunk + '=' * (-len(chunk) % 4))
+
+
+_STRING_STOP_PATTERN = re.compile(rb'["\\]')
+
+
+def iter_json_base64_field(byte_chunks, field_name: str = "data"):
+    """رمزگشایی جریانی مقدار base64url یک فیلد سطح اول از پاسخ JSON (مثل attachments.get جیمیل) بدون نگه داشتن کل پاسخ.
+
+    فقط کلید شیء بیرونی پذیرفته می‌شود (نه همین نام در اشیای تودرتو یا درون رشته‌ها) و escapeهای JSON، حتی اگر
+    بین دو تکه بریده شده باشند، باز می‌شوند. اگر فیلد نباشد یا پاسخ ناقص باشد ValueError داده می‌شود.
+    """
+    target_key = field_name.encode()
+    state = 'scan' # scan: بیرون رشته‌ها، string: رشته دیگر، value_start: پس از «:» کلید هدف، value: مقدار هدف
+    depth, expect_key, is_key, last_key = 0, False, False, None
+    key, escape, carry = bytearray(), b'', b''
+    for chunk in byte_chunks:
+        position = 0
+        while position < len(chunk):
+            if escape: # ادامه escape بریده شده؛ \uXXXX شش بایت است
+                escape += chunk[position:position + 1]
+                position += 1
+                if len(escape) < (6 if escape[1:2] == b'u' else 2): continue
+                if state == 'value':
+                    try: carry += json.loads(b'"' + escape + b'"').encode()
+                    except ValueError as e: raise ValueError(f"invalid escape in field {field_name!r}") from e
+                elif is_key:
+                    is_key = False # نام فیلدهای Gmail escape ندارند
+                escape = b''
+                continue
+            if state in ('string', 'value'):
+                match = _STRING_STOP_PATTERN.search(chunk, position)
+                end = match.start() if match else len(chunk)
+                if state == 'value':
+                    carry += chunk[position:end]
+                    usable = len(carry) - len(carry) % 4
+                    if usable: yield base64.urlsafe_b64decode(carry[:usable])
+                    carry = carry[usable:]
+                elif is_key and len(key) <= len(target_key):
+                    key += chunk[position:end]
+                if not match: break
+                position = end + 1
+                if chunk[end:end + 1] == b'\\':
+                    escape = b'\\'
+                elif state == 'value':
+                    if carry: yield base64.urlsafe_b64decode(carry + b'=' * (-len(carry) % 4))
+                    return
+                else:
+                    last_key = bytes(key) if is_key else None
+                    state = 'scan'
+                continue
+            byte = chunk[position:position + 1]
+            position += 1
+            if state == 'value_start':
+                if byte == b'"': state = 'value'
+                elif not byte.isspace(): raise ValueError(f"field {field_name!r} is not a string")
+            elif byte == b'"':
+                state, is_key = 'string', depth == 1 and expect_key
+                key.clear()
+            elif byte in (b'{', b'['):
+                depth += 1
+                expect_key = byte == b'{' and depth == 1
+            elif byte in (b'}', b']'):
+                depth -= 1
+                expect_key = False
+                if depth <= 0: raise ValueError(f"field {field_name!r} missing in response")
+            elif depth == 1 and byte == b',':
+                expect_key = True
+            elif depth == 1 and byte == b':':
+                expect_key = False
+                if last_key == target_key: state = 'value_start'
+                last_key = None
+    raise ValueError(f"field {field_name!r} missing or truncated in response")
+
+
+class _HTMLTextExtractor(HTMLParser):
+    """متن قابل خواندن HTML: حذف اسکریپت و استایل، خط جدید برای تگ‌های بلوکی و توقف جمع‌آوری پس از max_chars."""
+
+    def __init__(self, max_chars: int):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.pieces, self.length, self.skip_depth = [], 0, 0
+
+    @property
+    def full(self) -> bool:
+        return self.length > self.max_chars
+
+    def _append(self, text: str):
+        if self.full: return
+        self.pieces.append(text)
+        self.length += len(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS: self.skip_depth += 1
+        elif tag == 'li': self._append("\n• ")
+        elif tag in BLOCK_TAGS: self._append("\n")
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in BLOCK_TAGS: self._append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS: self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in BLOCK_TAGS: self._append("\n")
+
+    def handle_data(self, data):
+        if not self.skip_depth: self._append(_WHITESPACE_PATTERN.sub(' ', data.replace('\n', ' ')))
+
+
+def _iter_text(byte_chunks, charset: str):
+    decoder = codecs.getincrementaldecoder(charset)(errors='replace')
+    for chunk in byte_chunks:
+        for offset in range(0, len(chunk), TEXT_READ_CHUNK_BYTES):
+            text = decoder.decode(chunk[offset:offset + TEXT_READ_CHUNK_BYTES])
+            if text: yield text
+    tail = decoder.decode(b'', final=True)
+    if tail: yield tail
+
+
+def _normalize_text(text: str) -> str:
+    lines = (line.strip() for line in text.replace('\r\n', '\n').split('\n'))
+    return _BLANK_LINES_PATTERN.sub('\n\n', '\n'.join(lines)).strip()
+
+
+def extract_body_text(message: dict, max_chars: int, fetch_part_chunks=None) -> str:
+    """متن بدنه پیام با حداکثر max_chars کاراکتر (text/plain و در نبود آن HTML تبدیل شده)؛ متن بریده شده با «…» پایان می‌یابد.
+
+    fetch_part_chunks(attachment_id) بایت‌های بخش‌هایی را که Gmail به جای data فقط attachmentId برایشان فرستاده
+    به صورت تکه‌ای برمی‌گرداند؛ خواندن به محض رسیدن به سقف متوقف و جریان بسته می‌شود.
+    """
+    plain_part, html_part = find_text_parts(message.get('payload', {}))
+    part = plain_part or html_part
+    if part is None: return ''
+    body = part.get('body', {})
+    if body.get('data'): byte_chunks = iter_base64url_chunks(body['data'])
+    elif body.get('attachmentId') and fetch_part_chunks: byte_chunks = fetch_part_chunks(body['attachmentId'])
+    else: return ''
+    text_chunks = _iter_text(byte_chunks, _part_charset(part))
+    try:
+        if part is plain_part:
+            pieces, length = [], 0
+            for text in text_chunks:
+                pieces.append(text)
+                length += len(text)
+                if length > max_chars: break
+            text = ''.join(pieces)
+        else:
+            extractor = _HTMLTextExtractor(max_chars)
+            for text in text_chunks:
+                extractor.feed(text)
+                if extractor.full: break
+            else:
+                extractor.close()
+            text = ''.join(extractor.pieces)
+    finally:
+        text_chunks.close()
+        if hasattr(byte_chunks, 'close'): byte_chunks.close()
+    text = _normalize_text(text)
+    return text if len(text) <= max_chars else text[:max_chars].rstrip() + "…"
+
+
+# --- مرحله 3: تقسیم برای تلگرام ---
+_JOINING_CHARS = {'\u200c', '\u200d'} # ZWNJ (رایج در متن فارسی) و ZWJ (دنباله‌های ایموجی)
+
+
+def _is_joined(before: str, after: str) -> bool:
+    """آیا بریدن بین این دو کاراکتر یک نویسه قابل مشاهده را نصف می‌کند (نشانه ترکیبی، ZWJ/ZWNJ، variation selector، رنگ پوست ایموجی)؟"""
+    return (before in _JOINING_CHARS or after in _JOINING_CHARS
+            or unicodedata.category(after) in ('Mn', 'Mc', 'Me')
+            or '\ufe00' <= after <= '\ufe0f' or '\U0001f3fb' <= after <= '\U0001f3ff')
+
+
+def split_text(text: str, max_chars: int = TELEGRAM_MESSAGE_MAX_CHARS) -> list:
+    """تقسیم متن به تکه‌های حداکثر max_chars، ترجیحاً در مرز پاراگراف، سپس خط و سپس کلمه."""
+    chunks = []
+    while len(text) > max_chars:
+        window = text[:max_chars]
+        for separator in ('\n\n', '\n', ' '):
+            cut = window.rfind(separator)
+            if cut >= max_chars // 2: break
+        else:
+            cut = max_chars
+            while cut > max_chars // 2 and _is_joined(text[cut - 1], text[cut]): cut -= 1 # نشانه ترکیبی یا دنباله ایموجی نصف نشود
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text: chunks.append(text)
+    return chunks
+
+
+# --- مرحله 4: پیوست‌ها ---
+def spool_chunks(byte_chunks, max_bytes: int, max_memory_bytes: int):
+    """نوشتن تکه‌ها در SpooledTemporaryFile (در حافظه تا max_memory_bytes، سپس فایل موقت) و بازگرداندن آن از ابتدا.
+
+    اگر اندازه از max_bytes بگذرد، دریافت متوقف، فایل بسته و AttachmentTooLargeError داده می‌شود.
+    """
+    spooled_file = tempfile.SpooledTemporaryFile(max_size=max_memory_bytes)
+    written = 0
+    try:
+        for chunk in byte_chunks:
+            written += len(chunk)
+            if written > max_bytes: raise AttachmentTooLargeError(f"attachment exceeds {max_bytes} bytes")
+            spooled_file.write(chunk)
+    except BaseException:
+        spooled_file.close()
+        raise
+    finally:
+        if hasattr(byte_chunks, 'close'): byte_chunks.close()
+    spooled_file.seek(0)
+    return spooled_file
+
+
+def format_size(size_bytes: int) -> str:
+    if size_bytes >= 1024 * 1024: return f"{size_bytes / (1024 * 1024):.1f}MB"
+    if size_bytes >= 1024: return f"{size_bytes / 1024:.0f}KB"
+    return f"{size_bytes}B"
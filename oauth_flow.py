@@ -0,0 +1,215 @@
+# oauth_flow.py
+# مراحل مشترک تکمیل اتصال OAuth گوگل بین redirect_handler_app.py (Flask) و webhook_server.py (حالت webhook ربات).
+# این ماژول خودش درخواست HTTP نمی‌فرستد؛ هر سرور فراخوانی‌های گوگل را با کلاینت خودش (همگام یا async) انجام می‌دهد
+# و تابع db_execute خودش را برای ذخیره‌سازی می‌دهد.
+import base64
+import hashlib
+import hmac
+import importlib.util
+import secrets
+from datetime import datetime, timezone
+
+import httpx
+from jinja2 import Environment
+
+import admin_stats
+from ttl_cache import TTLCache
+
+GOOGLE_TOKEN_URL = "https://oauth2.googleapis.com/token"
+GOOGLE_USERINFO_URL = "https://www.googleapis.com/oauth2/v1/userinfo"
+
+# حالت قدیمی (OAUTH_STATE_MODE="db"): state یک UUID است که ردیف آن در oauth_states ذخیره شده
+OAUTH_STATE_QUERY = "SELECT state_uuid, telegram_id, provider, chat_id, message_id FROM oauth_states WHERE state_uuid = %s"
+SIGNED_STATE_PREFIX = "s1." # نسخه قالب state امضا شده؛ UUIDها هیچ‌گاه با آن شروع نمی‌شوند
+
+# HTTP/2 فقط وقتی بسته اختیاری h2 نصب باشد فعال می‌شود (httpx بدون آن خطا می‌دهد)
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# --- قالب‌های HTML ساده برای نمایش پیام به کاربر ---
+SUCCESS_PAGE_TEMPLATE = """
+<!DOCTYPE html><html lang="fa" dir="rtl"><head><meta charset="UTF-8"><title>اتصال موفق</title>
+<style>body{font-family: sans-serif; display: flex; justify-content: center; align-items: center; height: 90vh; background-color: #f4f7f6; margin: 0;} .container{text-align: center; padding: 30px; background-color: white; border-radius: 8px; box-shadow: 0 4px 8px rgba(0,0,0,0.1);} h1{color: #4CAF50;} p{color: #333; font-size: 1.1em;}</style></head>
+<body><div class="container"><h1>✅ اتصال موفقیت آمیز بود!</h1><p>ایمیل <strong>{{ email }}</strong> با موفقیت به ربات تلگرام شما متصل شد.</p><p>اکنون می‌توانید این پنجره را ببندید و به ربات در تلگرام بازگردید.</p></div></body></html>
+"""
+ERROR_PAGE_TEMPLATE = """
+<!DOCTYPE html><html lang="fa" dir="rtl"><head><meta charset="UTF-8"><title>خطا در اتصال</title>
+<style>body{font-family: sans-serif; display: flex; justify-content: center; align-items: center; height: 90vh; background-color: #f4f7f6; margin: 0;} .container{text-align: center; padding: 30px; background-color: white; border-radius: 8px; box-shadow: 0 4px 8px rgba(0,0,0,0.1);} h1{color: #F44336;} p{color: #333; font-size: 1.1em;}</style></head>
+<body><div class="container"><h1>❌ خطا در اتصال</h1><p>{{ error_message }}</p><p>لطفاً دوباره از طریق ربات تلگرام تلاش کنید یا با پشتیبانی تماس بگیرید.</p></div></body></html>
+"""
+
+_template_environment = Environment(autoescape=True) # مانند render_template_string در Flask
+
+
+class OAuthCallbackError(Exception):
+    """خطای تکمیل OAuth؛ user_message به کاربر نمایش داده می‌شود و status کد HTTP پاسخ است."""
+
+    def __init__(self, log_message: str, user_message: str, status: int = 500):
+        super().__init__(log_message)
+        self.user_message = user_message
+        self.status = status
+
+
+def google_http_client_options(max_connections: int, timeout_seconds: float = 10) -> dict:
+    """تنظیمات مشترک httpx.Client/AsyncClient برای endpointهای گوگل: اتصال‌های keep-alive و HTTP/2 در صورت امکان."""
+    return {
+        'http2': HTTP2_AVAILABLE,
+        'timeout': timeout_seconds,
+        'limits': httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=60),
+    }
+
+
+def render_page(template: str, **context) -> str:
+    return _template_environment.from_string(template).render(**context)
+
+
+def parse_callback_args(args) -> tuple[str, str]:
+    """پارامترهای state و code را از query string (هر شیء شبیه dict) برمی‌گرداند یا OAuthCallbackError می‌دهد."""
+    error_from_google = args.get('error')
+    if error_from_google:
+        raise OAuthCallbackError(f"OAuth Error from Google: {error_from_google}", f"گوگل خطایی را برگرداند: {error_from_google}", 400)
+    state_from_google, code_from_google = args.get('state'), args.get('code')
+    if not state_from_google or not code_from_google:
+        raise OAuthCallbackError("OAuth callback missing state or code.", "پاسخ ناقص از سرویس احراز هویت دریافت شد.", 400)
+    return state_from_google, code_from_google
+
+
+def check_state_row(state_data_row, state_from_google: str) -> tuple[int, str]:
+    """(شناسه کاربر تلگرام، ارائه‌دهنده) از ردیف oauth_states؛ نبود ردیف یعنی state نامعتبر یا منقضی است."""
+    if not state_data_row:
+        raise OAuthCallbackError(f"Invalid or expired OAuth state received: {state_from_google}",
+                                 "وضعیت (state) احراز هویت نامعتبر یا منقضی شده است.", 400)
+    return state_data_row['telegram_id'], state_data_row['provider'] # provider باید "google" باشد
+
+
+def is_signed_state(state: str) -> bool:
+    return state.startswith(SIGNED_STATE_PREFIX)
+
+
+class OAuthStateSigner:
+    """state بدون جدول: "s1.<telegram_id>.<provider>.<chat_id>.<message_id>.<issued_at>.<nonce>.<signature>".
+
+    امضا HMAC-SHA256 (کوتاه شده به 16 بایت) با کلیدی است که از ENCRYPTION_KEY مشتق می‌شود، پس ربات و redirect handler
+    بدون پایگاه داده state یکدیگر را می‌پذیرند. هر nonce پس از اتصال موفق (consume) در همین پردازه دیگر پذیرفته نمی‌شود؛ با چند worker
+    تکرار در worker دیگر در نهایت در تبادل کد رد می‌شود چون گوگل هر authorization_code را فقط یک بار قبول می‌کند.
+    """
+
+    def __init__(self, encryption_key: str, max_age_seconds: int = 1800, nonce_store_size: int = 100000):
+        key_material = base64.urlsafe_b64decode(encryption_key.encode())
+        self._signing_key = hmac.new(key_material, b"mailtotelbot-oauth-state", hashlib.sha256).digest() # جدا از کلید Fernet
+        self.max_age_seconds = max_age_seconds
+        self._used_nonces = TTLCache(maxsize=nonce_store_size, ttl_seconds=max_age_seconds)
+
+    def _signature(self, payload: str) -> str:
+        digest = hmac.new(self._signing_key, payload.encode(), hashlib.sha256).digest()[:16]
+        return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+    def issue(self, telegram_id: int, provider: str, chat_id: int = None, message_id: int = None) -> tuple[str, str, int]:
+        """(state، nonce، زمان صدور)؛ nonce در callback_data دکمه بررسی و در oauth_completion_events به جای state_uuid می‌آید."""
+        nonce = secrets.token_hex(8)
+        issued_at = int(datetime.now(timezone.utc).timestamp())
+        payload = f"{SIGNED_STATE_PREFIX}{telegram_id}.{provider}.{chat_id or ''}.{message_id or ''}.{issued_at}.{nonce}"
+        return f"{payload}.{self._signature(payload)}", nonce, issued_at
+
+    def verify(self, state: str) -> dict:
+        """ردیفی با همان کلیدهای OAUTH_STATE_QUERY؛ state نامعتبر، منقضی یا مصرف شده OAuthCallbackError می‌دهد.
+
+        nonce اینجا علامت نمی‌خورد تا خطای موقت گوگل در تبادل کد لینک را باطل نکند؛ پس از ذخیره حساب consume را صدا بزنید.
+        """
+        invalid_state = OAuthCallbackError(f"Invalid OAuth state: {state!r}", "وضعیت (state) احراز هویت نامعتبر است.", 400)
+        payload, _, signature = state.rpartition(".")
+        if not hmac.compare_digest(signature.encode(), self._signature(payload).encode()):
+            raise invalid_state
+        try:
+            telegram_id, provider, chat_id, message_id, issued_at, nonce = payload[len(SIGNED_STATE_PREFIX):].split(".")
+            state_data_row = {
+                'state_uuid': nonce, 'telegram_id': int(telegram_id), 'provider': provider, 'signed': True,
+                'chat_id': int(chat_id) if chat_id else None, 'message_id': int(message_id) if message_id else None,
+            }
+            issued_at = int(issued_at)
+        except ValueError as e: # امضای معتبر روی payload نادرست؛ فقط با کلید نشت کرده یا تغییر قالب ممکن است
+            raise invalid_state from e
+        if issued_at + self.max_age_seconds < datetime.now(timezone.utc).timestamp():
+            raise OAuthCallbackError(f"Expired OAuth state for user {telegram_id}.", "وضعیت (state) احراز هویت منقضی شده است. لطفاً دوباره از ربات اقدام کنید.", 400)
+        if self._used_nonces.get(nonce) is not None:
+            raise OAuthCallbackError(f"Replayed OAuth state for user {telegram_id}: {nonce}", "این لینک احراز هویت قبلاً استفاده شده است.", 400)
+        return state_data_row
+
+    def consume(self, state_data_row: dict) -> bool:
+        """علامت زدن nonce یک state امضا شده پس از ذخیره موفق حساب؛ False یعنی پیش‌تر مصرف شده بود (ردیف‌های oauth_states نادیده گرفته می‌شوند)."""
+        if not state_data_row.get('signed'): return True
+        return self._used_nonces.add(state_data_row['state_uuid'], True)
+
+
+def token_request_data(code: str, client_id: str, client_secret: str, redirect_uri: str) -> dict:
+    """بدنه درخواست تبادل authorization_code با access_token و refresh_token."""
+    return {
+        'code': code,
+        'client_id': client_id,
+        'client_secret': client_secret,
+        'redirect_uri': redirect_uri, # باید دقیقاً با آنچه در کنسول گوگل ثبت شده مطابقت داشته باشد
+        'grant_type': 'authorization_code'
+    }
+
+
+def parse_token_response(tokens: dict, user_telegram_id: int) -> tuple[str, str | None, int | None]:
+    """(access_token، refresh_token، expires_in) از پاسخ گوگل؛ refresh_token فقط در اولین اتصال ارسال می‌شود."""
+    access_token = tokens.get('access_token')
+    if not access_token:
+        raise OAuthCallbackError(f"Access token not found in Google's response for user {user_telegram_id}. Response: {tokens}",
+                                 "توکن دسترسی از گوگل دریافت نشد.")
+    return access_token, tokens.get('refresh_token'), tokens.get('expires_in')
+
+
+def parse_user_email(user_info: dict, user_telegram_id: int) -> str:
+    user_email = user_info.get('email')
+    if not user_email:
+        raise OAuthCallbackError(f"Email not found in user_info for user {user_telegram_id}. Response: {user_info}",
+                                 "ایمیل کاربر از گوگل دریافت نشد.")
+    return user_email
+
+
+def store_connected_account(db_execute, encrypt_data, state_data_row: dict, user_email: str,
+                            access_token: str, refresh_token: str | None, expires_in: int | None):
+    """ذخیره توکن‌های رمزنگاری شده و ایمیل کاربر، ثبت رویداد تکمیل برای ربات و سپس حذف state استفاده شده.
+
+    state_data_row ردیف oauth_states یا خروجی OAuthStateSigner.verify است؛ chat_id و message_id آن پیام اتصال در تلگرام
+    هستند تا ربات همان پیام را ویرایش کند.
+    """
+    user_telegram_id, provider = state_data_row['telegram_id'], state_data_row['provider']
+    encrypted_access_token = encrypt_data(access_token)
+    encrypted_refresh_token = encrypt_data(refresh_token) if refresh_token else None # refresh_token ممکن است null باشد
+    timestamp_added = int(datetime.now(timezone.utc).timestamp())
+    token_expiry_timestamp = timestamp_added + expires_in if expires_in else None
+    existing_account = db_execute(
+        "SELECT is_active FROM connected_oauth_emails WHERE user_telegram_id = %s AND email_address = %s AND provider = %s",
+        (user_telegram_id, user_email, provider), fetchone=True
+    )
+    # استفاده از INSERT ... ON DUPLICATE KEY UPDATE برای مدیریت اتصال مجدد همان ایمیل
+    # این کوئری فرض می‌کند که UNIQUE KEY (user_telegram_id, email_address, provider) روی جدول وجود دارد
+    db_execute(
+        """
+        INSERT INTO connected_oauth_emails
+        (user_telegram_id, provider, email_address, encrypted_access_token, encrypted_refresh_token, token_expiry_timestamp, is_active, timestamp_added)
+        VALUES (%s, %s, %s, %s, %s, %s, TRUE, %s)
+        ON DUPLICATE KEY UPDATE
+        encrypted_access_token = VALUES(encrypted_access_token),
+        encrypted_refresh_token = IF(VALUES(encrypted_refresh_token) IS NOT NULL, VALUES(encrypted_refresh_token), encrypted_refresh_token), -- فقط اگر توکن بازآوری جدیدی وجود دارد، آن را به‌روز کن
+        token_expiry_timestamp = VALUES(token_expiry_timestamp),
+        is_active = TRUE,
+        timestamp_added = VALUES(timestamp_added)
+        """,
+        (user_telegram_id, provider, user_email, encrypted_access_token, encrypted_refresh_token, token_expiry_timestamp, timestamp_added),
+        commit=True
+    )
+    # شمارنده‌های /stats: حساب جدید یا فعال شدن دوباره حساب غیرفعال
+    admin_stats.add_to_counters(lambda query, params: db_execute(query, params, commit=True), {
+        admin_stats.accounts_total_counter(provider): 0 if existing_account else 1,
+        admin_stats.accounts_active_counter(provider): 0 if existing_account and existing_account['is_active'] else 1,
+    })
+    db_execute(
+        "INSERT INTO oauth_completion_events (state_uuid, telegram_id, chat_id, message_id, email_address, created_at) VALUES (%s, %s, %s, %s, %s, %s)",
+        (state_data_row['state_uuid'], user_telegram_id, state_data_row['chat_id'], state_data_row['message_id'], user_email, timestamp_added),
+        commit=True
+    )
+    if not state_data_row.get('signed'): # state امضا شده ردیفی در oauth_states ندارد
+        db_execute("DELETE FROM oauth_states WHERE state_uuid = %s", (state_data_row['state_uuid'],), commit=True)
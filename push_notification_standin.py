@@ -0,0 +1,46 @@
+# push_notification_standin.py
+# جایگزین محلی Pub/Sub برای تست: اعلان‌هایی با قالب push جیمیل به endpoint /gmail/push ارسال می‌کند.
+# مثال:
+#   python push_notification_standin.py --email someone@gmail.com --history-id 12345 --count 3
+import argparse
+import base64
+import json
+import time
+import uuid
+
+import requests
+
+
+def build_push_envelope(email_address: str, history_id: int) -> dict:
+    """پاکت JSON مشابه آنچه Pub/Sub برای اشتراک push ارسال می‌کند."""
+    data = json.dumps({'emailAddress': email_address, 'historyId': history_id}).encode()
+    return {
+        'message': {
+            'data': base64.b64encode(data).decode(),
+            'messageId': str(uuid.uuid4()),
+            'publishTime': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'subscription': 'projects/local-standin/subscriptions/gmail-push',
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post Gmail watch-style push notifications to the redirect handler.")
+    parser.add_argument('--url', default='http://localhost:5000/gmail/push')
+    parser.add_argument('--email', required=True)
+    parser.add_argument('--history-id', type=int, default=1)
+    parser.add_argument('--token', default=None, help="GMAIL_PUSH_VERIFICATION_TOKEN of the redirect handler")
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--interval', type=float, default=0.5, help="seconds between notifications")
+    args = parser.parse_args()
+
+    params = {'token': args.token} if args.token else None
+    for i in range(args.count):
+        envelope = build_push_envelope(args.email, args.history_id + i)
+        response = requests.post(args.url, params=params, json=envelope, timeout=10)
+        print(f"#{i + 1} historyId={args.history_id + i} -> HTTP {response.status_code}")
+        if i + 1 < args.count: time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
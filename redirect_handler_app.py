@@ -1,8 +1,12 @@
 # redirect_handler_app.py
 import os
+import json
+import base64
+import hmac
 import logging
-from flask import Flask, request, redirect as flask_redirect, render_template_string
-import requests # برای تبادل کد با توکن
+import time
+from flask import Flask, request, g, redirect as flask_redirect, render_template_string
+import httpx # برای تبادل کد با توکن و دریافت اطلاعات کاربر
 from urllib.parse import urljoin
 import mysql.connector
 from mysql.connector import errorcode
@@ -10,6 +14,10 @@ from datetime import datetime, timezone
 from cryptography.fernet import Fernet # برای رمزنگاری توکن‌ها
 from dotenv import load_dotenv
 
+from db_pool import MySQLPool
+import metrics
+import oauth_flow
+
 load_dotenv()
 
 app = Flask(__name__)
@@ -38,6 +46,26 @@ GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
 # این مقدار باید از طریق متغیر محیطی به ربات اصلی (main_bot.py) نیز داده شود.
 CURRENT_APP_REDIRECT_URI = os.getenv('GOOGLE_REDIRECT_URI') # آدرس همین اپلیکیشن
 
+# توکن مشترک که در آدرس push subscription (پارامتر token) قرار می‌گیرد تا درخواست‌های جعلی رد شوند
+# بدون آن /gmail/push هیچ اعلانی را نمی‌پذیرد (503)
+GMAIL_PUSH_VERIFICATION_TOKEN = os.getenv('GMAIL_PUSH_VERIFICATION_TOKEN')
+if not GMAIL_PUSH_VERIFICATION_TOKEN:
+    if os.getenv('GMAIL_PUSH_TOPIC'):
+        app.logger.error("GMAIL_PUSH_TOPIC is set but GMAIL_PUSH_VERIFICATION_TOKEN is not; /gmail/push will refuse all notifications.")
+    else:
+        app.logger.info("GMAIL_PUSH_VERIFICATION_TOKEN not set; /gmail/push is disabled.")
+
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 10))
+DB_POOL_MAX_LIFETIME_SECONDS = int(os.getenv('DB_POOL_MAX_LIFETIME_SECONDS', 1800))
+DB_POOL_HEALTHCHECK_IDLE_SECONDS = int(os.getenv('DB_POOL_HEALTHCHECK_IDLE_SECONDS', 30))
+DB_POOL_ACQUIRE_TIMEOUT_SECONDS = float(os.getenv('DB_POOL_ACQUIRE_TIMEOUT_SECONDS', 10))
+
+# حداکثر اتصال هم‌زمان (keep-alive) هر فرآیند به endpointهای گوگل
+GOOGLE_HTTP_MAX_CONNECTIONS = int(os.getenv('GOOGLE_HTTP_MAX_CONNECTIONS', 100))
+
+# اگر تنظیم شود، /metrics فقط با هدر "Authorization: Bearer <token>" پاسخ می‌دهد
+METRICS_ACCESS_TOKEN = os.getenv('METRICS_ACCESS_TOKEN')
+
 ENCRYPTION_KEY_STR = os.getenv('ENCRYPTION_KEY')
 if not ENCRYPTION_KEY_STR:
     app.logger.critical("ENCRYPTION_KEY not set for redirect handler. Exiting.")
@@ -48,166 +76,177 @@ except Exception as e:
     app.logger.critical(f"Invalid ENCRYPTION_KEY for redirect handler: {e}. Exiting.")
     exit(1)
 
+# state امضا شده ربات با همان ENCRYPTION_KEY بررسی می‌شود (باید با OAUTH_STATE_MAX_AGE_SECONDS ربات یکسان باشد)
+OAUTH_STATE_MAX_AGE_SECONDS = int(os.getenv('OAUTH_STATE_MAX_AGE_SECONDS', 1800))
+oauth_state_signer = oauth_flow.OAuthStateSigner(ENCRYPTION_KEY_STR, OAUTH_STATE_MAX_AGE_SECONDS)
+
 def encrypt_data_rh(data: str) -> str: # rh for redirect_handler to avoid name clash if in same process
     if not data: return ""
     return cipher_suite.encrypt(data.encode()).decode()
 
+def running_under_gevent() -> bool:
+    """آیا این فرآیند در worker گونیکورن gevent (با socket وصله شده) اجرا می‌شود؟"""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+# کلاینت HTTP مشترک برای گوگل: اتصال‌ها بین درخواست‌ها دوباره استفاده می‌شوند (و با h2، روی یک اتصال HTTP/2 چندگانه می‌شوند).
+# زیر worker gevent (gunicorn.conf.py) هر درخواست یک greenlet است و انتظار برای گوگل worker را مسدود نمی‌کند.
+google_http_client = httpx.Client(**oauth_flow.google_http_client_options(GOOGLE_HTTP_MAX_CONNECTIONS))
+
 # --- توابع کمکی پایگاه داده ---
+# هر فرآیند (یا هر worker گونیکورن) استخر خودش را دارد؛ اتصال‌ها در اولین درخواست ساخته می‌شوند
+db_pool_rh = MySQLPool(
+    "redirect_handler",
+    {
+        'host': MYSQL_HOST, 'user': MYSQL_USER, 'password': MYSQL_PASSWORD,
+        'database': MYSQL_DATABASE_NAME_ENV, 'port': MYSQL_PORT, 'autocommit': False,
+        # افزونه C کانکتور با gevent هم‌کاری نمی‌کند و کل worker را هنگام کوئری مسدود می‌کند
+        **({'use_pure': True} if running_under_gevent() else {}),
+    },
+    size=DB_POOL_SIZE,
+    max_lifetime_seconds=DB_POOL_MAX_LIFETIME_SECONDS,
+    healthcheck_idle_seconds=DB_POOL_HEALTHCHECK_IDLE_SECONDS,
+    acquire_timeout_seconds=DB_POOL_ACQUIRE_TIMEOUT_SECONDS,
+)
+metrics.register_stats_collectors(
+    "mailtotelbot_db_pool", "MySQL connection pool", db_pool_rh.stats, labels={'pool': 'redirect_handler'},
+    counter_keys=('acquired', 'waits', 'wait_seconds_total', 'timeouts', 'created', 'recycled_lifetime', 'discarded_unhealthy'),
+    keys=('acquired', 'waits', 'wait_seconds_total', 'wait_seconds_max', 'timeouts', 'created', 'recycled_lifetime', 'discarded_unhealthy', 'idle', 'size'),
+)
+# هر worker گونیکورن متریک‌های خودش را دارد؛ برای دید کامل، هر worker جداگانه scrape شود یا از یک worker استفاده کنید
+HTTP_REQUEST_SECONDS = metrics.Histogram("mailtotelbot_http_request_seconds", "Redirect handler request latency", ('endpoint', 'status'))
+
 def get_db_connection_rh():
     try:
-        conn = mysql.connector.connect(
-            host=MYSQL_HOST, user=MYSQL_USER, password=MYSQL_PASSWORD,
-            database=MYSQL_DATABASE_NAME_ENV, port=MYSQL_PORT, autocommit=False
-        )
-        return conn
+        return db_pool_rh.get_connection() # close() اتصال را به استخر بازمی‌گرداند
     except mysql.connector.Error as err:
         app.logger.error(f"RedirectHandler: Error connecting to MySQL: {err}")
         raise
 
-def db_execute_rh(query, params=None, fetchone=False, commit=False):
+def db_execute_rh(query, params=None, fetchone=False, commit=False, rowcount=False):
     result = None; conn = None; cursor = None
+    operation = query.lstrip()[:6].upper()
+    started = time.perf_counter()
     try:
         conn = get_db_connection_rh()
         cursor = conn.cursor(dictionary=True if fetchone else False)
         cursor.execute(query, params)
         if commit: conn.commit()
         if fetchone: result = cursor.fetchone()
+        elif rowcount: result = cursor.rowcount # None در صورت خطا
     except mysql.connector.Error as err:
         app.logger.error(f"RedirectHandler: DB error: {err} \nQuery: {query} \nParams: {params}")
+        metrics.DB_QUERY_ERRORS.inc(1, 'redirect_handler', operation)
         if conn: conn.rollback()
     finally:
         if cursor: cursor.close()
-        if conn and conn.is_connected(): conn.close()
+        if conn: conn.close()
+        metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - started, 'redirect_handler', operation)
     return result
 
-# --- قالب‌های HTML ساده برای نمایش پیام به کاربر ---
-SUCCESS_PAGE_TEMPLATE = """
-<!DOCTYPE html><html lang="fa" dir="rtl"><head><meta charset="UTF-8"><title>اتصال موفق</title>
-<style>body{font-family: sans-serif; display: flex; justify-content: center; align-items: center; height: 90vh; background-color: #f4f7f6; margin: 0;} .container{text-align: center; padding: 30px; background-color: white; border-radius: 8px; box-shadow: 0 4px 8px rgba(0,0,0,0.1);} h1{color: #4CAF50;} p{color: #333; font-size: 1.1em;}</style></head>
-<body><div class="container"><h1>✅ اتصال موفقیت آمیز بود!</h1><p>ایمیل <strong>{{ email }}</strong> با موفقیت به ربات تلگرام شما متصل شد.</p><p>اکنون می‌توانید این پنجره را ببندید و به ربات در تلگرام بازگردید.</p></div></body></html>
-"""
-ERROR_PAGE_TEMPLATE = """
-<!DOCTYPE html><html lang="fa" dir="rtl"><head><meta charset="UTF-8"><title>خطا در اتصال</title>
-<style>body{font-family: sans-serif; display: flex; justify-content: center; align-items: center; height: 90vh; background-color: #f4f7f6; margin: 0;} .container{text-align: center; padding: 30px; background-color: white; border-radius: 8px; box-shadow: 0 4px 8px rgba(0,0,0,0.1);} h1{color: #F44336;} p{color: #333; font-size: 1.1em;}</style></head>
-<body><div class="container"><h1>❌ خطا در اتصال</h1><p>{{ error_message }}</p><p>لطفاً دوباره از طریق ربات تلگرام تلاش کنید یا با پشتیبانی تماس بگیرید.</p></div></body></html>
-"""
+# --- متریک‌ها: تأخیر هر درخواست (از جمله oauth2callback) بر اساس endpoint و کد وضعیت ---
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None and request.endpoint != 'metrics_endpoint':
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, request.endpoint or 'unknown', str(response.status_code))
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if METRICS_ACCESS_TOKEN and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_ACCESS_TOKEN}"):
+        return "forbidden", 403
+    return metrics.render_text(), 200, {'Content-Type': metrics.CONTENT_TYPE}
 
 @app.route('/oauth2callback') # این مسیر باید با GOOGLE_REDIRECT_URI شما مطابقت داشته باشد
 def oauth2callback():
-    state_from_google = request.args.get('state')
-    code_from_google = request.args.get('code')
-    error_from_google = request.args.get('error')
-
-    if error_from_google:
-        app.logger.error(f"OAuth Error from Google: {error_from_google}")
-        return render_template_string(ERROR_PAGE_TEMPLATE, error_message=f"گوگل خطایی را برگرداند: {error_from_google}"), 400
-
-    if not state_from_google or not code_from_google:
-        app.logger.error("OAuth callback missing state or code.")
-        return render_template_string(ERROR_PAGE_TEMPLATE, error_message="پاسخ ناقص از سرویس احراز هویت دریافت شد."), 400
-
-    # 1. اعتبارسنجی state و دریافت شناسه کاربر تلگرام
-    state_data_row = db_execute_rh("SELECT telegram_id, provider FROM oauth_states WHERE state_uuid = %s", (state_from_google,), fetchone=True)
-    if not state_data_row:
-        app.logger.error(f"Invalid or expired OAuth state received: {state_from_google}")
-        return render_template_string(ERROR_PAGE_TEMPLATE, error_message="وضعیت (state) احراز هویت نامعتبر یا منقضی شده است."), 400
-    
-    user_telegram_id = state_data_row['telegram_id']
-    provider = state_data_row['provider'] # باید "google" باشد
-
-    # 2. تبادل authorization_code با access_token و refresh_token
-    token_url = "https://oauth2.googleapis.com/token"
-    token_payload = {
-        'code': code_from_google,
-        'client_id': GOOGLE_CLIENT_ID,
-        'client_secret': GOOGLE_CLIENT_SECRET,
-        'redirect_uri': CURRENT_APP_REDIRECT_URI, # باید دقیقاً با آنچه در کنسول گوگل ثبت شده مطابقت داشته باشد
-        'grant_type': 'authorization_code'
-    }
     try:
-        token_response = requests.post(token_url, data=token_payload, timeout=10)
-        token_response.raise_for_status() # بررسی خطاهای HTTP
-        tokens = token_response.json()
-        
-        access_token = tokens.get('access_token')
-        refresh_token = tokens.get('refresh_token') # برای گوگل، refresh_token فقط در اولین بار ارسال می‌شود
-        expires_in = tokens.get('expires_in') # معمولاً 3600 ثانیه
-
-        if not access_token:
-            app.logger.error(f"Access token not found in Google's response for user {user_telegram_id}. Response: {tokens}")
-            return render_template_string(ERROR_PAGE_TEMPLATE, error_message="توکن دسترسی از گوگل دریافت نشد."), 500
-
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error exchanging code for token for user {user_telegram_id}: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            app.logger.error(f"Token exchange error response: {e.response.text}")
-        return render_template_string(ERROR_PAGE_TEMPLATE, error_message="خطا در تبادل کد با توکن."), 500
-    except Exception as e:
-        app.logger.error(f"Unexpected error during token exchange for user {user_telegram_id}: {e}")
-        return render_template_string(ERROR_PAGE_TEMPLATE, error_message="خطای پیش‌بینی نشده در سرور."), 500
+        # 1. اعتبارسنجی state و دریافت شناسه کاربر تلگرام
+        state_from_google, code_from_google = oauth_flow.parse_callback_args(request.args)
+        if oauth_flow.is_signed_state(state_from_google):
+            state_data_row = oauth_state_signer.verify(state_from_google)
+        else:
+            state_data_row = db_execute_rh(oauth_flow.OAUTH_STATE_QUERY, (state_from_google,), fetchone=True)
+        user_telegram_id, provider = oauth_flow.check_state_row(state_data_row, state_from_google)
+    except oauth_flow.OAuthCallbackError as e:
+        app.logger.error(str(e))
+        return render_template_string(oauth_flow.ERROR_PAGE_TEMPLATE, error_message=e.user_message), e.status
 
-    # 3. دریافت اطلاعات کاربر (ایمیل) با استفاده از access_token
-    user_info_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    headers = {'Authorization': f'Bearer {access_token}'}
     try:
-        user_info_response = requests.get(user_info_url, headers=headers, timeout=10)
-        user_info_response.raise_for_status()
-        user_info = user_info_response.json()
-        user_email = user_info.get('email')
-
-        if not user_email:
-            app.logger.error(f"Email not found in user_info for user {user_telegram_id}. Response: {user_info}")
-            return render_template_string(ERROR_PAGE_TEMPLATE, error_message="ایمیل کاربر از گوگل دریافت نشد."), 500
-            
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Error fetching user info for user {user_telegram_id}: {e}")
-        return render_template_string(ERROR_PAGE_TEMPLATE, error_message="خطا در دریافت اطلاعات کاربر از گوگل."), 500
+        # 2. تبادل authorization_code با access_token و refresh_token
+        token_payload = oauth_flow.token_request_data(code_from_google, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, CURRENT_APP_REDIRECT_URI)
+        try:
+            token_response = google_http_client.post(oauth_flow.GOOGLE_TOKEN_URL, data=token_payload)
+            token_response.raise_for_status() # بررسی خطاهای HTTP
+            access_token, refresh_token, expires_in = oauth_flow.parse_token_response(token_response.json(), user_telegram_id)
+        except httpx.HTTPError as e:
+            app.logger.error(f"Error exchanging code for token for user {user_telegram_id}: {e}")
+            if isinstance(e, httpx.HTTPStatusError):
+                app.logger.error(f"Token exchange error response: {e.response.text}")
+            return render_template_string(oauth_flow.ERROR_PAGE_TEMPLATE, error_message="خطا در تبادل کد با توکن."), 500
+
+        # 3. دریافت اطلاعات کاربر (ایمیل) با استفاده از access_token
+        try:
+            user_info_response = google_http_client.get(oauth_flow.GOOGLE_USERINFO_URL, headers={'Authorization': f'Bearer {access_token}'})
+            user_info_response.raise_for_status()
+            user_email = oauth_flow.parse_user_email(user_info_response.json(), user_telegram_id)
+        except httpx.HTTPError as e:
+            app.logger.error(f"Error fetching user info for user {user_telegram_id}: {e}")
+            return render_template_string(oauth_flow.ERROR_PAGE_TEMPLATE, error_message="خطا در دریافت اطلاعات کاربر از گوگل."), 500
+    except oauth_flow.OAuthCallbackError as e:
+        app.logger.error(str(e))
+        return render_template_string(oauth_flow.ERROR_PAGE_TEMPLATE, error_message=e.user_message), e.status
     except Exception as e:
-        app.logger.error(f"Unexpected error during user info fetch for user {user_telegram_id}: {e}")
-        return render_template_string(ERROR_PAGE_TEMPLATE, error_message="خطای پیش‌بینی نشده در سرور."), 500
-
-    # 4. ذخیره توکن‌های رمزنگاری شده و ایمیل کاربر در پایگاه داده
-    encrypted_access_token = encrypt_data_rh(access_token)
-    encrypted_refresh_token = encrypt_data_rh(refresh_token) if refresh_token else None # refresh_token ممکن است null باشد
-
-    token_expiry_timestamp = int(datetime.now(timezone.utc).timestamp()) + expires_in if expires_in else None
-    timestamp_added = int(datetime.now(timezone.utc).timestamp())
+        app.logger.error(f"Unexpected error during Google token exchange or user info fetch for user {user_telegram_id}: {e}")
+        return render_template_string(oauth_flow.ERROR_PAGE_TEMPLATE, error_message="خطای پیش‌بینی نشده در سرور."), 500
 
+    # 4. ذخیره توکن‌های رمزنگاری شده و ایمیل کاربر و حذف state استفاده شده
     try:
-        # استفاده از INSERT ... ON DUPLICATE KEY UPDATE برای مدیریت اتصال مجدد همان ایمیل
-        # این کوئری فرض می‌کند که UNIQUE KEY (user_telegram_id, email_address, provider) روی جدول وجود دارد
-        insert_query = """
-            INSERT INTO connected_oauth_emails 
-            (user_telegram_id, provider, email_address, encrypted_access_token, encrypted_refresh_token, token_expiry_timestamp, is_active, timestamp_added)
-            VALUES (%s, %s, %s, %s, %s, %s, TRUE, %s)
-            ON DUPLICATE KEY UPDATE
-            encrypted_access_token = VALUES(encrypted_access_token),
-            encrypted_refresh_token = IF(VALUES(encrypted_refresh_token) IS NOT NULL, VALUES(encrypted_refresh_token), encrypted_refresh_token), -- فقط اگر توکن بازآوری جدیدی وجود دارد، آن را به‌روز کن
-            token_expiry_timestamp = VALUES(token_expiry_timestamp),
-            is_active = TRUE,
-            timestamp_added = VALUES(timestamp_added)
-        """
-        params = (
-            user_telegram_id, provider, user_email, 
-            encrypted_access_token, encrypted_refresh_token, 
-            token_expiry_timestamp, timestamp_added
+        oauth_flow.store_connected_account(
+            db_execute_rh, encrypt_data_rh, state_data_row, user_email, access_token, refresh_token, expires_in
         )
-        db_execute_rh(insert_query, params, commit=True)
-        app.logger.info(f"Successfully stored/updated OAuth tokens for user {user_telegram_id}, email {user_email}")
-
-        # 5. حذف state استفاده شده از پایگاه داده
-        db_execute_rh("DELETE FROM oauth_states WHERE state_uuid = %s", (state_from_google,), commit=True)
-        app.logger.info(f"Deleted OAuth state: {state_from_google}")
-
-        return render_template_string(SUCCESS_PAGE_TEMPLATE, email=user_email)
-
+        oauth_state_signer.consume(state_data_row) # فقط پس از ذخیره موفق؛ خطای موقت قبل از آن لینک را باطل نمی‌کند
+        app.logger.info(f"Successfully stored/updated OAuth tokens for user {user_telegram_id}, email {user_email}; consumed state {state_data_row['state_uuid']}")
+        return render_template_string(oauth_flow.SUCCESS_PAGE_TEMPLATE, email=user_email)
     except Exception as e: # گرفتن خطاهای پایگاه داده یا رمزنگاری
         app.logger.error(f"Error saving tokens or deleting state for user {user_telegram_id}, email {user_email}: {e}")
-        return render_template_string(ERROR_PAGE_TEMPLATE, error_message="خطا در ذخیره‌سازی اطلاعات اتصال در سرور."), 500
+        return render_template_string(oauth_flow.ERROR_PAGE_TEMPLATE, error_message="خطا در ذخیره‌سازی اطلاعات اتصال در سرور."), 500
+
+@app.route('/gmail/push', methods=['POST'])
+def gmail_push_notification():
+    """دریافت اعلان push جیمیل (قالب Pub/Sub) و ثبت آن در صف پایدار gmail_push_notifications برای ربات."""
+    if not GMAIL_PUSH_VERIFICATION_TOKEN:
+        app.logger.warning("Gmail push notification rejected: GMAIL_PUSH_VERIFICATION_TOKEN is not configured.")
+        return "push notifications are not configured", 503
+    if not hmac.compare_digest(request.args.get('token', '').encode(), GMAIL_PUSH_VERIFICATION_TOKEN.encode()):
+        app.logger.warning("Gmail push notification rejected: invalid verification token.")
+        return "forbidden", 403
+    envelope = request.get_json(silent=True) or {}
+    try:
+        notification = json.loads(base64.b64decode(envelope['message']['data']))
+        email_address = notification['emailAddress']
+        history_id = str(notification['historyId'])
+    except (KeyError, TypeError, ValueError) as e:
+        app.logger.error(f"Malformed Gmail push notification: {e}")
+        return "bad request", 400 # بازارسال پیام خراب فایده‌ای ندارد
+    inserted = db_execute_rh(
+        "INSERT INTO gmail_push_notifications (email_address, history_id, received_at) VALUES (%s, %s, %s)",
+        (email_address, history_id, int(datetime.now(timezone.utc).timestamp())), commit=True, rowcount=True
+    )
+    if not inserted:
+        return "temporarily unavailable", 503 # Pub/Sub پیام را دوباره ارسال می‌کند
+    return "", 204
 
 if __name__ == '__main__':
     # این بخش برای اجرای مستقیم Flask برای تست است.
-    # در محیط پروداکشن، از Gunicorn یا مشابه استفاده کنید.
+    # در محیط پروداکشن، از Gunicorn با تنظیمات gunicorn.conf.py استفاده کنید: gunicorn redirect_handler_app:app
     # مطمئن شوید که GOOGLE_REDIRECT_URI با آدرس این سرور Flask مطابقت دارد.
     # مثال: اگر این را در لوکال اجرا می‌کنید، GOOGLE_REDIRECT_URI باید http://localhost:5000/oauth2callback باشد.
     app.run(debug=True, port=5000)
@@ -0,0 +1,297 @@
+# schema_migrations.py
+# مهاجرت‌های نسخه‌دار و فقط رو به جلوی طرح پایگاه داده. نسخه اعمال شده در جدول schema_version ثبت می‌شود؛
+# اگر طرح به‌روز باشد، راه‌اندازی فقط یک SELECT است و هیچ دستور DDL اجرا نمی‌شود.
+# برای تغییر طرح، یک تابع جدید به انتهای MIGRATIONS اضافه کنید؛ مهاجرت‌های قبلی را هرگز ویرایش نکنید.
+import logging
+import time
+
+import mysql.connector
+from mysql.connector import errorcode
+
+import admin_stats
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_LOCK_NAME = "mailtotelbot_schema_migrations" # ربات و fetch_workerها ممکن است هم‌زمان راه‌اندازی شوند
+MIGRATION_LOCK_TIMEOUT_SECONDS = 300
+
+SCHEMA_VERSION_DDL = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INT PRIMARY KEY,
+    description VARCHAR(255) NOT NULL,
+    applied_at BIGINT NOT NULL
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+"""
+
+
+# --- توابع کمکی DDL (DDL در MySQL تراکنشی نیست، پس هر مهاجرت باید در اجرای مجدد پس از شکست نیمه‌کاره هم امن باشد) ---
+def add_column_if_missing(cursor, database_name: str, table_name: str, column_name: str, column_definition: str):
+    """افزودن ستون به جدول موجود در صورت عدم وجود (MySQL از ADD COLUMN IF NOT EXISTS پشتیبانی نمی‌کند)."""
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+        (database_name, table_name, column_name)
+    )
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(f"ALTER TABLE `{table_name}` ADD COLUMN `{column_name}` {column_definition}")
+        logger.info(f"Added column {table_name}.{column_name}.")
+
+
+def add_index_if_missing(cursor, database_name: str, table_name: str, index_name: str, columns: str):
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND INDEX_NAME = %s",
+        (database_name, table_name, index_name)
+    )
+    if cursor.fetchone()[0] == 0:
+        cursor.execute(f"ALTER TABLE `{table_name}` ADD INDEX `{index_name}` ({columns})")
+        logger.info(f"Added index {table_name}.{index_name} ({columns}).")
+
+
+# --- مهاجرت‌ها ---
+def _migration_1_baseline(cursor, database_name: str):
+    """جداول پایه؛ روی پایگاه داده‌های ساخته شده پیش از schema_version هم اجرا می‌شود و ستون‌های بعدی را اضافه می‌کند."""
+    # جدول کاربران
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        telegram_id BIGINT PRIMARY KEY,
+        username VARCHAR(255),
+        is_admin BOOLEAN DEFAULT FALSE,
+        subscription_expiry_timestamp BIGINT,
+        max_allowed_emails INT DEFAULT 1,
+        monthly_email_quota INT DEFAULT 10,
+        current_month_emails_received INT DEFAULT 0,
+        last_quota_reset_month VARCHAR(7)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+    # جدول وضعیت‌های OAuth (فقط برای OAUTH_STATE_MODE="db")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS oauth_states (
+        state_uuid VARCHAR(36) PRIMARY KEY,
+        telegram_id BIGINT NOT NULL,
+        provider VARCHAR(50) NOT NULL,
+        timestamp_created BIGINT NOT NULL,
+        chat_id BIGINT,
+        message_id BIGINT
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+    # رویدادهای تکمیل OAuth (redirect handler درج می‌کند، ربات پیام اتصال را ویرایش و ردیف را حذف می‌کند)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS oauth_completion_events (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        state_uuid VARCHAR(36) NOT NULL,
+        telegram_id BIGINT NOT NULL,
+        chat_id BIGINT,
+        message_id BIGINT,
+        email_address VARCHAR(255) NOT NULL,
+        created_at BIGINT NOT NULL
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+    # جدول ایمیل‌های متصل شده با OAuth
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS connected_oauth_emails (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_telegram_id BIGINT NOT NULL,
+        provider VARCHAR(50) NOT NULL,
+        email_address VARCHAR(255) NOT NULL,
+        encrypted_access_token TEXT,
+        encrypted_refresh_token TEXT,
+        token_expiry_timestamp BIGINT,
+        is_active BOOLEAN DEFAULT TRUE,
+        last_processed_email_marker TEXT,
+        gmail_watch_expiration_timestamp BIGINT,
+        lease_owner VARCHAR(100),
+        lease_expires_at BIGINT,
+        timestamp_added BIGINT NOT NULL,
+        FOREIGN KEY (user_telegram_id) REFERENCES users(telegram_id) ON DELETE CASCADE,
+        UNIQUE KEY idx_user_email_provider (user_telegram_id, email_address, provider)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+    # صف پایدار اعلان‌های push جیمیل (redirect_handler_app.py درج می‌کند، ربات مصرف می‌کند)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS gmail_push_notifications (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        email_address VARCHAR(255) NOT NULL,
+        history_id VARCHAR(32) NOT NULL,
+        received_at BIGINT NOT NULL
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+    # صف پایدار پیام‌های خروجی تلگرام (پیام‌های تحویل نشده پس از راه‌اندازی مجدد ارسال می‌شوند)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS telegram_outbox (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        chat_id BIGINT NOT NULL,
+        message_text TEXT NOT NULL,
+        created_at BIGINT NOT NULL
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+    # پردازه‌های واکشی زنده (ضربان قلب) برای تقسیم عادلانه حساب‌ها بین آن‌ها
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS fetch_workers (
+        worker_id VARCHAR(100) PRIMARY KEY,
+        heartbeat_at BIGINT NOT NULL
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+    # ستون‌هایی که پیش از مهاجرت‌های نسخه‌دار به جداول موجود اضافه می‌شدند
+    add_column_if_missing(cursor, database_name, "connected_oauth_emails", "gmail_watch_expiration_timestamp", "BIGINT")
+    add_column_if_missing(cursor, database_name, "connected_oauth_emails", "lease_owner", "VARCHAR(100)")
+    add_column_if_missing(cursor, database_name, "connected_oauth_emails", "lease_expires_at", "BIGINT")
+    add_column_if_missing(cursor, database_name, "oauth_states", "chat_id", "BIGINT")
+    add_column_if_missing(cursor, database_name, "oauth_states", "message_id", "BIGINT")
+
+
+def _migration_2_query_indexes(cursor, database_name: str):
+    """ایندکس‌های ثانویه برای شرط‌های کوئری‌های پرتکرار (کلید اصلی InnoDB به انتهای هر ایندکس ثانویه اضافه می‌شود)."""
+    # iter_active_accounts: WHERE is_active = TRUE ... AND coe.id > %s ORDER BY coe.id
+    add_index_if_missing(cursor, database_name, "connected_oauth_emails", "idx_coe_is_active", "is_active")
+    # حساب‌های هر پردازه (lease_owner = %s) و ادعای lease: lease_owner IS NULL OR lease_expires_at < %s
+    add_index_if_missing(cursor, database_name, "connected_oauth_emails", "idx_coe_lease", "lease_owner, lease_expires_at")
+    # check_oauth_done_callback: WHERE user_telegram_id = %s AND provider = %s ... ORDER BY timestamp_added DESC LIMIT 1
+    add_index_if_missing(cursor, database_name, "connected_oauth_emails", "idx_coe_user_provider_added", "user_telegram_id, provider, timestamp_added")
+    # اعلان‌های push: اتصال gmail_push_notifications به حساب‌ها با email_address
+    add_index_if_missing(cursor, database_name, "connected_oauth_emails", "idx_coe_email", "email_address")
+    # FETCHABLE_ACCOUNT_CONDITIONS و گزارش‌های اشتراک
+    add_index_if_missing(cursor, database_name, "users", "idx_users_subscription_expiry", "subscription_expiry_timestamp")
+    # پاکسازی oauth_states منقضی (oauth_state_sweeper_loop)
+    add_index_if_missing(cursor, database_name, "oauth_states", "idx_oauth_states_created", "timestamp_created")
+    # check_oauth_done_callback: DELETE ... WHERE state_uuid = %s
+    add_index_if_missing(cursor, database_name, "oauth_completion_events", "idx_oauth_events_state", "state_uuid")
+    # پاکسازی اعلان‌های قدیمی: DELETE ... WHERE received_at < %s
+    add_index_if_missing(cursor, database_name, "gmail_push_notifications", "idx_push_received_at", "received_at")
+
+
+def _migration_3_admin_stats(cursor, database_name: str):
+    """جداول آمار پیش‌محاسبه شده دستور /stats (admin_stats.py) و مقداردهی اولیه شمارنده‌ها از داده‌های موجود."""
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name VARCHAR(100) PRIMARY KEY,
+        value BIGINT NOT NULL DEFAULT 0
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS subscription_expiry_days (
+        expiry_day INT PRIMARY KEY,
+        users INT NOT NULL DEFAULT 0
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS stats_snapshots (
+        name VARCHAR(150) PRIMARY KEY,
+        payload TEXT NOT NULL,
+        updated_at BIGINT NOT NULL
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+    # ردیف ثابت توزیع سهمیه؛ پردازه‌های واکشی بازسازی آن را با UPDATE روی updated_at بین خود تقسیم می‌کنند
+    cursor.execute(
+        "INSERT IGNORE INTO stats_snapshots (name, payload, updated_at) VALUES (%s, '{}', 0)", (admin_stats.QUOTA_DISTRIBUTION_SNAPSHOT,)
+    )
+    admin_stats.rebuild_counters(cursor.execute)
+
+
+def _migration_4_email_digests(cursor, database_name: str):
+    """حالت ارسال خلاصه (email_digest.py): ستون حالت ارسال هر حساب، پیام‌های منتظر خلاصه و خلاصه‌های ساخته شده."""
+    add_column_if_missing(cursor, database_name, "connected_oauth_emails", "delivery_mode", "VARCHAR(16) NOT NULL DEFAULT 'immediate'")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS email_digests (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        user_telegram_id BIGINT NOT NULL,
+        item_count INT NOT NULL DEFAULT 0,
+        created_at BIGINT NOT NULL,
+        sent_at BIGINT,
+        INDEX idx_digests_sent (sent_at),
+        INDEX idx_digests_created (created_at)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+    # digest_id خالی یعنی پیام هنوز در هیچ خلاصه‌ای نیست؛ ایندکس هم کاربران سررسید و هم صفحه‌های هر خلاصه را پوشش می‌دهد
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS digest_items (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        digest_id BIGINT,
+        user_telegram_id BIGINT NOT NULL,
+        account_id INT NOT NULL,
+        email_address VARCHAR(255) NOT NULL,
+        gmail_message_id VARCHAR(64) NOT NULL,
+        sender VARCHAR(255),
+        subject VARCHAR(500),
+        snippet TEXT,
+        created_at BIGINT NOT NULL,
+        INDEX idx_digest_items_digest (digest_id, user_telegram_id, created_at)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+    """)
+
+
+def _migration_5_account_filter_rules(cursor, database_name: str):
+    """قوانین فیلتر هر حساب (email_filters.py) به صورت JSON؛ همراه ردیف مجموعه کار واکشی خوانده می‌شود."""
+    add_column_if_missing(cursor, database_name, "connected_oauth_emails", "filter_rules", "TEXT")
+
+
+
+def _migration_6_forwarding_progress(cursor, database_name: str):
+    """آخرین پیام ارسال شده از فهرست پیام‌های marker فعلی؛ اگر واکشی پیش از ثبت marker جدید قطع شود، دور بعد از پس از آن ادامه می‌دهد."""
+    add_column_if_missing(cursor, database_name, "connected_oauth_emails", "last_forwarded_message_id", "VARCHAR(64) NULL")
+
+
+
+def _migration_7_outbox_attachments(cursor, database_name: str):
+    """کار ارسال پیوست (JSON: حساب، پیام، attachmentId، نام و اندازه) در telegram_outbox؛ message_text برای آن‌ها caption است."""
+    add_column_if_missing(cursor, database_name, "telegram_outbox", "attachment_job", "MEDIUMTEXT NULL")
+
+
+# (نسخه، توضیح، تابع اعمال)؛ فقط به انتها اضافه کنید
+MIGRATIONS = [
+    (1, "baseline tables", _migration_1_baseline),
+    (2, "secondary indexes for hot queries", _migration_2_query_indexes),
+    (3, "precomputed admin statistics", _migration_3_admin_stats),
+    (4, "email digest delivery mode", _migration_4_email_digests),
+    (5, "per-account filter rules", _migration_5_account_filter_rules),
+    (6, "per-batch forwarding progress", _migration_6_forwarding_progress),
+    (7, "attachment jobs in the Telegram outbox", _migration_7_outbox_attachments),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(cursor) -> int:
+    """بالاترین نسخه اعمال شده؛ 0 اگر جدول schema_version هنوز وجود نداشته باشد."""
+    try:
+        cursor.execute("SELECT MAX(version) FROM schema_version")
+    except mysql.connector.Error as err:
+        if err.errno == errorcode.ER_NO_SUCH_TABLE: return 0
+        raise
+    row = cursor.fetchone()
+    return row[0] or 0 if row else 0
+
+
+def migrate(conn, database_name: str) -> int:
+    """اعمال مهاجرت‌های باقی مانده به ترتیب؛ تعداد مهاجرت‌های اعمال شده را برمی‌گرداند.
+
+    اگر طرح به‌روز باشد فقط یک SELECT اجرا می‌شود. در غیر این صورت با GET_LOCK فقط یک پردازه مهاجرت‌ها را اعمال می‌کند
+    و پردازه‌های دیگر پس از آزاد شدن قفل نسخه جدید را می‌بینند.
+    """
+    cursor = conn.cursor()
+    try:
+        version = current_version(cursor)
+        if version >= LATEST_VERSION:
+            if version > LATEST_VERSION:
+                logger.warning(f"Database schema version {version} is newer than this code ({LATEST_VERSION}).")
+            return 0
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATION_LOCK_NAME, MIGRATION_LOCK_TIMEOUT_SECONDS))
+        if cursor.fetchone()[0] != 1:
+            raise RuntimeError(f"Timed out waiting for the schema migration lock '{MIGRATION_LOCK_NAME}'.")
+        try:
+            cursor.execute(SCHEMA_VERSION_DDL)
+            version = current_version(cursor) # ممکن است پردازه دیگری در این فاصله مهاجرت‌ها را اعمال کرده باشد
+            applied = 0
+            for migration_version, description, apply_migration in MIGRATIONS:
+                if migration_version <= version: continue
+                logger.info(f"Applying schema migration {migration_version}: {description}")
+                apply_migration(cursor, database_name)
+                cursor.execute(
+                    "INSERT INTO schema_version (version, description, applied_at) VALUES (%s, %s, %s)",
+                    (migration_version, description, int(time.time()))
+                )
+                conn.commit()
+                applied += 1
+            return applied
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK_NAME,))
+            cursor.fetchone()
+    finally:
+        cursor.close()
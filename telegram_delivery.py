@@ -0,0 +1,335 @@
+# telegram_delivery.py
+# صف خروجی پیام‌های تلگرام: پایدار در جدول telegram_outbox، با محدودیت نرخ سراسری و هر چت،
+# رعایت retry_after و ادغام پیام‌های کوچک یک چت در یک پیام.
+# پیوست‌ها به صورت کار (attachment_job) در همان صف و پشت پیام متنی ایمیل ذخیره می‌شوند و با همان محدودیت‌ها در نخ‌های
+# جداگانه دریافت و به صورت جریانی (TelegramDocumentSender) ارسال می‌شوند.
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+import httpx
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MESSAGE_MAX_CHARS = 4096
+TELEGRAM_CAPTION_MAX_CHARS = 1024
+TELEGRAM_UPLOAD_MAX_BYTES = 50 * 1024 * 1024 # سقف Bot API برای ارسال فایل
+COALESCE_SEPARATOR = "\n\n━━━━━━━━━━\n\n"
+
+
+class OutboxWriteError(Exception):
+    """ذخیره پیام در telegram_outbox ناموفق بود؛ فراخوانی‌کننده نباید آن پیام را ارسال شده حساب کند."""
+
+
+class AttachmentUnavailableError(Exception):
+    """پیوست قابل دریافت یا ارسال نیست (حساب قطع شده، پیام حذف شده، اندازه بیش از سقف)؛ کار بدون تلاش مجدد کنار گذاشته می‌شود."""
+
+
+class TokenBucket:
+    """سطل توکن ساده: rate توکن در ثانیه با ظرفیت burst."""
+
+    def __init__(self, rate_per_second: float, burst: float):
+        self.rate_per_second = rate_per_second
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def wait_time(self, now: float) -> float:
+        """ثانیه‌های باقی مانده تا در دسترس بودن یک توکن (0 یعنی همین حالا)."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate_per_second)
+        self.updated_at = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate_per_second
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        return self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, timedelta) else float(retry_after)
+
+
+class TelegramDeliveryQueue:
+    """صف تحویل پیام‌ها به تلگرام.
+
+    enqueue() و enqueue_many() از هر نخی قابل فراخوانی‌اند و پیام‌ها را در telegram_outbox ذخیره می‌کنند؛
+    run() روی حلقه رویداد ربات اجرا می‌شود، پیام‌های ذخیره شده را بارگذاری و با رعایت محدودیت‌ها ارسال می‌کند
+    و ردیف‌های تحویل شده را به صورت گروهی حذف می‌کند. پیام‌های تحویل نشده پس از راه‌اندازی مجدد ارسال می‌شوند.
+
+    کارهای پیوست با attachment_sender(chat_id، job، caption) در حداکثر max_concurrent_uploads نخ اجرا می‌شوند؛ تا پایان
+    ارسال یک پیوست، پیام‌های بعدی همان چت منتظر می‌مانند. attachment_sender خطاهای تلگرام را با همان انواع PTB
+    (RetryAfter، BadRequest، Forbidden، NetworkError) و پیوست غیرقابل دریافت را با AttachmentUnavailableError گزارش می‌دهد.
+    """
+
+    def __init__(self, db_execute, run_db, global_rate_per_second: float = 25, per_chat_rate_per_second: float = 1,
+                 per_chat_burst: float = 3, coalesce_max_chars: int = 1000, poll_seconds: float = 1,
+                 max_in_memory: int = 5000, max_attempts: int = 5, attachment_sender=None, max_concurrent_uploads: int = 2):
+        self._db_execute = db_execute
+        self._run_db = run_db
+        self.per_chat_rate_per_second = per_chat_rate_per_second
+        self.per_chat_burst = per_chat_burst
+        self.coalesce_max_chars = coalesce_max_chars
+        self.poll_seconds = poll_seconds
+        self.max_in_memory = max_in_memory
+        self.max_attempts = max_attempts
+        self.max_concurrent_uploads = max(1, max_concurrent_uploads)
+        self._attachment_sender = attachment_sender
+        self._upload_executor = ThreadPoolExecutor(max_workers=self.max_concurrent_uploads, thread_name_prefix="attachment_upload")
+        self._uploading_chats = set()
+        self._upload_tasks = set()
+        self._global_bucket = TokenBucket(global_rate_per_second, global_rate_per_second)
+        self._global_blocked_until = 0.0
+        self._chat_buckets = {}
+        self._chat_blocked_until = {}
+        self._pending = {} # chat_id -> deque[(row_id, text, attempts, attachment_job)]
+        self._ready_chats = deque() # چت‌های دارای پیام، به ترتیب نوبت (round-robin)
+        self._known_ids = set() # ردیف‌هایی که در حافظه هستند یا منتظر حذف‌اند
+        self._finished_ids = [] # ردیف‌های تحویل شده (یا کنار گذاشته شده) منتظر حذف از پایگاه داده
+        self._loop = None
+        self._wakeup = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'enqueued': 0, 'sent_messages': 0, 'sent_items': 0, 'retry_after': 0, 'retries': 0, 'dropped': 0}
+        self._recent_sends = deque() # (monotonic, items) برای محاسبه نرخ ارسال در 60 ثانیه اخیر
+
+    # --- سمت تولیدکننده (نخ‌های واکشی) ---
+    def enqueue(self, chat_id: int, text: str):
+        """ذخیره یک پیام برای ارسال؛ از هر نخ یا فرآیندی که به پایگاه داده دسترسی دارد قابل فراخوانی است.
+
+        اگر ردیف ذخیره نشود (db_execute خطا را فقط ثبت می‌کند) OutboxWriteError داده می‌شود.
+        """
+        self.enqueue_many(chat_id, [text])
+
+    def enqueue_many(self, chat_id: int, texts: list, attachment_jobs=()):
+        """ذخیره پیام‌های متنی و سپس کارهای پیوست ((caption، job) با job قابل تبدیل به JSON) با یک INSERT؛ همه یا هیچ.
+
+        ترتیب ردیف‌ها ترتیب ارسال در چت است. در صورت ذخیره نشدن OutboxWriteError داده می‌شود.
+        """
+        rows = [(text[:TELEGRAM_MESSAGE_MAX_CHARS], None) for text in texts]
+        rows.extend((caption[:TELEGRAM_CAPTION_MAX_CHARS], json.dumps(job, ensure_ascii=False)) for caption, job in attachment_jobs)
+        if not rows: return
+        created_at = int(time.time())
+        inserted = self._db_execute(
+            f"INSERT INTO telegram_outbox (chat_id, message_text, attachment_job, created_at) VALUES {', '.join(['(%s, %s, %s, %s)'] * len(rows))}",
+            tuple(value for text, job in rows for value in (chat_id, text, job, created_at)), commit=True, row_count=True
+        )
+        if inserted != len(rows): raise OutboxWriteError(f"could not store {len(rows)} message(s) for chat {chat_id} in telegram_outbox")
+        with self._stats_lock: self._stats['enqueued'] += len(rows)
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    # --- سمت مصرف‌کننده (حلقه رویداد ربات) ---
+    async def run(self, bot):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        last_load_at = 0.0
+        while True:
+            try:
+                if self._wakeup.is_set() or time.monotonic() - last_load_at >= self.poll_seconds:
+                    self._wakeup.clear()
+                    await self._sync_with_outbox()
+                    last_load_at = time.monotonic()
+                wait_seconds = await self._deliver_next(bot)
+            except asyncio.CancelledError:
+                for task in list(self._upload_tasks): task.cancel() # ردیف‌های آن‌ها در telegram_outbox می‌مانند
+                raise
+            except Exception as e:
+                logger.error(f"Error in Telegram delivery loop: {e}")
+                wait_seconds = self.poll_seconds
+            if wait_seconds > 0:
+                try: await asyncio.wait_for(self._wakeup.wait(), timeout=min(wait_seconds, self.poll_seconds))
+                except asyncio.TimeoutError: pass
+
+    async def flush(self):
+        """حذف ردیف‌های تحویل شده از telegram_outbox (مثلاً هنگام خاموش شدن)."""
+        if not self._finished_ids: return
+        finished_ids, self._finished_ids = self._finished_ids, []
+        await self._run_db(
+            self._db_execute,
+            f"DELETE FROM telegram_outbox WHERE id IN ({', '.join(['%s'] * len(finished_ids))})",
+            tuple(finished_ids), commit=True
+        )
+        self._known_ids.difference_update(finished_ids)
+
+    async def _sync_with_outbox(self):
+        await self.flush()
+        if len(self._known_ids) >= self.max_in_memory: return
+        # ردیف‌های قدیمی‌تر معمولاً همان‌هایی‌اند که در حافظه هستند؛ LIMIT طوری است که ردیف‌های جدید هم برگردند
+        rows = await self._run_db(
+            self._db_execute,
+            "SELECT id, chat_id, message_text, attachment_job FROM telegram_outbox ORDER BY id LIMIT %s",
+            (len(self._known_ids) + min(500, self.max_in_memory),), fetchall=True
+        ) or []
+        for row in rows:
+            if row['id'] in self._known_ids: continue
+            self._known_ids.add(row['id'])
+            self._push(row['chat_id'], (row['id'], row['message_text'], 0, json.loads(row['attachment_job']) if row['attachment_job'] else None))
+        if len(self._chat_buckets) > 2 * len(self._pending) + 1000: # حذف سطل‌های چت‌های بیکار
+            now = time.monotonic()
+            for chat_id in [c for c, b in self._chat_buckets.items() if c not in self._pending and b.is_full(now)]:
+                del self._chat_buckets[chat_id]
+                self._chat_blocked_until.pop(chat_id, None)
+
+    def _push(self, chat_id: int, item, front: bool = False):
+        if chat_id not in self._pending:
+            self._pending[chat_id] = deque()
+            self._ready_chats.append(chat_id)
+        if front: self._pending[chat_id].appendleft(item)
+        else: self._pending[chat_id].append(item)
+
+    def _take_coalesced(self, chat_id: int) -> list:
+        """برداشتن اولین پیام چت و ادغام پیام‌های کوچک بعدی تا سقف طول پیام تلگرام (کارهای پیوست ادغام نمی‌شوند)."""
+        chat_queue = self._pending[chat_id]
+        items = [chat_queue.popleft()]
+        total_chars = len(items[0][1])
+        while (chat_queue and items[0][3] is None and chat_queue[0][3] is None
+               and len(items[0][1]) <= self.coalesce_max_chars
+               and len(chat_queue[0][1]) <= self.coalesce_max_chars
+               and total_chars + len(COALESCE_SEPARATOR) + len(chat_queue[0][1]) <= TELEGRAM_MESSAGE_MAX_CHARS):
+            item = chat_queue.popleft()
+            items.append(item)
+            total_chars += len(COALESCE_SEPARATOR) + len(item[1])
+        if not chat_queue:
+            del self._pending[chat_id]
+            self._ready_chats.remove(chat_id)
+        return items
+
+    async def _deliver_next(self, bot) -> float:
+        """ارسال یک پیام در صورت امکان؛ 0 یا مدت انتظار تا امکان ارسال بعدی را برمی‌گرداند."""
+        if not self._ready_chats: return self.poll_seconds
+        now = time.monotonic()
+        global_wait = max(self._global_blocked_until - now, self._global_bucket.wait_time(now))
+        if global_wait > 0: return global_wait
+        min_wait = self.poll_seconds
+        for _ in range(len(self._ready_chats)):
+            chat_id = self._ready_chats[0]
+            self._ready_chats.rotate(-1)
+            if chat_id in self._uploading_chats: continue # بعد از پایان ارسال پیوست، بیدار می‌شود
+            is_upload = self._pending[chat_id][0][3] is not None
+            if is_upload and len(self._uploading_chats) >= self.max_concurrent_uploads: continue
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate_per_second, self.per_chat_burst)
+            chat_wait = max(self._chat_blocked_until.get(chat_id, 0) - now, bucket.wait_time(now))
+            if chat_wait > 0:
+                min_wait = min(min_wait, chat_wait); continue
+            bucket.take()
+            self._global_bucket.take()
+            if is_upload:
+                self._uploading_chats.add(chat_id)
+                task = asyncio.create_task(self._upload(chat_id, self._take_coalesced(chat_id)))
+                self._upload_tasks.add(task)
+                task.add_done_callback(self._upload_tasks.discard)
+            else:
+                await self._send(bot, chat_id, self._take_coalesced(chat_id))
+            return 0
+        return min_wait
+
+    async def _upload(self, chat_id: int, items: list):
+        try:
+            await self._send(None, chat_id, items)
+        finally:
+            self._uploading_chats.discard(chat_id)
+            self._wakeup.set()
+
+    async def _send(self, bot, chat_id: int, items: list):
+        try:
+            attachment_job = items[0][3]
+            if attachment_job is not None:
+                if self._attachment_sender is None: raise AttachmentUnavailableError("no attachment sender configured")
+                await self._loop.run_in_executor(self._upload_executor, self._attachment_sender, chat_id, attachment_job, items[0][1])
+            else:
+                await bot.send_message(chat_id=chat_id, text=COALESCE_SEPARATOR.join(item[1] for item in items))
+        except RetryAfter as e:
+            retry_seconds = _retry_after_seconds(e)
+            blocked_until = time.monotonic() + retry_seconds
+            self._chat_blocked_until[chat_id] = blocked_until
+            self._global_blocked_until = max(self._global_blocked_until, blocked_until)
+            for item in reversed(items): self._push(chat_id, item, front=True)
+            with self._stats_lock: self._stats['retry_after'] += 1
+            logger.warning(f"Telegram flood control for chat {chat_id}: pausing deliveries for {retry_seconds:.0f}s.")
+            return
+        except (BadRequest, Forbidden, AttachmentUnavailableError) as e: # کاربر ربات را مسدود کرده یا پیام نامعتبر است؛ تلاش مجدد فایده‌ای ندارد
+            logger.warning(f"Dropping {len(items)} message(s) for chat {chat_id}: {e}")
+            self._finished_ids.extend(item[0] for item in items)
+            with self._stats_lock: self._stats['dropped'] += len(items)
+            return
+        except Exception as e: # NetworkError یا خطای دریافت پیوست؛ با تأخیر نمایی دوباره تلاش می‌شود
+            attempts = items[0][2] + 1
+            if attempts >= self.max_attempts:
+                logger.error(f"Giving up on {len(items)} message(s) for chat {chat_id} after {attempts} attempts: {e}")
+                self._finished_ids.extend(item[0] for item in items)
+                with self._stats_lock: self._stats['dropped'] += len(items)
+                return
+            for item in reversed(items): self._push(chat_id, (item[0], item[1], attempts, item[3]), front=True)
+            self._chat_blocked_until[chat_id] = time.monotonic() + 2 ** attempts
+            with self._stats_lock: self._stats['retries'] += 1
+            logger.warning(f"Network error delivering to chat {chat_id} (attempt {attempts}): {e}")
+            return
+        self._finished_ids.extend(item[0] for item in items)
+        now = time.monotonic()
+        self._recent_sends.append((now, len(items)))
+        while self._recent_sends and self._recent_sends[0][0] < now - 60: self._recent_sends.popleft()
+        with self._stats_lock:
+            self._stats['sent_messages'] += 1
+            self._stats['sent_items'] += len(items)
+
+    def stats(self) -> dict:
+        """آمار تحویل: تعداد ارسال‌ها، عمق صف و نرخ ارسال در دقیقه اخیر."""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = sum(len(q) for q in list(self._pending.values()))
+        stats['chats_waiting'] = len(self._pending)
+        window_start = time.monotonic() - 60
+        stats['items_per_second_1m'] = sum(n for sent_at, n in list(self._recent_sends) if sent_at >= window_start) / 60
+        return stats
+
+
+class TelegramDocumentSender:
+    """یک تلاش ارسال فایل (پیوست ایمیل) به sendDocument در Bot API؛ تلاش مجدد و محدودیت نرخ با TelegramDeliveryQueue است.
+
+    PTB محتوای InputFile را کامل در حافظه می‌خواند؛ اینجا httpx بدنه multipart را تکه تکه از فایل (مثلاً SpooledTemporaryFile)
+    می‌سازد. پاسخ‌های ناموفق به همان خطاهای PTB تبدیل می‌شوند تا صف با آن‌ها مثل پیام‌های متنی رفتار کند.
+    """
+
+    def __init__(self, bot_token: str, base_url: str = "https://api.telegram.org", timeout_seconds: float = 120):
+        self._url = f"{base_url}/bot{bot_token}/sendDocument"
+        self._client = httpx.Client(timeout=timeout_seconds)
+        self._stats_lock = threading.Lock()
+        self._stats = {'sent': 0, 'errors': 0, 'bytes_sent': 0}
+
+    def upload(self, chat_id: int, file_obj, filename: str, caption: str = ""):
+        """ارسال فایل از ابتدای file_obj؛ در صورت عدم موفقیت RetryAfter، Forbidden، BadRequest یا NetworkError."""
+        file_obj.seek(0)
+        try:
+            response = self._client.post(
+                self._url, data={'chat_id': str(chat_id), 'caption': caption[:TELEGRAM_CAPTION_MAX_CHARS]},
+                files={'document': (filename, file_obj)}
+            )
+            result = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            with self._stats_lock: self._stats['errors'] += 1
+            raise NetworkError(f"sendDocument failed: {e}") from e
+        if result.get('ok'):
+            with self._stats_lock:
+                self._stats['sent'] += 1
+                self._stats['bytes_sent'] += file_obj.tell()
+            return
+        with self._stats_lock: self._stats['errors'] += 1
+        description = result.get('description') or f"HTTP {response.status_code}"
+        if response.status_code == 429: raise RetryAfter(result.get('parameters', {}).get('retry_after', 5))
+        if response.status_code == 403: raise Forbidden(description)
+        if response.status_code >= 500: raise NetworkError(description)
+        raise BadRequest(description)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return dict(self._stats)
@@ -0,0 +1,5 @@
+# ماژول‌های پروژه در ریشه مخزن هستند (بدون بسته)؛ تست‌ها از هر پوشه‌ای قابل اجرا باشند
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
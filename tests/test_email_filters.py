@@ -0,0 +1,132 @@
+import pytest
+
+import email_filters
+
+
+def _message(labels=('INBOX',), size=None):
+    message = {'labelIds': list(labels)}
+    if size is not None: message['sizeEstimate'] = size
+    return message
+
+
+def _filter(*rule_texts):
+    return email_filters.MessageFilter([email_filters.parse_rule(text) for text in rule_texts])
+
+
+# --- parse_rule ---
+@pytest.mark.parametrize('text, rule', [
+    ("from: Boss@Example.com", {'kind': 'from', 'value': 'boss@example.com'}),
+    ("FROM:boss", {'kind': 'from', 'value': 'boss'}),
+    ("-from: noreply@", {'kind': 'not_from', 'value': 'noreply@'}),
+    ("subject: Invoice", {'kind': 'subject', 'value': 'invoice'}),
+    ("subject: time: 10:30", {'kind': 'subject', 'value': 'time: 10:30'}),
+    ("subject: فاکتور", {'kind': 'subject', 'value': 'فاکتور'}),
+    ("label: My Label", {'kind': 'label', 'value': 'my-label'}),
+    ("larger: 2M", {'kind': 'larger', 'value': 2 * 1024 * 1024}),
+    ("smaller: 500k", {'kind': 'smaller', 'value': 500 * 1024}),
+    ("larger: 100KB", {'kind': 'larger', 'value': 100 * 1024}),
+    ("larger: 1234", {'kind': 'larger', 'value': 1234}),
+])
+def test_parse_rule(text, rule):
+    assert email_filters.parse_rule(text) == rule
+
+
+def test_parse_rule_strips_query_syntax():
+    # نقل‌قول، آکولاد و پرانتز ساختار جستجوی Gmail را تغییر می‌دهند
+    assert email_filters.parse_rule('from: "a" OR {b} (c)') == {'kind': 'from', 'value': 'a or b c'}
+
+
+@pytest.mark.parametrize('text', [
+    "boss@example.com", # بدون نوع
+    "to: boss", # نوع ناشناخته
+    "from:", "from:   ", 'from: ""', # مقدار خالی
+    "from: " + "x" * (email_filters.MAX_RULE_VALUE_CHARS + 1),
+    "larger: big", "larger: 2G", "smaller: -1",
+])
+def test_parse_rule_rejects_invalid_text(text):
+    with pytest.raises(ValueError):
+        email_filters.parse_rule(text)
+
+
+def test_rules_round_trip_through_json():
+    rules = [email_filters.parse_rule("subject: سلام"), email_filters.parse_rule("larger: 1M")]
+    assert email_filters.load_rules(email_filters.dump_rules(rules)) == rules
+    assert email_filters.dump_rules([]) is None and email_filters.load_rules(None) == []
+
+
+def test_describe_rule():
+    assert email_filters.describe_rule({'kind': 'larger', 'value': 2 * 1024 * 1024}) == "بزرگ‌تر از: 2M"
+    assert email_filters.describe_rule({'kind': 'from', 'value': 'a@b'}) == "فرستنده شامل: a@b"
+
+
+# --- gmail_query ---
+def test_gmail_query_same_kind_or_different_kinds_and():
+    query = _filter("from: a@x", "from: b@y", "subject: invoice", "-from: spam@", "-from: ads@",
+                    "larger: 1K", "larger: 2K", "smaller: 1M", "smaller: 2M").gmail_query
+    assert query == ('{from:"a@x" from:"b@y"} subject:"invoice" -from:"spam@" -from:"ads@" '
+                     f'larger:{2 * 1024} smaller:{1024 * 1024}')
+
+
+def test_gmail_query_single_rule_has_no_braces():
+    assert _filter("label: work").gmail_query == 'label:"work"'
+    assert email_filters.MessageFilter([]).gmail_query == ""
+
+
+# --- matches ---
+def test_matches_from_is_case_insensitive_substring_and_any_of():
+    message_filter = _filter("from: boss@example.com", "from: hr@")
+    assert message_filter.matches(_message(), 'The Boss <BOSS@Example.com>', '')
+    assert message_filter.matches(_message(), 'hr@company.com', '')
+    assert not message_filter.matches(_message(), 'someone@else.com', '')
+    assert not message_filter.matches(_message(), None, '')
+
+
+def test_matches_not_from_excludes_each_sender():
+    message_filter = _filter("-from: noreply@", "-from: ads@")
+    assert message_filter.matches(_message(), 'friend@x.com', '')
+    assert not message_filter.matches(_message(), 'NoReply@service.com', '')
+    assert not message_filter.matches(_message(), 'ads@shop.com', '')
+    assert message_filter.matches(_message(), None, '')
+
+
+def test_matches_kinds_are_combined_with_and():
+    message_filter = _filter("from: boss", "subject: invoice")
+    assert message_filter.matches(_message(), 'boss@x', 'Your Invoice')
+    assert not message_filter.matches(_message(), 'boss@x', 'hello')
+    assert not message_filter.matches(_message(), 'other@x', 'invoice')
+
+
+def test_matches_escapes_regex_characters():
+    message_filter = _filter("subject: [urgent] a+b")
+    assert message_filter.matches(_message(), '', 'RE: [URGENT] a+b now')
+    assert not message_filter.matches(_message(), '', 'urgent aab')
+
+
+def test_matches_system_labels_locally_and_passes_user_labels():
+    assert _filter("label: starred").matches(_message(['INBOX', 'STARRED']), '', '')
+    assert not _filter("label: starred").matches(_message(['INBOX']), '', '')
+    assert _filter("label: category_updates").matches(_message(['CATEGORY_UPDATES']), '', '')
+    # برچسب کاربر در labelIds با شناسه می‌آید؛ فقط جستجوی سمت سرور آن را بررسی می‌کند
+    assert _filter("label: my work").matches(_message(['INBOX']), '', '')
+    assert _filter("label: starred", "label: my work").matches(_message(['INBOX']), '', '')
+
+
+def test_matches_size_bounds_are_exclusive_like_gmail():
+    message_filter = _filter("larger: 1K", "smaller: 2K")
+    assert message_filter.matches(_message(size=1500), '', '')
+    assert not message_filter.matches(_message(size=1024), '', '')
+    assert not message_filter.matches(_message(size=2048), '', '')
+    assert message_filter.matches(_message(), '', '') # بدون sizeEstimate رد نمی‌شود
+
+
+def test_empty_filter_matches_everything():
+    assert email_filters.MessageFilter([]).matches(_message(['SPAM']), None, None)
+
+
+# --- compile_rules ---
+def test_compile_rules_caches_by_text():
+    rules_json = email_filters.dump_rules([email_filters.parse_rule("from: cached@x")])
+    first = email_filters.compile_rules(rules_json)
+    assert first is email_filters.compile_rules(rules_json)
+    assert first.matches(_message(), 'cached@x', '')
+    assert email_filters.compile_rules(None) is None and email_filters.compile_rules('') is None
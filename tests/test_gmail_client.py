@@ -0,0 +1,60 @@
+import pytest
+
+import gmail_client
+
+
+# --- skip_forwarded_message_ids ---
+def test_skip_forwarded_resumes_after_last_forwarded():
+    assert gmail_client.skip_forwarded_message_ids(['a', 'b', 'c', 'd'], 'b') == ['c', 'd']
+
+
+def test_skip_forwarded_when_everything_was_forwarded():
+    assert gmail_client.skip_forwarded_message_ids(['a', 'b'], 'b') == []
+
+
+def test_skip_forwarded_keeps_messages_added_since():
+    # دور بعد با همان marker: پیام‌های جدید به انتهای همان فهرست اضافه شده‌اند
+    assert gmail_client.skip_forwarded_message_ids(['a', 'b', 'c', 'new'], 'c') == ['new']
+
+
+@pytest.mark.parametrize('forwarded_through', [None, '', 'missing'])
+def test_skip_forwarded_without_usable_progress_returns_all(forwarded_through):
+    message_ids = ['a', 'b']
+    assert gmail_client.skip_forwarded_message_ids(message_ids, forwarded_through) == message_ids
+
+
+# --- list_history_message_ids ---
+def _history_pages(monkeypatch, pages):
+    requests_seen = []
+    def fake_gmail_get(access_token, path, params=None):
+        requests_seen.append(dict(params))
+        return pages[len(requests_seen) - 1]
+    monkeypatch.setattr(gmail_client, '_gmail_get', fake_gmail_get)
+    return requests_seen
+
+
+def _record(history_id, *message_ids, labels=('INBOX',)):
+    return {'id': history_id, 'messagesAdded': [{'message': {'id': message_id, 'labelIds': list(labels)}} for message_id in message_ids]}
+
+
+def test_history_lists_all_pages_in_order_and_dedups(monkeypatch):
+    requests_seen = _history_pages(monkeypatch, [
+        {'history': [_record('11', 'a'), _record('12', 'b', 'a')], 'nextPageToken': 'p2', 'historyId': '20'},
+        {'history': [_record('13', 'c'), _record('14', 'd', labels=('SENT',))], 'historyId': '20'},
+    ])
+    assert gmail_client.list_history_message_ids('token', '10') == (['a', 'b', 'c'], '20')
+    assert [params.get('pageToken') for params in requests_seen] == [None, 'p2']
+
+
+def test_history_truncated_at_max_pages_returns_last_record_id(monkeypatch):
+    _history_pages(monkeypatch, [
+        {'history': [_record('11', 'a'), _record('12', 'b')], 'nextPageToken': 'p2', 'historyId': '99'},
+        {'history': [_record('13', 'c')], 'nextPageToken': 'p3', 'historyId': '99'},
+    ])
+    # historyId صندوق (99) صفحه‌های خوانده نشده را رد می‌کرد؛ دور بعد از آخرین رکورد خوانده شده ادامه می‌یابد
+    assert gmail_client.list_history_message_ids('token', '10', max_pages=2) == (['a', 'b', 'c'], '13')
+
+
+def test_history_without_records_keeps_mailbox_history_id(monkeypatch):
+    _history_pages(monkeypatch, [{'historyId': '42'}])
+    assert gmail_client.list_history_message_ids('token', '10') == ([], '42')
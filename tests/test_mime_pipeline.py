@@ -0,0 +1,246 @@
+import base64
+import json
+import os
+
+import pytest
+
+import mime_pipeline
+
+
+def _chunks(data: bytes, size: int):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+def _b64url(raw: bytes, padded: bool = False) -> str:
+    encoded = base64.urlsafe_b64encode(raw).decode()
+    return encoded if padded else encoded.rstrip('=')
+
+
+# --- iter_base64url_chunks ---
+@pytest.mark.parametrize('length', [0, 1, 2, 3, 4, 5, 299, 300, 301])
+@pytest.mark.parametrize('chunk_chars', [4, 5, 7, 8, 64])
+def test_base64url_chunks_round_trip(length, chunk_chars):
+    raw = os.urandom(length)
+    for padded in (False, True):
+        assert b''.join(mime_pipeline.iter_base64url_chunks(_b64url(raw, padded), chunk_chars)) == raw
+
+
+def test_base64url_chunks_accept_urlsafe_alphabet():
+    raw = bytes([0xfb, 0xff, 0xfe] * 10) # رمزگذاری شامل «-» و «_»
+    encoded = _b64url(raw)
+    assert '-' in encoded or '_' in encoded
+    assert b''.join(mime_pipeline.iter_base64url_chunks(encoded, 8)) == raw
+
+
+# --- iter_json_base64_field ---
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 5, 7, 64, 100000])
+def test_json_field_decodes_across_any_chunk_boundary(chunk_size):
+    raw = os.urandom(1000)
+    response = json.dumps({'size': len(raw), 'data': _b64url(raw, padded=True)}).encode()
+    assert b''.join(mime_pipeline.iter_json_base64_field(_chunks(response, chunk_size))) == raw
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 4, 5, 6])
+def test_json_field_escape_split_across_chunks(chunk_size):
+    raw = os.urandom(30)
+    encoded = _b64url(raw, padded=True)
+    # یک کاراکتر به صورت \uXXXX و padding به صورت = (مثل رمزگذارهای JSON سخت‌گیر)
+    escaped = encoded[:5] + '\\u%04x' % ord(encoded[5]) + encoded[6:].replace('=', '\\u003d')
+    response = ('{"data": "' + escaped + '"}').encode()
+    assert b''.join(mime_pipeline.iter_json_base64_field(_chunks(response, chunk_size))) == raw
+
+
+def test_json_field_escaped_slash_in_standard_alphabet():
+    raw = bytes([0xff, 0xff, 0xff])
+    standard = base64.b64encode(raw).decode() # "////"
+    response = json.dumps({'data': standard}).encode() # json.dumps «/» را escape نمی‌کند
+    response = response.replace(b'/', b'\\/')
+    assert b''.join(mime_pipeline.iter_json_base64_field(_chunks(response, 3))) == raw
+
+
+@pytest.mark.parametrize('chunk_size', [1, 4, 9, 1000])
+def test_json_field_ignores_nested_keys_and_string_values(chunk_size):
+    raw = os.urandom(64)
+    response = json.dumps({
+        'note': 'data', # همان نام به عنوان مقدار
+        'meta': {'data': _b64url(b'nested object')},
+        'parts': [{'data': _b64url(b'nested array')}],
+        'attachmentId': 'ANGjdJdata',
+        'data': _b64url(raw),
+        'size': len(raw),
+    }).encode()
+    assert b''.join(mime_pipeline.iter_json_base64_field(_chunks(response, chunk_size))) == raw
+
+
+def test_json_field_with_whitespace_around_colon():
+    raw = b'hello world'
+    response = b'{\n  "size" : 11 ,\n  "data"  :\n  "' + _b64url(raw).encode() + b'"\n}'
+    assert b''.join(mime_pipeline.iter_json_base64_field(_chunks(response, 2))) == raw
+
+
+def test_json_field_custom_name():
+    response = json.dumps({'data': _b64url(b'no'), 'body': _b64url(b'yes')}).encode()
+    assert b''.join(mime_pipeline.iter_json_base64_field(_chunks(response, 5), 'body')) == b'yes'
+
+
+@pytest.mark.parametrize('response', [
+    b'{"size": 10}',
+    b'{"meta": {"data": "aGk"}}',
+    b'{"note": "data"}',
+    b'{"data": "aGVsbG8',
+    b'',
+])
+def test_json_field_missing_or_truncated(response):
+    with pytest.raises(ValueError):
+        b''.join(mime_pipeline.iter_json_base64_field(_chunks(response, 3)))
+
+
+def test_json_field_not_a_string():
+    with pytest.raises(ValueError):
+        b''.join(mime_pipeline.iter_json_base64_field([b'{"data": null}']))
+
+
+def test_json_field_stops_reading_after_value():
+    consumed = []
+    def chunks():
+        for chunk in (b'{"data": "aGk"', b', "size": 2}', b'never read'):
+            consumed.append(chunk)
+            yield chunk
+    assert b''.join(mime_pipeline.iter_json_base64_field(chunks())) == b'hi'
+    assert consumed == [b'{"data": "aGk"']
+
+
+# --- split_text ---
+def test_split_text_short_text_unchanged():
+    assert mime_pipeline.split_text("سلام") == ["سلام"]
+    assert mime_pipeline.split_text("") == []
+
+
+def test_split_text_prefers_paragraph_then_line_then_word():
+    text = "a" * 60 + "\n\n" + "b" * 30 + "\n" + "c" * 30
+    assert mime_pipeline.split_text(text, 100) == ["a" * 60, "b" * 30 + "\n" + "c" * 30]
+    text = "x" * 70 + "\n" + "y" * 70
+    assert mime_pipeline.split_text(text, 100) == ["x" * 70, "y" * 70]
+    text = ("word " * 40).strip()
+    chunks = mime_pipeline.split_text(text, 50)
+    assert all(len(chunk) <= 50 for chunk in chunks)
+    assert " ".join(chunks) == text
+
+
+@pytest.mark.parametrize('text', [
+    "سلام" * 100, # فارسی بدون فاصله
+    "😀" * 150, # کاراکترهای خارج از BMP
+    "👩‍💻" * 60, # دنباله ZWJ
+    "👍🏽" * 100, # رنگ پوست
+    "❤️" * 100, # variation selector
+    "é" * 150, # حرف + نشانه ترکیبی
+    "می‌شود" * 50, # ZWNJ فارسی
+], ids=['persian', 'emoji', 'zwj', 'skin-tone', 'variation-selector', 'combining-mark', 'zwnj'])
+def test_split_text_hard_cut_keeps_characters_whole(text):
+    chunks = mime_pipeline.split_text(text, 37)
+    assert ''.join(chunks) == text
+    assert all(0 < len(chunk) <= 37 for chunk in chunks)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert not mime_pipeline._is_joined(previous[-1], chunk[0])
+
+
+def test_split_text_every_chunk_fits_telegram_limit():
+    text = ("پاراگراف " * 500 + "\n\n") * 5
+    chunks = mime_pipeline.split_text(text)
+    assert all(len(chunk) <= mime_pipeline.TELEGRAM_MESSAGE_MAX_CHARS for chunk in chunks)
+    assert "".join(chunks).replace(" ", "").replace("\n", "") == text.replace(" ", "").replace("\n", "")
+
+
+# --- extract_body_text ---
+def _message(*parts, mime_type='multipart/alternative'):
+    return {'payload': {'mimeType': mime_type, 'parts': list(parts)}}
+
+
+def _text_part(mime_type, text, charset='utf-8'):
+    return {
+        'mimeType': mime_type,
+        'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'}],
+        'body': {'data': _b64url(text.encode(charset))},
+    }
+
+
+def test_extract_body_prefers_plain_text():
+    message = _message(_text_part('text/html', '<p>html</p>'), _text_part('text/plain', 'plain body'))
+    assert mime_pipeline.extract_body_text(message, 100) == 'plain body'
+
+
+def test_extract_body_converts_html_and_skips_scripts():
+    html = '<html><head><title>t</title><style>p{}</style></head><body><p>یک</p><script>x()</script><ul><li>دو</li></ul></body></html>'
+    message = _message(_text_part('text/html', html))
+    assert mime_pipeline.extract_body_text(message, 100) == 'یک\n\n• دو'
+
+
+def test_extract_body_truncates_with_ellipsis():
+    message = _message(_text_part('text/plain', 'ab ' * 100))
+    text = mime_pipeline.extract_body_text(message, 10)
+    assert text.endswith('…') and len(text) <= 11
+
+
+def test_extract_body_uses_part_charset():
+    message = _message(_text_part('text/plain', 'Grüße', charset='iso-8859-1'))
+    assert mime_pipeline.extract_body_text(message, 100) == 'Grüße'
+
+
+def test_extract_body_multibyte_split_across_fetched_chunks():
+    text = 'سلام دنیا ' * 20
+    raw = text.encode()
+    message = _message({'mimeType': 'text/plain', 'body': {'attachmentId': 'AT1'}})
+    fetched = []
+    def fetch_part_chunks(attachment_id):
+        fetched.append(attachment_id)
+        return _chunks(raw, 3) # مرز تکه‌ها وسط کاراکترهای دو بایتی
+    assert mime_pipeline.extract_body_text(message, 1000, fetch_part_chunks) == text.strip()
+    assert fetched == ['AT1']
+
+
+def test_extract_body_stops_reading_at_limit():
+    read = []
+    def fetch_part_chunks(attachment_id):
+        for _ in range(1000):
+            read.append(1)
+            yield b'x' * 100
+    message = _message({'mimeType': 'text/plain', 'body': {'attachmentId': 'AT1'}})
+    assert len(mime_pipeline.extract_body_text(message, 50, fetch_part_chunks)) == 51
+    assert len(read) < 5
+
+
+def test_extract_body_ignores_attachments_and_missing_parts():
+    attachment = dict(_text_part('text/plain', 'file content'), filename='notes.txt')
+    assert mime_pipeline.extract_body_text(_message(attachment, mime_type='multipart/mixed'), 100) == ''
+    assert mime_pipeline.extract_body_text({'payload': {}}, 100) == ''
+
+
+# --- list_attachments و spool_chunks ---
+def test_list_attachments_in_nested_parts():
+    payload = {'mimeType': 'multipart/mixed', 'parts': [
+        {'mimeType': 'multipart/alternative', 'parts': [_text_part('text/plain', 'body')]},
+        {'mimeType': 'application/pdf', 'filename': 'a.pdf', 'body': {'attachmentId': 'A', 'size': 10}},
+        {'mimeType': 'multipart/mixed', 'parts': [{'mimeType': '', 'filename': 'b.bin', 'body': {'data': 'aGk', 'size': 2}}]},
+    ]}
+    attachments = mime_pipeline.list_attachments(payload)
+    assert [(a['filename'], a['mime_type'], a['size'], a['attachment_id'], a['data']) for a in attachments] == [
+        ('a.pdf', 'application/pdf', 10, 'A', None),
+        ('b.bin', 'application/octet-stream', 2, None, 'aGk'),
+    ]
+
+
+def test_spool_chunks_returns_file_from_start():
+    with mime_pipeline.spool_chunks(iter([b'ab', b'cd']), 10, 1) as spooled:
+        assert spooled.read() == b'abcd'
+
+
+def test_spool_chunks_stops_at_limit_and_closes_source():
+    closed = []
+    def source():
+        try:
+            while True: yield b'x' * 4
+        finally:
+            closed.append(True)
+    with pytest.raises(mime_pipeline.AttachmentTooLargeError):
+        mime_pipeline.spool_chunks(source(), 10, 4)
+    assert closed == [True]
@@ -0,0 +1,97 @@
+import base64
+
+import pytest
+
+import oauth_flow
+
+KEY = base64.urlsafe_b64encode(b'k' * 32).decode()
+
+
+@pytest.fixture
+def signer():
+    return oauth_flow.OAuthStateSigner(KEY, max_age_seconds=600)
+
+
+def _assert_rejected(signer, state):
+    with pytest.raises(oauth_flow.OAuthCallbackError) as error:
+        signer.verify(state)
+    assert error.value.status == 400
+
+
+def test_issue_and_verify_round_trip(signer):
+    state, nonce, issued_at = signer.issue(123, 'google', 456, 789)
+    assert oauth_flow.is_signed_state(state)
+    assert signer.verify(state) == {
+        'state_uuid': nonce, 'telegram_id': 123, 'provider': 'google', 'signed': True, 'chat_id': 456, 'message_id': 789,
+    }
+
+
+def test_verify_without_chat_message(signer):
+    state, _, _ = signer.issue(123, 'google')
+    row = signer.verify(state)
+    assert row['chat_id'] is None and row['message_id'] is None
+
+
+def test_state_from_another_key_is_rejected(signer):
+    other = oauth_flow.OAuthStateSigner(base64.urlsafe_b64encode(b'o' * 32).decode())
+    state, _, _ = other.issue(123, 'google')
+    _assert_rejected(signer, state)
+
+
+@pytest.mark.parametrize('tamper', [
+    lambda state: state.replace('.123.', '.124.', 1), # شناسه کاربر دیگر
+    lambda state: state[:-1] + ('A' if state[-1] != 'A' else 'B'), # امضا
+    lambda state: state[:-2] + 'éé', # کاراکتر غیر ASCII در امضا
+    lambda state: state.replace('google', 'gööglé'), # غیر ASCII در payload
+    lambda state: state.rpartition('.')[0], # بدون امضا
+    lambda state: state + '.extra',
+])
+def test_tampered_state_is_rejected_with_400(signer, tamper):
+    state, _, _ = signer.issue(123, 'google', 456, 789)
+    _assert_rejected(signer, tamper(state))
+
+
+@pytest.mark.parametrize('state', ['s1.', 's1.x', 's1......', 's1.' + '.' * 20, 's1.\x00', 's1.ü.ü', ''])
+def test_malformed_state_is_rejected_with_400(signer, state):
+    _assert_rejected(signer, state)
+
+
+def test_validly_signed_but_malformed_payload_is_rejected_with_400(signer):
+    for payload in ('s1.abc.google...1.nonce', 's1.1.google...notanumber.nonce', 's1.1.google..1.nonce'):
+        _assert_rejected(signer, f"{payload}.{signer._signature(payload)}")
+
+
+def test_expired_state_is_rejected():
+    expired_signer = oauth_flow.OAuthStateSigner(KEY, max_age_seconds=-1)
+    state, _, _ = expired_signer.issue(123, 'google')
+    with pytest.raises(oauth_flow.OAuthCallbackError) as error:
+        expired_signer.verify(state)
+    assert 'منقضی' in error.value.user_message
+
+
+def test_verify_does_not_consume_nonce(signer):
+    state, _, _ = signer.issue(123, 'google')
+    row = signer.verify(state)
+    assert signer.verify(state) == row # خطای موقت گوگل بین verify و ذخیره، لینک را باطل نمی‌کند
+
+
+def test_consumed_state_is_rejected_as_replay(signer):
+    state, _, _ = signer.issue(123, 'google')
+    row = signer.verify(state)
+    assert signer.consume(row) is True
+    assert signer.consume(row) is False
+    with pytest.raises(oauth_flow.OAuthCallbackError) as error:
+        signer.verify(state)
+    assert 'قبلاً استفاده شده' in error.value.user_message
+
+
+def test_consume_ignores_database_state_rows(signer):
+    assert signer.consume({'state_uuid': 'uuid', 'telegram_id': 1, 'provider': 'google'}) is True
+
+
+def test_nonces_are_unique(signer):
+    assert len({signer.issue(1, 'google')[1] for _ in range(100)}) == 100
+
+
+def test_unsigned_states_are_not_treated_as_signed():
+    assert not oauth_flow.is_signed_state('0b8f4c6e-1f2a-4c5e-9d3b-2a1f0e9d8c7b')
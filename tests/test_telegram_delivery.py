@@ -0,0 +1,189 @@
+import asyncio
+import json
+
+import pytest
+from telegram.error import Forbidden, NetworkError, RetryAfter
+
+import telegram_delivery
+from telegram_delivery import COALESCE_SEPARATOR, TELEGRAM_MESSAGE_MAX_CHARS, OutboxWriteError, TelegramDeliveryQueue, TokenBucket
+
+
+# --- TokenBucket ---
+def test_token_bucket_starts_full_and_allows_burst():
+    bucket = TokenBucket(rate_per_second=1, burst=3)
+    now = bucket.updated_at
+    for _ in range(3):
+        assert bucket.wait_time(now) == 0
+        bucket.take()
+    assert bucket.wait_time(now) == pytest.approx(1.0)
+
+
+def test_token_bucket_refills_at_rate_and_caps_at_capacity():
+    bucket = TokenBucket(rate_per_second=4, burst=2)
+    now = bucket.updated_at
+    bucket.take(); bucket.take()
+    assert bucket.wait_time(now) == pytest.approx(0.25)
+    assert bucket.wait_time(now + 0.25) == 0
+    assert not bucket.is_full(now + 0.25)
+    assert bucket.is_full(now + 100)
+    assert bucket.tokens == 2 # پس از بیکاری طولانی بیش از ظرفیت جمع نمی‌شود
+
+
+def test_token_bucket_fractional_rate_and_minimum_capacity():
+    bucket = TokenBucket(rate_per_second=0.5, burst=0)
+    assert bucket.capacity == 1
+    now = bucket.updated_at
+    bucket.take()
+    assert bucket.wait_time(now + 1) == pytest.approx(1.0)
+
+
+# --- ادغام پیام‌ها ---
+def _queue(**kwargs):
+    kwargs.setdefault('coalesce_max_chars', 100)
+    return TelegramDeliveryQueue(lambda *args, **kw: None, None, **kwargs)
+
+
+def _push_texts(queue, chat_id, texts, first_id=1):
+    for row_id, text in enumerate(texts, first_id):
+        queue._push(chat_id, (row_id, text, 0, None))
+
+
+def test_coalesce_merges_small_messages_in_order():
+    queue = _queue()
+    _push_texts(queue, 7, ["a", "b", "c"])
+    assert [item[0] for item in queue._take_coalesced(7)] == [1, 2, 3]
+    assert 7 not in queue._pending and 7 not in queue._ready_chats
+
+
+def test_coalesce_skips_large_messages():
+    queue = _queue()
+    _push_texts(queue, 7, ["a", "x" * 101, "b"])
+    assert [item[0] for item in queue._take_coalesced(7)] == [1]
+    assert [item[0] for item in queue._take_coalesced(7)] == [2]
+    assert [item[0] for item in queue._take_coalesced(7)] == [3]
+
+
+def test_coalesce_never_exceeds_telegram_limit():
+    queue = _queue(coalesce_max_chars=1000)
+    _push_texts(queue, 7, ["x" * 1000] * 10)
+    while 7 in queue._pending:
+        items = queue._take_coalesced(7)
+        assert len(COALESCE_SEPARATOR.join(item[1] for item in items)) <= TELEGRAM_MESSAGE_MAX_CHARS
+
+
+def test_coalesce_keeps_attachment_jobs_separate():
+    queue = _queue()
+    _push_texts(queue, 7, ["a", "b"])
+    queue._push(7, (3, "caption", 0, {'attachment_id': 'A'}))
+    _push_texts(queue, 7, ["c"], first_id=4)
+    assert [item[0] for item in queue._take_coalesced(7)] == [1, 2]
+    assert [item[0] for item in queue._take_coalesced(7)] == [3]
+    assert [item[0] for item in queue._take_coalesced(7)] == [4]
+
+
+# --- enqueue_many ---
+def test_enqueue_many_stores_texts_then_jobs_in_one_insert():
+    calls = []
+    def db_execute(query, params, **kwargs):
+        calls.append((query, params, kwargs))
+        return query.count('(%s')
+    queue = TelegramDeliveryQueue(db_execute, None)
+    queue.enqueue_many(7, ["one", "two"], [("c" * 2000, {'attachment_id': 'A'})])
+    (query, params, kwargs), = calls
+    assert query.startswith("INSERT INTO telegram_outbox") and kwargs['row_count']
+    rows = [params[i:i + 4] for i in range(0, len(params), 4)]
+    assert [(row[0], row[1][:5], row[2]) for row in rows] == [(7, "one", None), (7, "two", None), (7, "ccccc", json.dumps({'attachment_id': 'A'}))]
+    assert len(rows[2][1]) == telegram_delivery.TELEGRAM_CAPTION_MAX_CHARS
+
+
+def test_enqueue_raises_when_rows_are_not_stored():
+    queue = TelegramDeliveryQueue(lambda *args, **kwargs: 0, None)
+    with pytest.raises(OutboxWriteError):
+        queue.enqueue(7, "text")
+    assert queue.stats()['enqueued'] == 0
+
+
+# --- ارسال ---
+class FakeBot:
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        outcome = self.outcomes.pop(0) if self.outcomes else None
+        if outcome: raise outcome
+        self.sent.append((chat_id, text))
+
+
+def _deliver(queue, bot, rounds=1, unblock=True):
+    async def run():
+        queue._loop = asyncio.get_running_loop()
+        queue._wakeup = asyncio.Event()
+        for _ in range(rounds):
+            if unblock:
+                queue._chat_blocked_until.clear()
+                queue._global_blocked_until = 0.0
+            await queue._deliver_next(bot)
+    asyncio.run(run())
+
+
+def test_per_chat_rate_limit_and_round_robin():
+    queue = _queue(per_chat_rate_per_second=0.001, per_chat_burst=1, coalesce_max_chars=0)
+    _push_texts(queue, 1, ["a1", "a2"])
+    _push_texts(queue, 2, ["b1"], first_id=3)
+    bot = FakeBot()
+    _deliver(queue, bot, rounds=3)
+    assert bot.sent == [(1, "a1"), (2, "b1")] # a2 منتظر سطل چت 1 می‌ماند
+
+
+@pytest.mark.filterwarnings("ignore:.*retry_after.*timedelta")
+def test_retry_after_requeues_in_order_and_blocks_chat():
+    queue = _queue(coalesce_max_chars=0)
+    _push_texts(queue, 1, ["a1", "a2"])
+    bot = FakeBot(RetryAfter(30))
+    _deliver(queue, bot, rounds=1)
+    assert bot.sent == [] and [item[0] for item in queue._pending[1]] == [1, 2]
+    assert queue._chat_blocked_until[1] == queue._global_blocked_until > 0
+    _deliver(queue, bot, rounds=1, unblock=False)
+    assert bot.sent == []
+    _deliver(queue, bot, rounds=2)
+    assert bot.sent == [(1, "a1"), (1, "a2")]
+
+
+def test_forbidden_drops_without_retry():
+    queue = _queue()
+    _push_texts(queue, 1, ["a"])
+    _deliver(queue, FakeBot(Forbidden("blocked")), rounds=1)
+    assert queue._finished_ids == [1] and queue.stats()['dropped'] == 1 and not queue._pending
+
+
+def test_network_errors_retry_until_max_attempts():
+    queue = _queue(max_attempts=3)
+    _push_texts(queue, 1, ["a"])
+    bot = FakeBot(NetworkError("x"), NetworkError("x"), NetworkError("x"))
+    _deliver(queue, bot, rounds=2)
+    assert queue._pending[1][0][2] == 2 and queue.stats()['retries'] == 2
+    _deliver(queue, bot, rounds=1)
+    assert queue._finished_ids == [1] and queue.stats()['dropped'] == 1
+
+
+def test_attachment_upload_holds_chat_until_finished():
+    uploads = []
+    def attachment_sender(chat_id, job, caption):
+        uploads.append((chat_id, job['attachment_id'], caption))
+    queue = _queue(attachment_sender=attachment_sender)
+    queue._push(1, (1, "caption", 0, {'attachment_id': 'A'}))
+    _push_texts(queue, 1, ["after"], first_id=2)
+    bot = FakeBot()
+    async def run():
+        queue._loop = asyncio.get_running_loop()
+        queue._wakeup = asyncio.Event()
+        await queue._deliver_next(bot) # شروع آپلود
+        await queue._deliver_next(bot) # چت منتظر پایان آپلود است
+        assert bot.sent == []
+        await asyncio.gather(*queue._upload_tasks)
+        queue._chat_blocked_until.clear()
+        await queue._deliver_next(bot)
+    asyncio.run(run())
+    assert uploads == [(1, 'A', "caption")] and bot.sent == [(1, "after")]
+    assert queue._finished_ids == [1, 2]
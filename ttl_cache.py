@@ -0,0 +1,77 @@
+# ttl_cache.py
+# کش درون‌حافظه‌ای محدود (LRU) با زمان انقضا (TTL)، امن برای استفاده هم‌زمان از چند نخ.
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class TTLCache:
+    """کش LRU با اندازه محدود که هر مدخل پس از ttl_seconds منقضی می‌شود."""
+
+    def __init__(self, maxsize: int = 1024, ttl_seconds: float = 60):
+        self.maxsize = max(1, maxsize)
+        self.ttl_seconds = ttl_seconds
+        self._data = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def get(self, key, default=None):
+        """مقدار کش شده یا default در صورت نبود یا انقضا."""
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self._stats['misses'] += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return default
+            self._data.move_to_end(key)
+            self._stats['hits'] += 1
+            return value
+
+    def set(self, key, value, ttl_seconds: float = None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl_seconds if ttl_seconds is None else ttl_seconds), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def add(self, key, value, ttl_seconds: float = None) -> bool:
+        """درج فقط اگر کلید وجود نداشته یا منقضی شده باشد (بررسی و درج اتمی)؛ True یعنی درج انجام شد."""
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING and entry[0] > time.monotonic():
+                return False
+            self._data[key] = (time.monotonic() + (self.ttl_seconds if ttl_seconds is None else ttl_seconds), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats['evictions'] += 1
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, _MISSING) is not _MISSING:
+                self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """آمار کش: hits، misses، نرخ موفقیت و اندازه فعلی."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._data)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,154 @@
+# webhook_server.py
+# حالت webhook ربات: یک سرور ASGI (Starlette روی uvicorn) در همان پردازه و حلقه رویداد ربات که به‌روزرسانی‌های تلگرام
+# و callback OAuth گوگل را دریافت می‌کند؛ در این حالت اجرای جداگانه redirect_handler_app.py برای /oauth2callback لازم نیست.
+# main_bot.run_bot این ماژول را فقط وقتی TELEGRAM_WEBHOOK_URL تنظیم شده باشد import می‌کند (starlette و uvicorn وابستگی اختیاری‌اند).
+import asyncio
+import contextlib
+import hmac
+import logging
+import secrets
+import signal
+
+import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import HTMLResponse, PlainTextResponse, Response
+from starlette.routing import Route
+from telegram import Update
+
+import oauth_flow
+
+logger = logging.getLogger(__name__)
+
+
+class _UvicornServer(uvicorn.Server):
+    """سیگنال‌های توقف را BotWebhookServer.serve مدیریت می‌کند (uvicorn پس از serve سیگنال را دوباره ارسال می‌کند
+    و توقف برنامه تلگرام نیمه‌کاره می‌ماند)."""
+
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
+
+    def install_signal_handlers(self): # نسخه‌های قدیمی‌تر uvicorn
+        pass
+
+
+class BotWebhookServer:
+    """سرور مشترک webhook تلگرام و callback OAuth.
+
+    به‌روزرسانی‌ها پس از بررسی هدر secret token فقط در update_queue برنامه قرار می‌گیرند و پاسخ بلافاصله برمی‌گردد؛
+    فراخوانی‌های گوگل در callback OAuth با httpx.AsyncClient (keep-alive و HTTP/2 در صورت نصب بودن h2) و کارهای پایگاه داده با run_db انجام می‌شوند
+    تا حلقه رویداد ربات مسدود نشود.
+    """
+
+    def __init__(self, application, db_execute, run_db, encrypt_data, google_client_id: str, google_client_secret: str,
+                 google_redirect_uri: str, webhook_path: str = "/telegram", secret_token: str = None, on_account_connected=None,
+                 google_http_max_connections: int = 100, oauth_state_signer=None):
+        self.application = application
+        self._db_execute = db_execute
+        self._run_db = run_db
+        self._encrypt_data = encrypt_data
+        self.google_client_id = google_client_id
+        self.google_client_secret = google_client_secret
+        self.google_redirect_uri = google_redirect_uri
+        self.webhook_path = "/" + webhook_path.strip("/")
+        # اگر داده نشود، در هر اجرا یک مقدار تصادفی ساخته و هنگام set_webhook به تلگرام داده می‌شود
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+        self._on_account_connected = on_account_connected
+        self.google_http_max_connections = google_http_max_connections
+        self.oauth_state_signer = oauth_state_signer # برای state امضا شده (oauth_flow.OAuthStateSigner)
+        self._http_client = None
+        self.asgi_app = Starlette(routes=[
+            Route(self.webhook_path, self.telegram_update, methods=["POST"]),
+            Route("/oauth2callback", self.oauth2callback, methods=["GET"]),
+            Route("/healthz", self.healthz, methods=["GET"]),
+        ])
+
+    # --- مسیرها ---
+    async def telegram_update(self, request):
+        if not hmac.compare_digest(request.headers.get('X-Telegram-Bot-Api-Secret-Token', ''), self.secret_token):
+            logger.warning("Telegram webhook request rejected: invalid secret token.")
+            return Response(status_code=403)
+        try:
+            update_data = await request.json()
+        except ValueError:
+            return Response(status_code=400)
+        await self.application.update_queue.put(Update.de_json(update_data, self.application.bot))
+        return Response()
+
+    async def healthz(self, request):
+        return PlainTextResponse("ok")
+
+    async def oauth2callback(self, request):
+        user_telegram_id = None
+        try:
+            state_from_google, code_from_google = oauth_flow.parse_callback_args(request.query_params)
+            if self.oauth_state_signer and oauth_flow.is_signed_state(state_from_google):
+                state_data_row = self.oauth_state_signer.verify(state_from_google)
+            else:
+                state_data_row = await self._run_db(self._db_execute, oauth_flow.OAUTH_STATE_QUERY, (state_from_google,), fetchone=True)
+            user_telegram_id, provider = oauth_flow.check_state_row(state_data_row, state_from_google)
+
+            token_payload = oauth_flow.token_request_data(code_from_google, self.google_client_id, self.google_client_secret, self.google_redirect_uri)
+            try:
+                token_response = await self._http_client.post(oauth_flow.GOOGLE_TOKEN_URL, data=token_payload)
+                token_response.raise_for_status()
+                access_token, refresh_token, expires_in = oauth_flow.parse_token_response(token_response.json(), user_telegram_id)
+            except httpx.HTTPError as e:
+                raise oauth_flow.OAuthCallbackError(f"Error exchanging code for token for user {user_telegram_id}: {e}", "خطا در تبادل کد با توکن.")
+
+            try:
+                user_info_response = await self._http_client.get(oauth_flow.GOOGLE_USERINFO_URL, headers={'Authorization': f'Bearer {access_token}'})
+                user_info_response.raise_for_status()
+                user_email = oauth_flow.parse_user_email(user_info_response.json(), user_telegram_id)
+            except httpx.HTTPError as e:
+                raise oauth_flow.OAuthCallbackError(f"Error fetching user info for user {user_telegram_id}: {e}", "خطا در دریافت اطلاعات کاربر از گوگل.")
+        except oauth_flow.OAuthCallbackError as e:
+            logger.error(str(e))
+            return HTMLResponse(oauth_flow.render_page(oauth_flow.ERROR_PAGE_TEMPLATE, error_message=e.user_message), e.status)
+        except Exception as e:
+            logger.error(f"Unexpected error during Google token exchange or user info fetch for user {user_telegram_id}: {e}")
+            return HTMLResponse(oauth_flow.render_page(oauth_flow.ERROR_PAGE_TEMPLATE, error_message="خطای پیش‌بینی نشده در سرور."), 500)
+
+        try:
+            await self._run_db(
+                oauth_flow.store_connected_account, self._db_execute, self._encrypt_data, state_data_row, user_email,
+                access_token, refresh_token, expires_in
+            )
+            if self.oauth_state_signer: self.oauth_state_signer.consume(state_data_row) # فقط پس از ذخیره موفق
+        except Exception as e: # گرفتن خطاهای پایگاه داده یا رمزنگاری
+            logger.error(f"Error saving tokens or deleting state for user {user_telegram_id}, email {user_email}: {e}")
+            return HTMLResponse(oauth_flow.render_page(oauth_flow.ERROR_PAGE_TEMPLATE, error_message="خطا در ذخیره‌سازی اطلاعات اتصال در سرور."), 500)
+        logger.info(f"Successfully stored/updated OAuth tokens for user {user_telegram_id}, email {user_email}; consumed state {state_data_row['state_uuid']}")
+        if self._on_account_connected: self._on_account_connected(user_telegram_id)
+        return HTMLResponse(oauth_flow.render_page(oauth_flow.SUCCESS_PAGE_TEMPLATE, email=user_email))
+
+    # --- اجرا ---
+    async def serve(self, listen_host: str, listen_port: int, webhook_url: str):
+        """راه‌اندازی برنامه، ثبت webhook در تلگرام و اجرای uvicorn تا دریافت SIGINT/SIGTERM (معادل run_polling)."""
+        application = self.application
+        server = _UvicornServer(uvicorn.Config(
+            self.asgi_app, host=listen_host, port=listen_port, log_config=None, access_log=False, proxy_headers=True
+        ))
+        self._http_client = httpx.AsyncClient(**oauth_flow.google_http_client_options(self.google_http_max_connections))
+        await application.initialize()
+        try:
+            if application.post_init: await application.post_init(application)
+            await application.bot.set_webhook(
+                url=webhook_url.rstrip("/") + self.webhook_path, secret_token=self.secret_token, allowed_updates=Update.ALL_TYPES
+            )
+            await application.start()
+            logger.info(f"Webhook server listening on {listen_host}:{listen_port} (Telegram updates at {self.webhook_path}, OAuth at /oauth2callback).")
+            loop = asyncio.get_running_loop()
+            for stop_signal in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(stop_signal, setattr, server, 'should_exit', True)
+            try:
+                await server.serve()
+            finally:
+                for stop_signal in (signal.SIGINT, signal.SIGTERM): loop.remove_signal_handler(stop_signal)
+                await application.stop()
+                if application.post_stop: await application.post_stop(application)
+        finally:
+            await self._http_client.aclose()
+            await application.shutdown()
+            if application.post_shutdown: await application.post_shutdown(application)